@@ -1,31 +1,55 @@
 import logging
 import sys
-import threading
+import time
 import process_manager
 from process_manager import ProcessManager
 
 
-logging.basicConfig(format="%(asctime)s: %(message)s",
-                    level=logging.INFO, datefmt="%H:%M:%S")
-logging.info("Multinational Retail Data Centralisation project starting")
+# the processes of the executor_hybrid and executor_processes pools are spawned, and import this module again as __mp_main__,
+# so the run only starts when this is the main module and not in each process of the pool
+def main():
+    ProcessManager.initialise_process()
+    logging.info("Multinational Retail Data Centralisation project starting")
 
-process_manager = ProcessManager()
-for arg in  sys.argv:
-    if arg not in process_manager.valid_arguments_list and arg!='.':
-        logging.error(f"invalid argument {arg} specified. valid arguments are \
-                      {process_manager.valid_arguments_list}")
-        exit()
+    process_manager = ProcessManager()
+    # the first argument is the script, such as . or __main__.py
+    for arg in sys.argv[1:]:
+        # replay is also given as replay=<snapshot id>
+        if arg.startswith('replay='):
+            arg = 'replay'
+        if arg not in process_manager.valid_arguments_list:
+            logging.error(f"invalid argument {arg} specified. valid arguments are \
+                          {process_manager.valid_arguments_list}")
+            exit()
 
 
-thread_list = process_manager.initialise_threads(sys.argv)
+    stage_scheduler = process_manager.initialise_stages(sys.argv)
+    start_time = time.perf_counter()
 
-for thread in thread_list:
-    thread.start()
+    # each stage starts as soon as the stages it depends on have succeeded
+    succeeded = stage_scheduler.run(process_manager.api_config.get('stage_max_workers'))
 
-# wait for all threads to finish
-for thread in thread_list:
-    thread.join()
+    # waits for the raw snapshots still being saved with write_raw
+    succeeded = process_manager.finalise() and succeeded
+    logging.info(f"{process_manager.executor} executor: stages finished in {time.perf_counter()-start_time:.1f}s")
+    for line in stage_scheduler.report().splitlines():
+        logging.info(line)
 
-process_manager.finalise()
+    for prefix, statistics in process_manager.db_connector.pool_statistics().items():
+        logging.info(f"{prefix} connection pool: {statistics}")
 
-logging.info("all done")
+    # the time, rows, bytes and memory of each stage, to compare with earlier runs
+    metrics_report_path = process_manager.api_config.get('metrics_report_path', 'run_report.json')
+    metrics_prometheus_path = process_manager.api_config.get('metrics_prometheus_path')
+    process_manager.metrics.write_reports(process_manager.metrics.report(stage_scheduler), metrics_report_path, metrics_prometheus_path)
+    if metrics_report_path:
+        logging.info(f"run report written to {metrics_report_path}")
+
+    if not succeeded:
+        logging.error("some stages FAILED")
+        exit(1)
+    logging.info("all done")
+
+
+if __name__ == '__main__':
+    main()
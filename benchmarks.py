@@ -0,0 +1,257 @@
+'''
+Benchmarks for the extraction, cleaning and loading hot paths.
+They use generated data from sample_data so no credentials or network access are needed unless noted.
+Run them all with:
+    python benchmarks.py
+or only the ones named on the command line, such as:
+    python benchmarks.py store_frames
+'''
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+import requests
+import sample_data
+import sqlalchemy.types as types
+from data_cleaning import DataCleaning
+from data_extraction import DataExtractor
+from database_utils import DatabaseConnector
+from date_parsing import DateParser
+from extract_cache import ExtractCache
+from phone_number_formatter import PhoneNumberFormatter
+from raw_snapshots import RawSnapshots
+from reference_cleaning import ReferenceCleaning
+from schema_inference import SchemaInferrer
+
+
+def time_best_of(function, repeat=3) -> float:
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def report(name: str, baseline_seconds: float, new_seconds: float):
+    print(f"{name}: {baseline_seconds:.4f}s -> {new_seconds:.4f}s ({baseline_seconds/new_seconds:.1f}x)")
+
+def benchmark_store_frames(number_of_stores=20000):
+    # one row DataFrame per store concatenated vs a single DataFrame built from the JSON records
+    store_records = sample_data.store_records(number_of_stores)
+    data_extractor = DataExtractor()
+    baseline = time_best_of(lambda: pd.concat([pd.DataFrame(record, index=["index"]) for record in store_records]))
+    new = time_best_of(lambda: data_extractor.stores_records_to_data_frame(store_records))
+    report(f"store frames ({number_of_stores} stores)", baseline, new)
+
+def benchmark_rds_copy(table_name='legacy_users'):
+    # needs db_creds.yaml. Reads the table from the source (RDS_) database, such as a local PostgreSQL loaded with sample_data
+    db_connector = DatabaseConnector()
+    data_extractor = DataExtractor()
+    baseline = time_best_of(lambda: data_extractor.read_rds_table(db_connector, table_name))
+    new = time_best_of(lambda: data_extractor.read_rds_table(db_connector, table_name, use_copy=True))
+    row_count = data_extractor.read_rds_table(db_connector, table_name).shape[0]
+    report(f"read {table_name} read_sql_table -> COPY ({row_count} rows)", baseline, new)
+
+def benchmark_upload(number_of_rows=200000):
+    # needs db_creds.yaml. Writes benchmark_orders to the target (LOCAL_) database
+    db_connector = DatabaseConnector()
+    data_frame = DataCleaning().clean_orders_data(sample_data.orders_frame(number_of_rows))
+    dtypes = {'product_quantity': types.SMALLINT, 'date_uuid': types.UUID, 'user_uuid': types.UUID}
+    baseline = time_best_of(lambda: db_connector.upload_to_db(data_frame, 'benchmark_orders', dtypes, bulk_load=False), repeat=1)
+    new = time_best_of(lambda: db_connector.upload_to_db(data_frame, 'benchmark_orders', dtypes))
+    report(f"upload orders INSERT -> COPY ({number_of_rows} rows)", baseline, new)
+
+def benchmark_upsert(number_of_rows=200000, changed_fraction=0.01):
+    # needs db_creds.yaml. Replacing benchmark_users in the target (LOCAL_) database vs loading only the rows which changed
+    db_connector = DatabaseConnector()
+    data_frame = DataCleaning().clean_user_data(sample_data.users_frame(number_of_rows))
+    dtypes = {'date_of_birth': types.DATE, 'join_date': types.DATE, 'user_uuid': types.UUID}
+    db_connector.upsert_to_db(data_frame, 'benchmark_users', dtypes, 'user_uuid', full_refresh=True)
+    changed = data_frame.copy()
+    changed_rows = changed.sample(frac=changed_fraction, random_state=0).index
+    changed.loc[changed_rows, 'last_name'] = 'Changed'
+    baseline = time_best_of(lambda: db_connector.upsert_to_db(changed, 'benchmark_users', dtypes, 'user_uuid', full_refresh=True))
+    # the table is put back to the unchanged rows before each timing so every incremental load has the changes to write
+    reset = lambda: db_connector.upsert_to_db(data_frame, 'benchmark_users', dtypes, 'user_uuid', full_refresh=True)
+    new = min(timeit.repeat(lambda: db_connector.upsert_to_db(changed, 'benchmark_users', dtypes, 'user_uuid'),
+                            setup=reset, number=1, repeat=3))
+    report(f"load users replace -> incremental ({len(data_frame)} rows, {len(changed_rows)} changed)", baseline, new)
+
+def benchmark_null_strings(number_of_rows=1000000):
+    # the original per cell apply vs the vectorised isin on the users columns
+    data_frame = sample_data.users_frame(number_of_rows).drop('index', axis=1)
+    baseline = time_best_of(lambda: ReferenceCleaning().handle_nulls_empties_and_duplicates(data_frame.copy()), repeat=1)
+    new = time_best_of(lambda: DataCleaning()._DataCleaning__handle_nulls_empties_and_duplicates(data_frame.copy()), repeat=1)
+    report(f"null strings apply -> isin ({number_of_rows} rows)", baseline, new)
+
+def benchmark_weights(number_of_rows=1000000):
+    # converting each weight and assigning its class per cell vs the regular expression and pd.cut
+    weights = pd.Series(sample_data.weight_values(number_of_rows))
+    reference_cleaning = ReferenceCleaning()
+    data_cleaning = DataCleaning()
+    def convert_per_cell():
+        converted = weights.apply(reference_cleaning.convert_product_weight).astype('float')
+        return converted.apply(reference_cleaning.assign_weight_class)
+    def convert_vectorised():
+        converted = data_cleaning._DataCleaning__convert_product_weights(pd.DataFrame({'weight': weights}))['weight']
+        return data_cleaning._DataCleaning__assign_weight_classes(converted)
+    baseline = time_best_of(convert_per_cell)
+    new = time_best_of(convert_vectorised)
+    report(f"weights apply -> str.extract and pd.cut ({number_of_rows} rows)", baseline, new)
+
+def benchmark_nonnumeric(number_of_rows=1000000):
+    # removing non-numeric characters from each cell with apply vs str.replace on the string cells, for each column it is used on
+    stores = pd.DataFrame.from_records(sample_data.store_records(number_of_rows))
+    columns = {'longitude': stores['longitude'], 'latitude': stores['latitude'], 'staff_numbers': stores['staff_numbers'],
+               'product_price': sample_data.products_frame(number_of_rows)['product_price']}
+    reference_cleaning = ReferenceCleaning()
+    data_cleaning = DataCleaning()
+    for name, column in columns.items():
+        baseline = time_best_of(lambda: column.apply(reference_cleaning.remove_nonnumeric_characters))
+        new = time_best_of(lambda: data_cleaning._DataCleaning__remove_nonnumeric_characters(column))
+        report(f"{name} non-numeric characters apply -> str.replace ({number_of_rows} rows)", baseline, new)
+def benchmark_phones(number_of_rows=2000000):
+    # the UK pattern match and six regex replacements over the column vs one pass of the numbering plan for each country
+    phone_numbers = sample_data.phone_numbers(number_of_rows)
+    baseline = time_best_of(lambda: ReferenceCleaning().reformat_phone_data(phone_numbers[['phone_number']].copy(), 'phone_number'), repeat=1)
+    new = time_best_of(lambda: PhoneNumberFormatter().format_phone_numbers(phone_numbers['phone_number'], phone_numbers['country_code']), repeat=1)
+    report(f"phone numbers str.match and replace -> PhoneNumberFormatter ({number_of_rows} rows, {number_of_rows/new:,.0f} rows/s)", baseline, new)
+
+def benchmark_dates(number_of_rows=1000000):
+    # parsing each distinct date with dateutil through format='mixed' vs the explicit format passes over the distinct dates
+    for name, seed in [('date_of_birth', 0), ('join_date', 1)]:
+        column = pd.Series(sample_data.date_strings(number_of_rows, seed), name=name)
+        baseline = time_best_of(lambda: pd.to_datetime(column, format='mixed', errors='coerce'), repeat=1)
+        new = time_best_of(lambda: DateParser().parse(column, errors='coerce'))
+        report(f"{name} format='mixed' -> DateParser ({number_of_rows} rows)", baseline, new)
+
+def benchmark_times(number_of_rows=1000000):
+    # joining the date and time strings and inferring their format vs building the datetimes from the numbers
+    data_frame = sample_data.times_frame(number_of_rows)
+    baseline = time_best_of(lambda: ReferenceCleaning().clean_time_data(data_frame.copy()))
+    new = time_best_of(lambda: DataCleaning().clean_time_data(data_frame.copy()))
+    report(f"clean_time_data joined strings -> numbers ({number_of_rows} rows)", baseline, new)
+
+def benchmark_extract_cache(number_of_rows=100000):
+    # downloading the date details JSON on every run vs revalidating the cached copy with its ETag.
+    # served from localhost, so this understates the saving on a real network
+    content = sample_data.times_frame(number_of_rows).to_json().encode()
+    class JsonHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.headers.get('If-None-Match') == '"1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', '"1"')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        def log_message(self, format, *args):
+            pass
+    server = ThreadingHTTPServer(('localhost', 0), JsonHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://localhost:{server.server_port}/date_details.json'
+    session = requests.Session()
+    with tempfile.TemporaryDirectory() as directory:
+        extract_cache = ExtractCache(directory)
+        extract_cache.fetch_http(session, url)
+        baseline = time_best_of(lambda: session.get(url).content)
+        new = time_best_of(lambda: extract_cache.fetch_http(session, url))
+        report(f"date details download -> ETag revalidation ({len(content)} bytes)", baseline, new)
+    server.shutdown()
+    server.server_close()
+
+def benchmark_executors(number_of_rows=200000):
+    # cleaning the users, products and cards together on threads vs in a process pool as the hybrid executor does.
+    # the process pool only helps with more than one CPU, since it adds the pickling of each DataFrame there and back
+    data_cleaning = DataCleaning()
+    work = [(data_cleaning.clean_user_data, sample_data.users_frame(number_of_rows)),
+            (data_cleaning.clean_products_data, sample_data.products_frame(number_of_rows)),
+            (data_cleaning.clean_card_data, sample_data.cards_frame(number_of_rows))]
+    def clean_all(executor):
+        futures = [executor.submit(clean_function, data_frame.copy()) for clean_function, data_frame in work]
+        return [future.result() for future in futures]
+    with ThreadPoolExecutor(max_workers=len(work)) as thread_pool, \
+         ProcessPoolExecutor(max_workers=len(work), mp_context=multiprocessing.get_context('spawn')) as process_pool:
+        # start the processes before timing
+        list(process_pool.map(abs, range(len(work))))
+        baseline = time_best_of(lambda: clean_all(thread_pool))
+        new = time_best_of(lambda: clean_all(process_pool))
+    report(f"cleaning threads -> processes ({number_of_rows} rows each, {os.cpu_count()} CPUs)", baseline, new)
+
+def benchmark_raw_snapshots(number_of_rows=120000):
+    # needs db_creds.yaml. How long a stage waits to save the raw orders: a _raw table in the target (LOCAL_) database vs the background snapshot
+    db_connector = DatabaseConnector()
+    data_frame = sample_data.orders_frame(number_of_rows)
+    baseline = time_best_of(lambda: db_connector.upload_to_db(data_frame, 'benchmark_orders_raw'))
+    with tempfile.TemporaryDirectory() as directory:
+        raw_snapshots = RawSnapshots(directory, 'benchmark')
+        new = time_best_of(lambda: raw_snapshots.write('orders_table', data_frame))
+        raw_snapshots.close()
+        replay = time_best_of(lambda: raw_snapshots.read('orders_table'))
+    report(f"saving raw orders _raw table -> background snapshot ({number_of_rows} rows, {replay:.2f}s to replay)", baseline, new)
+
+def benchmark_compact_dtypes(number_of_rows=120000, number_of_users=15000):
+    # the memory held by the cleaned orders with object strings and int64 numbers vs the categoricals and downcast integers
+    data_frame = DataCleaning().clean_orders_data(sample_data.orders_frame(number_of_rows, number_of_users=number_of_users))
+    memory_bytes, memory_bytes_uncompacted = DataCleaning.memory_footprint(data_frame)
+    print(f"cleaned orders in memory object/int64 -> compact types ({number_of_rows} rows): "
+          f"{memory_bytes_uncompacted/2**20:.1f}MB -> {memory_bytes/2**20:.1f}MB ({memory_bytes_uncompacted/memory_bytes:.1f}x)")
+
+def benchmark_schema_inference(number_of_rows=120000):
+    # the longest value of each text column of the orders measured one value at a time with a lambda vs the inferred types of every column, and read from the cache
+    data_frame = DataCleaning().clean_orders_data(sample_data.orders_frame(number_of_rows))
+    text_columns = ['date_uuid', 'user_uuid', 'card_number', 'store_code', 'product_code']
+    baseline = time_best_of(lambda: [data_frame[column].map(lambda x: len(str(x))).max() for column in text_columns])
+    new = time_best_of(lambda: SchemaInferrer().infer(data_frame, {'product_quantity': types.SMALLINT}))
+    with tempfile.TemporaryDirectory() as directory:
+        schema_inferrer = SchemaInferrer(os.path.join(directory, 'schema_cache.json'))
+        schema_inferrer.infer(data_frame, {'product_quantity': types.SMALLINT}, 'orders_table', 'benchmark')
+        cached = time_best_of(lambda: schema_inferrer.infer(data_frame, {'product_quantity': types.SMALLINT}, 'orders_table', 'benchmark'))
+    report(f"orders VARCHAR lengths per value -> all column types inferred ({number_of_rows} rows, {cached:.4f}s from the cache)", baseline, new)
+
+def benchmark_copies(number_of_rows=120000):
+    # the peak memory allocated by each cleaner as a number of copies of its extract, with the time it takes. under Copy-on-Write the columns
+    # which are passed through are shared, so only the rows are sliced once. tests_unit compares the copies with those of the previous cleaners
+    data_frames = {'clean_user_data': sample_data.users_frame(number_of_rows),
+                   'clean_card_data': sample_data.cards_frame(number_of_rows),
+                   'clean_store_data': DataExtractor().stores_records_to_data_frame(sample_data.store_records(number_of_rows // 10)),
+                   'clean_products_data': sample_data.products_frame(number_of_rows),
+                   'clean_orders_data': sample_data.orders_frame(number_of_rows),
+                   'clean_time_data': sample_data.times_frame(number_of_rows)}
+    for clean_function_name, data_frame in data_frames.items():
+        clean_function = getattr(DataCleaning(), clean_function_name)
+        # Copy-on-Write is on as ProcessManager.initialise_process turns it on for a run
+        with pd.option_context('mode.copy_on_write', True):
+            seconds = time_best_of(lambda: clean_function(data_frame))
+            tracemalloc.start()
+            clean_function(data_frame)
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        input_bytes = data_frame.memory_usage(index=False, deep=True).sum()
+        print(f"{clean_function_name} peak allocations ({len(data_frame)} rows): {peak_bytes/2**20:.1f}MB, "
+              f"{peak_bytes/input_bytes:.2f} copies of the extract in {seconds:.4f}s")
+
+benchmarks = {'store_frames': benchmark_store_frames,
+              'rds_copy': benchmark_rds_copy,
+              'upload': benchmark_upload,
+              'upsert': benchmark_upsert,
+              'null_strings': benchmark_null_strings,
+              'weights': benchmark_weights,
+              'nonnumeric': benchmark_nonnumeric,
+              'phones': benchmark_phones,
+              'dates': benchmark_dates,
+              'times': benchmark_times,
+              'extract_cache': benchmark_extract_cache,
+              'executors': benchmark_executors,
+              'raw_snapshots': benchmark_raw_snapshots,
+              'compact_dtypes': benchmark_compact_dtypes,
+              'schema_inference': benchmark_schema_inference,
+              'copies': benchmark_copies}
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] or list(benchmarks)
+    for name in selected:
+        benchmarks[name]()
@@ -1,39 +1,157 @@
+import contextlib
+import datetime
+import itertools
+import sys
+import numpy as np
 import pandas as pd
-import re
+from date_parsing import DateParser
+from phone_number_formatter import PhoneNumberFormatter
+
 
 
 class DataCleaning:
+    # the cleaners are written for Copy-on-Write, which ProcessManager.initialise_process turns on once for a run: a DataFrame made from another by
+    # dropping, selecting or adding columns then shares the arrays of the columns it does not change rather than copying them.
+    # without it the results are the same, only with more copies. the caller's DataFrame is never changed either way
+    # one formatter is shared so its patterns are only compiled once
+    phone_number_formatter = PhoneNumberFormatter()
+    # every upper/lower case spelling of the strings which mean null, so they can be found with a vectorised isin rather than lower() on each cell
+    null_strings = [''.join(letters) for word in ['null', 'none', 'nan']
+                    for letters in itertools.product(*[(letter, letter.upper()) for letter in word])]
+    # a weight such as '12x100g', '1.2kg' or '500ml' once the spaces are removed
+    weight_expression = r'\A(?:(?P<multiplier>[0-9]+\.?[0-9]*|\.[0-9]+)x)?(?P<value>[0-9]+\.?[0-9]*|\.[0-9]+)(?P<unit>kg|g|ml)?\.?\Z'
+    # a time in the date details such as 22:00:06. Seconds of 60 are left to pd.to_datetime, which carries them into the next minute
+    time_expression = '(?:[01]?[0-9]|2[0-3]):[0-5]?[0-9]:[0-5]?[0-9]'
+    # the weight classes are bounded below by these weights in kg. Weights which are not a number are Truck_Required
+    weight_class_bins = [float('-inf'), 2, 40, 140, float('inf')]
+    weight_class_labels = ['Light', 'Mid_Sized', 'Heavy', 'Truck_Required']
+    # when set to a RunMetrics, the null handling, weights, phone numbers and dates of each clean are timed as steps of the stage
+    metrics = None
+    # the column added to a chunk cleaned with whole_table=False: a hash of each row as it is when a whole table has its duplicates found,
+    # so that the database removes the same duplicates from a streamed table, rather than those of the cleaned rows
+    duplicate_key_column = 'etl_duplicate_key'
+
+    def __step(self, step: str):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.step(step)
+
     # clean the user data - handle NULL values, errors with dates, incorrectly typed values and rows filled with the wrong information.
-    def __handle_nulls_empties_and_duplicates(self, data_frame: pd.DataFrame) -> pd.DataFrame:
-        for column in data_frame.columns:
-                data_frame[column] = data_frame[column].apply(self.__replace_null_strings)
-        data_frame.drop_duplicates(inplace=True)
-        # remove completely empty columns & rows in the dataframe
-        data_frame.dropna(how="all", axis=1, inplace=True)
-        data_frame.dropna(how="all", axis=0, inplace=True)
+    # returns the DataFrame with the null strings replaced and the empty columns dropped, and the mask of the rows to keep: those with a value and
+    # the first of each duplicate. the rows are not sliced here, so each cleaner combines the mask with its own and slices the rows once.
+    # when whole_table is False, data_frame is one chunk of a table so removing duplicates and empty columns is left to the database,
+    # with the duplicate key of each row added as the last column
+    def __handle_nulls_empties_and_duplicates(self, data_frame: pd.DataFrame, whole_table=True) -> tuple:
+        replaced_columns, empty_columns = {}, []
+        # the nulls are found a column at a time rather than with isna() on the whole DataFrame, which would hold a flag for every cell
+        has_value = np.zeros(data_frame.shape[0], dtype=bool)
+        for column_name, column in data_frame.items():
+            # only object columns can hold strings
+            if column.dtype == object:
+                null_mask = column.isin(self.null_strings)
+                # infer_objects gives the column the same type as apply did, such as float64 for numbers once the null strings are gone
+                column = replaced_columns[column_name] = (column.where(~null_mask, None) if null_mask.any() else column).infer_objects()
+            is_value = column.notna().to_numpy()
+            has_value |= is_value
+            if not is_value.any():
+                empty_columns.append(column_name)
+        data_frame = data_frame.assign(**replaced_columns)
+        rows = pd.Series(has_value, index=data_frame.index)
+        if whole_table:
+            # remove completely empty columns & rows in the dataframe
+            data_frame = self.__drop_columns(data_frame, empty_columns)
+            return data_frame, rows & ~self.__duplicated_rows(data_frame)
+        return data_frame.assign(**{self.duplicate_key_column: self.__duplicate_keys(data_frame)}), rows
+
+    # the same as data_frame.duplicated(), but the codes of each column are folded into one id per row as the columns are factorized
+    # rather than all being held until the last column, so at most three arrays of the rows are held at once rather than one per column
+    def __duplicated_rows(self, data_frame: pd.DataFrame) -> pd.Series:
+        row_ids = np.zeros(data_frame.shape[0], dtype='int64')
+        number_of_ids = 1
+        for _, column in data_frame.items():
+            # nulls have the code -1, so every code is shifted up one
+            codes, unique_values = pd.factorize(column)
+            # the ids are numbered again from 0 when combining them with the next column could overflow
+            if number_of_ids * (len(unique_values) + 1) >= 2**62:
+                row_ids, unique_ids = pd.factorize(row_ids)
+                number_of_ids = len(unique_ids)
+            row_ids *= len(unique_values) + 1
+            row_ids += codes + 1
+            number_of_ids *= len(unique_values) + 1
+        return pd.Series(row_ids, index=data_frame.index).duplicated()
+
+    # the rows of different chunks are compared by these keys, so each value is written the same way whatever the type its chunk gave the column,
+    # and values which duplicated() treats as equal, such as 1, 1.0 and True or None and NaN, are written the same
+    def __duplicate_keys(self, data_frame: pd.DataFrame) -> pd.Series:
+        canonical_columns = {column_name: self.__canonical_values(column) for column_name, column in data_frame.items()}
+        row_hashes = pd.util.hash_pandas_object(pd.DataFrame(canonical_columns, index=data_frame.index), index=False)
+        # int64 rather than uint64 so that the keys fit in a BIGINT column
+        return pd.Series(row_hashes.to_numpy().view('int64'), index=data_frame.index)
+
+    def __canonical_values(self, column: pd.Series) -> pd.Series:
+        is_value = column.notna().to_numpy()
+        canonical = np.full(column.shape[0], None, dtype=object)
+        if pd.api.types.is_integer_dtype(column) or pd.api.types.is_bool_dtype(column):
+            canonical[is_value] = 'n' + column[is_value].astype('int64').astype(str)
+        else:
+            canonical[is_value] = [self.__canonical_value(value) for value in column[is_value]]
+        return pd.Series(canonical, index=column.index)
+
+    @staticmethod
+    def __canonical_value(value) -> str:
+        if isinstance(value, str):
+            return 's' + value
+        if isinstance(value, (bool, np.bool_, int, np.integer)):
+            return 'n' + str(int(value))
+        if isinstance(value, (float, np.floating)):
+            value = float(value)
+            return 'n' + (str(int(value)) if value.is_integer() else repr(value))
+        if isinstance(value, (datetime.datetime, np.datetime64)):
+            return 't' + str(pd.Timestamp(value).value)
+        return 'o' + repr(value)
+
+    # under Copy-on-Write deleting a column splits its block around it and shares the other columns, where drop() would take them into a new array.
+    # the caller's DataFrame keeps its columns
+    def __drop_columns(self, data_frame: pd.DataFrame, column_names) -> pd.DataFrame:
+        data_frame = data_frame.copy(deep=False)
+        for column_name in column_names:
+            del data_frame[column_name]
         return data_frame
+
+    # slices the rows once every mask of a cleaner is combined. when every row is kept the DataFrame is returned as it is rather than copied
+    def __keep_rows(self, data_frame: pd.DataFrame, rows: pd.Series) -> pd.DataFrame:
+        if rows.all():
+            return data_frame
+        return data_frame.loc[rows]
     
-    def __replace_null_strings(self, cell_value):
-        if type(cell_value) == str and cell_value.lower() in ['null','none', 'nan']:
-            cell_value = None
-        return cell_value
-    
+    # left as a per cell step: on object strings two str.replace calls per cell are faster than any of the pandas .str methods
     def __remove_unwanted_characters(self, cell_value):
         if type(cell_value) == str:
             cell_value = cell_value.replace('?','').replace('.','')
         return cell_value
-    
-    def __remove_nonnumeric_characters(self, cell_value):
-        if type(cell_value) == str:
-            cell_value = re.sub("[^0-9.]", "",cell_value)
-            if cell_value == '':
-                cell_value = None
-        return cell_value
 
-    def __reformat_phone_data(self, data_frame: pd.DataFrame, column_name: str):
-        regex_expression = r'^(?:(?:\(?(?:0(?:0|11)\)?[\s-]?\(?|\+)44\)?[\s-]?(?:\(?0\)?[\s-]?)?)|(?:\(?0))(?:(?:\d{5}\)?[\s-]?\d{4,5})|(?:\d{4}\)?[\s-]?(?:\d{5}|\d{3}[\s-]?\d{3}))|(?:\d{3}\)?[\s-]?\d{3}[\s-]?\d{3,4})|(?:\d{2}\)?[\s-]?\d{4}[\s-]?\d{4}))(?:[\s-]?(?:x|ext\.?|\#)\d{3,4})?$'
-        data_frame.loc[~data_frame[column_name].str.match(regex_expression), column_name] = None # For every row where the column_name column does not match our regular expression, replace the value with None/null
-        data_frame[column_name] = data_frame[column_name].replace({r'\+44(0)': '0',r'\+44': '0', r'\(': '', r'\)': '', r'-': '', r' ': ''}, regex=True)
+    # only the string cells of the column are changed, so numbers read from the source are left as they are
+    def __remove_nonnumeric_characters(self, column: pd.Series) -> pd.Series:
+        is_string = column.map(type) == str
+        if not is_string.any():
+            return column
+        strings = column[is_string]
+        # when the values repeat, such as prices and staff numbers, each distinct string is stripped once and mapped back to the rows.
+        # the number of values repeated in a random sample of k strings estimates the number of distinct strings as k**2/(2*repeated),
+        # and pd.factorize pays off when that is under a quarter of the strings. A few very common values such as 'N/A' only count once
+        sample = strings.sample(min(len(strings), 1000), random_state=0)
+        repeated = (sample.value_counts() > 1).sum()
+        if 2 * len(sample)**2 < repeated * len(strings):
+            codes, unique_strings = pd.factorize(strings)
+            stripped = pd.Series(unique_strings, dtype=object).str.replace(r'[^0-9.]', '', regex=True).to_numpy()[codes]
+        else:
+            stripped = strings.str.replace(r'[^0-9.]', '', regex=True).to_numpy()
+        cleaned = column.to_numpy(dtype=object, copy=True)
+        cleaned[is_string.to_numpy()] = stripped
+        # only the stripped strings can be empty. under Copy-on-Write the array of a Series is read only, so they are set to None in the copy
+        cleaned[cleaned == ''] = None
+        # infer_objects gives the column the type apply did, such as float64 when the remaining cells are numbers and None
+        return pd.Series(cleaned, index=column.index, name=column.name).infer_objects()
 
     # Convert a weights to a decimal value represented in kg
     def __convert_product_weight(self, raw_weight):
@@ -48,7 +166,7 @@ class DataCleaning:
         if type(raw_weight) != str:
             try:
                 return abs(float(raw_weight))
-            except ValueError:
+            except (TypeError, ValueError):
                 return None
         # clean up characters that won't impact the value
         new_weight = raw_weight.replace(' ', '')
@@ -61,7 +179,7 @@ class DataCleaning:
             new_weight = new_weight_split[1]
             try:
                 divisor = 1/float(new_weight_split[0])
-            except ValueError:
+            except (ValueError, ZeroDivisionError):
                 return None
         # convert known units to kg and remove the unit designation
         if new_weight.endswith('kg'):
@@ -81,54 +199,126 @@ class DataCleaning:
         '''
         Modifiies dataframe column weight values to a decimal value represented in kg. If no units specified, presumes the weight is already in kg.
         For ml, a 1:1 ratio of ml to g is used as a rough estimate for the rows containing ml.
+        Weights in the usual forms such as '1.2kg', '500ml' or '12 x 100g' are converted together with one regular expression. Any others are converted one at a time with __convert_product_weight.
             Parameters:
                     products_data_frame (dataframe): Dataframe with 'weight' as the column to manipulate.
             Returns:
                     data_frame (Pandas Dataframe): The modified dataframe.
         '''
-        products_data_frame['weight'] = products_data_frame['weight'].apply(self.__convert_product_weight)
-        products_data_frame.weight = products_data_frame.weight.astype('float')
+        # there are far fewer distinct weights than rows, so each one is converted once and the results are mapped back to the rows
+        codes, raw_weights = pd.factorize(products_data_frame['weight'])
+        raw_weights = pd.Series(raw_weights, dtype=object)
+        weights = pd.Series(float('nan'), index=raw_weights.index)
+        fast_path = pd.Series(False, index=raw_weights.index)
+        # the .str methods can only be used when there are strings
+        if pd.api.types.infer_dtype(raw_weights) in ('string', 'mixed', 'mixed-integer'):
+            # as __convert_product_weight: spaces are removed and one trailing '.' is ignored
+            parts = raw_weights.str.replace(' ', '', regex=False).str.extract(self.weight_expression)
+            multiplier = parts['multiplier'].astype('float')
+            value = parts['value'].astype('float')
+            # a zero multiplier is left to __convert_product_weight which treats it as a bad value
+            fast_path = value.notna() & (multiplier != 0)
+            # g and ml replace the multipack divisor rather than combining with it, as in __convert_product_weight
+            divisor = (1 / multiplier).fillna(1).where(~parts['unit'].isin(['g', 'ml']), 1000)
+            weights = (value / divisor).abs().where(fast_path)
+        if not fast_path.all():
+            weights[~fast_path] = raw_weights[~fast_path].apply(self.__convert_product_weight).to_numpy()
+        # factorize gives missing values the code -1, which takes the NaN added to the end
+        weights = pd.Series(np.append(weights.to_numpy(dtype='float'), float('nan'))[codes], index=products_data_frame.index)
+        products_data_frame['weight'] = weights.astype('float')
         return products_data_frame
-    
-    def __assign_weight_class(self, weight: int) -> str:
-        if weight < 2:
-            return 'Light'
-        if weight < 40:
-            return 'Mid_Sized'
-        if weight < 140:
-            return 'Heavy'
-        return 'Truck_Required'
 
-    def clean_user_data(self, data_frame: pd.DataFrame) -> pd.DataFrame:
+    # the smallest integer type which holds a column of whole numbers. a column with nulls becomes a nullable integer such as Int16 rather than float64
+    def __downcast_integers(self, column: pd.Series) -> pd.Series:
+        if pd.api.types.is_float_dtype(column):
+            values = column.dropna()
+            if not (values == values.round()).all():
+                return column
+            column = column.astype('Int64')
+        return pd.to_numeric(column, downcast='integer')
+
+    def __compact_dtypes(self, data_frame: pd.DataFrame, categorical_columns: list, integer_columns=[]) -> pd.DataFrame:
+        '''
+        Gives the columns of a cleaned DataFrame compact types. The SQL types are unchanged: a categorical is loaded as its strings and a downcast integer as the same number.
+            Parameters:
+                    data_frame (Pandas dataframe): The cleaned dataframe.
+                    categorical_columns (list): The columns with few distinct values, such as country_code, which are stored once each as a categorical when they repeat.
+                    integer_columns (list) (optional): The columns of whole numbers, downcast to the smallest integer type holding them.
+            Returns:
+                    data_frame (Pandas Dataframe): The modified dataframe.
+        '''
+        # a column may have been dropped as empty. a categorical of mostly distinct values would use more memory than the strings, so those are left
+        for column in data_frame.columns.intersection(categorical_columns):
+            if 2 * data_frame[column].nunique() <= data_frame.shape[0]:
+                data_frame[column] = data_frame[column].astype('category')
+        for column in data_frame.columns.intersection(integer_columns):
+            data_frame[column] = self.__downcast_integers(data_frame[column])
+        return data_frame
+
+    @staticmethod
+    def memory_footprint(data_frame: pd.DataFrame) -> tuple:
+        '''
+        Returns the memory used by a cleaned DataFrame, and the memory it would use without compact types with its categoricals as object strings and its integers as int64.
+        The second is worked out from the categories and the row counts rather than by converting the columns back.
+            Parameters:
+                    data_frame (Pandas dataframe): The cleaned dataframe.
+            Returns:
+                    compact_bytes (int): The memory used, counting the strings as memory_usage(deep=True) does.
+                    uncompacted_bytes (int): The memory the DataFrame would use without the compact types.
+        '''
+        column_bytes = data_frame.memory_usage(index=False, deep=True)
+        compact_bytes = uncompacted_bytes = int(column_bytes.sum())
+        for column_name, column in data_frame.items():
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                codes = column.cat.codes.to_numpy()
+                category_bytes = np.array([sys.getsizeof(category) for category in column.cat.categories], dtype='int64')
+                # a pointer per row, the string of each row and None for each null
+                object_bytes = 8 * len(codes) + np.bincount(codes[codes >= 0], minlength=len(category_bytes)) @ category_bytes \
+                               + sys.getsizeof(None) * int((codes < 0).sum())
+            elif pd.api.types.is_integer_dtype(column.dtype):
+                object_bytes = 8 * len(column)
+            else:
+                continue
+            uncompacted_bytes += int(object_bytes) - int(column_bytes[column_name])
+        return compact_bytes, uncompacted_bytes
+
+    def __assign_weight_classes(self, weights: pd.Series) -> pd.Series:
+        weight_classes = pd.cut(weights, self.weight_class_bins, right=False, labels=self.weight_class_labels)
+        return weight_classes.astype(object).fillna('Truck_Required')
+
+    def clean_user_data(self, data_frame: pd.DataFrame, whole_table=True) -> pd.DataFrame:
         '''
         Cleans legacy user data and sets column types as appropriate.
                 Removes columns and rows with all null data and removes duplicates
-                Standardises phone number formatting.
                 Standardises GB country_code.
+                Standardises phone number formatting for the numbering plan of the country_code.
                 Removes invalid email_address rows.
             Parameters:
                     data_frame (dataframe): Dataframe with the legacy user data.
+                    whole_table (bool) (optional): False when data_frame is one chunk of the table. Duplicates and empty columns are then left in to be removed in the database, with the duplicate key of each row in the duplicate_key_column. Defaults to True.
             Returns:
                     data_frame (Pandas Dataframe): The modified dataframe.
         '''
         # we have the uuid as a unique key, so we can drop the index column
-        data_frame.drop(['index'], axis=1, inplace=True)
+        data_frame = self.__drop_columns(data_frame, ['index'])
         # check date errors & set as date time type
-        data_frame['date_of_birth'] = pd.to_datetime(data_frame['date_of_birth'], format='mixed', errors='coerce')
-        data_frame['join_date'] = pd.to_datetime(data_frame['join_date'], format='mixed', errors='coerce')
+        with self.__step('dates'):
+            date_parser = DateParser()
+            data_frame['date_of_birth'] = date_parser.parse(data_frame['date_of_birth'], errors='coerce')
+            data_frame['join_date'] = date_parser.parse(data_frame['join_date'], errors='coerce')
         # check NULL values and remove duplicates
-        data_frame = self.__handle_nulls_empties_and_duplicates(data_frame)
-        # format phone numbers
-        self.__reformat_phone_data(data_frame, 'phone_number')
-        # fix country_code
-        mask_country = data_frame['country'] == 'United Kingdom'
-        data_frame.loc[mask_country, 'country_code'] = 'GB'
+        with self.__step('nulls'):
+            data_frame, rows = self.__handle_nulls_empties_and_duplicates(data_frame, whole_table)
         # email_addresses - the data without a simple @ in the email address has the entire row as invalid in this table, so remove those rows
-        pd.options.mode.chained_assignment = None  # default='warn'
-        mask_email_address = data_frame['email_address'].str.contains('@')
-        data_frame = data_frame.loc[mask_email_address]
-        pd.options.mode.chained_assignment = 'warn'
-        return data_frame
+        rows &= data_frame['email_address'].str.contains('@', na=False)
+        data_frame = self.__keep_rows(data_frame, rows)
+        # fix country_code before it is used to choose the numbering plan for the phone numbers
+        mask_country = data_frame['country'] == 'United Kingdom'
+        data_frame['country_code'] = data_frame['country_code'].mask(mask_country, 'GB')
+        # format phone numbers
+        with self.__step('phones'):
+            data_frame['phone_number'] = self.phone_number_formatter.format_phone_numbers(data_frame['phone_number'], data_frame['country_code'])
+        return self.__compact_dtypes(data_frame, ['country', 'country_code'])
 
     # remove any erroneous values, NULL values or errors with formatting.
     def clean_card_data(self, data_frame: pd.DataFrame) -> pd.DataFrame:
@@ -142,18 +332,19 @@ class DataCleaning:
             Returns:
                     data_frame (Pandas Dataframe): The modified dataframe.
         '''
-        data_frame = self.__handle_nulls_empties_and_duplicates(data_frame)
-        pd.options.mode.chained_assignment = None  # default='warn'
+        with self.__step('nulls'):
+            data_frame, rows = self.__handle_nulls_empties_and_duplicates(data_frame)
         # expiry_date - the data without a / in the expiry date has the entire row as invalid in this table, so remove those rows
-        expiry_date_mask = data_frame['expiry_date'].str.contains('/')
-        data_frame = data_frame.loc[expiry_date_mask]
+        rows &= data_frame['expiry_date'].str.contains('/', na=False)
+        data_frame = self.__keep_rows(data_frame, rows)
         # clean card_number. We could convert them to numeric with pd.to_numeric or force them to typeint64, but since this will be a varchar column, leave as text
         data_frame['card_number'] = data_frame['card_number'].apply(self.__remove_unwanted_characters)
         # set date_payment_confirmed as date type
         data_frame['date_payment_confirmed'] = data_frame['date_payment_confirmed'].apply(self.__remove_unwanted_characters)
-        data_frame['date_payment_confirmed'] = pd.to_datetime(data_frame['date_payment_confirmed'], errors='coerce')
-        pd.options.mode.chained_assignment = 'warn'
-        return data_frame
+        # pandas infers the format from the first date and parses the column with it in one vectorised pass, so DateParser is not used here. Dates in other formats become NaT
+        with self.__step('dates'):
+            data_frame['date_payment_confirmed'] = pd.to_datetime(data_frame['date_payment_confirmed'], errors='coerce')
+        return self.__compact_dtypes(data_frame, ['card_provider'])
 
     def clean_store_data(self, data_frame: pd.DataFrame) -> pd.DataFrame:
         '''
@@ -169,35 +360,30 @@ class DataCleaning:
                     data_frame (Pandas Dataframe): The modified dataframe.
         '''
         # we have the store_key as a unique key, so we can drop the index column
-        data_frame.drop(['index'], axis=1, inplace=True)
         # remove lat column which is empty and replaced with the latitude column
-        data_frame.drop(['lat'], axis=1, inplace=True)
-        data_frame = self.__handle_nulls_empties_and_duplicates(data_frame)
+        data_frame = self.__drop_columns(data_frame, ['index', 'lat'])
+        with self.__step('nulls'):
+            data_frame, rows = self.__handle_nulls_empties_and_duplicates(data_frame)
         # we know that invalid store_type, continent or country_code are all on same rows which are all invalid data, so remove these first
         # we didn't filter on country_code or continent because they have more values or values that are likely to expand in the future
-        data_frame = data_frame[data_frame['store_type'].isin(["Mall Kiosk","Super Store","Local","Web Portal","Outlet"])]
+        rows &= data_frame['store_type'].isin(["Mall Kiosk","Super Store","Local","Web Portal","Outlet"])
+        # re-order so into a more logical order of identification, attributes, location. the columns are concatenated rather than selected with
+        # data_frame[columns], which would take them into a new array, and are chosen before the rows are sliced so only they are copied
+        columns = ['store_code', 'store_type', 'staff_numbers', 'opening_date', 'address','locality', 'continent', 'country_code', 'longitude', 'latitude']
+        data_frame = self.__keep_rows(pd.concat([data_frame[column] for column in columns], axis=1), rows)
         # fix some invalid data in continent field
-        pd.options.mode.chained_assignment = None  # default='warn'
-        mask_continent = data_frame['continent'] == 'eeEurope'
-        data_frame.loc[mask_continent, 'continent'] = 'Europe'
-        mask_continent = data_frame['continent'] == 'eeAmerica'
-        data_frame.loc[mask_continent, 'continent'] = 'America'
+        data_frame['continent'] = data_frame['continent'].replace({'eeEurope': 'Europe', 'eeAmerica': 'America'})
         # remove non-numerical characters from float values and set type
-        data_frame['longitude'] = data_frame['longitude'].apply(self.__remove_nonnumeric_characters)
-        data_frame['longitude'] = data_frame['longitude'].astype('float', errors='ignore')
-        data_frame['latitude'] = data_frame['latitude'].apply(self.__remove_nonnumeric_characters)
-        data_frame['latitude'] = data_frame['latitude'].astype('float', errors='ignore')
+        data_frame['longitude'] = self.__remove_nonnumeric_characters(data_frame['longitude']).astype('float', errors='ignore')
+        data_frame['latitude'] = self.__remove_nonnumeric_characters(data_frame['latitude']).astype('float', errors='ignore')
         # remove non-numerical characters from int values and set type
-        data_frame['staff_numbers'] = data_frame['staff_numbers'].apply(self.__remove_nonnumeric_characters)
-        data_frame['staff_numbers'] = data_frame['staff_numbers'].astype('int32', errors='raise')
+        data_frame['staff_numbers'] = self.__remove_nonnumeric_characters(data_frame['staff_numbers']).astype('int32', errors='raise')
         # standardise date type
-        data_frame['opening_date'] = pd.to_datetime(data_frame['opening_date'], format='mixed', errors='ignore')
-        pd.options.mode.chained_assignment = 'warn'  # back to default mode
-        # re-order so into a more logical order of identification, attributes, location
-        data_frame = data_frame[['store_code', 'store_type', 'staff_numbers', 'opening_date', 'address','locality', 'continent', 'country_code', 'longitude', 'latitude']]
-        return data_frame
+        with self.__step('dates'):
+            data_frame['opening_date'] = DateParser().parse(data_frame['opening_date'], errors='ignore')
+        return self.__compact_dtypes(data_frame, ['store_type', 'locality', 'continent', 'country_code'], ['staff_numbers'])
     
-    def clean_products_data(self, data_frame: pd.DataFrame) -> pd.DataFrame:
+    def clean_products_data(self, data_frame: pd.DataFrame, whole_table=True) -> pd.DataFrame:
         '''
         Cleans legacy products data and sets column types as appropriate.
                 Removes columns and rows with all null data and removes duplicates.
@@ -206,42 +392,55 @@ class DataCleaning:
                 Standardises removed flag to a boolean.
             Parameters:
                     data_frame (Pandas dataframe): Dataframe with the legacy products data.
+                    whole_table (bool) (optional): False when data_frame is one chunk of the table. Duplicates and empty columns are then left in to be removed in the database, with the duplicate key of each row in the duplicate_key_column,
+                                                   and date_added is parsed as format='mixed'. Defaults to True.
             Returns:
                     data_frame (Pandas Dataframe): The modified dataframe.
         '''
         # the 'Unnamed: 0' column looks like the index. we have the uuid, so we can drop it
-        data_frame.drop(['Unnamed: 0'], axis=1, inplace=True)
-        data_frame = self.__handle_nulls_empties_and_duplicates(data_frame)
-        data_frame = self.__convert_product_weights(data_frame)
+        data_frame = self.__drop_columns(data_frame, ['Unnamed: 0'])
+        with self.__step('nulls'):
+            data_frame, rows = self.__handle_nulls_empties_and_duplicates(data_frame, whole_table)
         data_frame['currency'] = data_frame['product_price'].apply(lambda x: x[:1] if type(x)==str else '£')
-        pd.options.mode.chained_assignment = None  # default='warn'
         # rows with no currency symbol are bogus based on our data review so remove them
         regex_expression = r'^[£€\$]'
-        data_frame = data_frame.loc[data_frame['currency'].str.match(regex_expression)]
-        data_frame['product_price'] = data_frame['product_price'].apply(self.__remove_nonnumeric_characters)
-        data_frame.product_price = data_frame.product_price.astype('float')
-        data_frame['date_added'] = pd.to_datetime(data_frame['date_added'], errors='coerce')
-        data_frame['still_available'] = data_frame['removed'].apply(lambda x: False if x is not None and type(x) == str and x.lower() == 'removed' else True)
-        data_frame['still_available'] = data_frame['still_available'].astype('bool')
-        data_frame.drop(['removed'], axis=1, inplace=True)
-        data_frame['weight_class'] = data_frame['weight'].apply(self.__assign_weight_class)
-        pd.options.mode.chained_assignment = 'warn'
-        return data_frame
+        rows &= data_frame['currency'].str.match(regex_expression)
+        data_frame = self.__keep_rows(data_frame, rows)
+        # each weight is converted on its own, so only the rows kept are converted
+        with self.__step('weights'):
+            data_frame = self.__convert_product_weights(data_frame)
+        data_frame['product_price'] = self.__remove_nonnumeric_characters(data_frame['product_price']).astype('float')
+        # the whole table is parsed with the format pandas infers from its first date, so dates in other formats are NaT. each chunk would infer
+        # a format of its own from its first date, so a chunk is parsed as format='mixed' instead, which also parses the dates in the other formats
+        with self.__step('dates'):
+            if whole_table:
+                data_frame['date_added'] = pd.to_datetime(data_frame['date_added'], errors='coerce')
+            else:
+                data_frame['date_added'] = DateParser().parse(data_frame['date_added'], errors='coerce')
+        data_frame['still_available'] = data_frame['removed'].apply(lambda x: False if x is not None and type(x) == str and x.lower() == 'removed' else True).astype('bool')
+        data_frame = self.__drop_columns(data_frame, ['removed'])
+        with self.__step('weights'):
+            data_frame['weight_class'] = self.__assign_weight_classes(data_frame['weight'])
+        return self.__compact_dtypes(data_frame, ['category', 'currency', 'weight_class'])
 
-    def clean_orders_data(self, data_frame: pd.DataFrame) -> pd.DataFrame:
+    def clean_orders_data(self, data_frame: pd.DataFrame, whole_table=True) -> pd.DataFrame:
         '''
         Cleans legacy orders data and sets column types as appropriate.
                 Removes columns and rows with all null data including first_name, last_name & '1' and removes duplicates.
             Parameters:
                     data_frame (Pandas dataframe): Dataframe with the legacy products data.
+                    whole_table (bool) (optional): False when data_frame is one chunk of the table. Duplicates and empty columns are then left in to be removed in the database, with the duplicate key of each row in the duplicate_key_column. Defaults to True.
             Returns:
                     data_frame (Pandas Dataframe): The modified dataframe.
         '''
         # remove columns as per specification: first_name, last_name and 1
-        data_frame.drop(['first_name', 'last_name', '1'], axis=1, inplace=True)
         # we can drop index since we have level_0 as a unique key
-        data_frame.drop(['index'], axis=1, inplace=True)
-        return self.__handle_nulls_empties_and_duplicates(data_frame)
+        data_frame = self.__drop_columns(data_frame, ['first_name', 'last_name', '1', 'index'])
+        with self.__step('nulls'):
+            data_frame, rows = self.__handle_nulls_empties_and_duplicates(data_frame, whole_table)
+        data_frame = self.__keep_rows(data_frame, rows)
+        # the keys of the dimension tables repeat across the orders, so they are stored once each as categoricals
+        return self.__compact_dtypes(data_frame, ['user_uuid', 'card_number', 'store_code', 'product_code'], ['product_quantity'])
 
     def clean_time_data(self, data_frame: pd.DataFrame) -> pd.DataFrame:
         '''
@@ -254,9 +453,59 @@ class DataCleaning:
                     data_frame (Pandas dataframe): The modified dataframe.
         '''
         # consolodate time value fields into one datetime column
-        data_frame['date_timestamp'] = data_frame['year'] + '-' + data_frame['month'] + '-' + data_frame['day'] + ' ' + data_frame['timestamp']
-        data_frame['date_timestamp'] = pd.to_datetime(data_frame['date_timestamp'], errors='coerce')
-        data_frame.drop(['year', 'month', 'day', 'timestamp'], axis=1, inplace=True)
+        with self.__step('dates'):
+            date_timestamps = self.__assemble_date_timestamps(data_frame)
+        data_frame = self.__drop_columns(data_frame, ['year', 'month', 'day', 'timestamp'])
+        data_frame['date_timestamp'] = date_timestamps
         # bad dates will be null now. there's no useful information in those rows, so drop them
-        data_frame.dropna(inplace=True)
-        return data_frame
+        with self.__step('nulls'):
+            rows = np.ones(data_frame.shape[0], dtype=bool)
+            for _, column in data_frame.items():
+                rows &= column.notna().to_numpy()
+            data_frame = self.__keep_rows(data_frame, rows)
+        return self.__compact_dtypes(data_frame, ['time_period'])
+
+    # joins the year, month, day and timestamp strings and parses them as pd.to_datetime does when it infers the format from the first row
+    def __join_date_timestamps(self, data_frame: pd.DataFrame, date_format=None) -> pd.Series:
+        date_timestamps = data_frame['year'] + '-' + data_frame['month'] + '-' + data_frame['day'] + ' ' + data_frame['timestamp']
+        return pd.to_datetime(date_timestamps, format=date_format, errors='coerce')
+
+    # converts a column of strings such as years to numbers, converting each distinct string once with convert_function.
+    # returns the number for each row, NaN where the string does not match regex_expression, and whether each row has a value
+    def __factorize_numbers(self, column: pd.Series, regex_expression: str, convert_function=pd.to_numeric):
+        codes, unique_values = pd.factorize(column)
+        unique_values = pd.Series(unique_values, dtype=object)
+        is_number = (unique_values.map(type) == str) & unique_values.str.fullmatch(regex_expression).fillna(False).astype(bool)
+        numbers = pd.Series(float('nan'), index=unique_values.index)
+        if is_number.any():
+            numbers[is_number] = convert_function(unique_values[is_number]).to_numpy(dtype='float')
+        # factorize gives missing values the code -1, which takes the NaN added to the end
+        return np.append(numbers.to_numpy(), float('nan'))[codes], codes >= 0
+
+    def __assemble_date_timestamps(self, data_frame: pd.DataFrame) -> pd.Series:
+        '''
+        Builds the datetime of each row from the year, month, day and timestamp columns, with NaT for the rows which are not a valid date and time.
+        Rows such as 2012, 9, 19, 22:00:06 are built from the numbers with pd.to_datetime and pd.to_timedelta without joining strings. Any other rows are joined and parsed as before.
+            Parameters:
+                    data_frame (Pandas dataframe): Dataframe with the year, month, day and timestamp string columns.
+            Returns:
+                    date_timestamps (Pandas series): The datetimes.
+        '''
+        years, has_year = self.__factorize_numbers(data_frame['year'], '[0-9]{4}')
+        months, has_month = self.__factorize_numbers(data_frame['month'], '[0-9]{1,2}')
+        days, has_day = self.__factorize_numbers(data_frame['day'], '[0-9]{1,2}')
+        seconds, has_timestamp = self.__factorize_numbers(data_frame['timestamp'], self.time_expression,
+                                                          lambda timestamps: pd.to_timedelta(timestamps).dt.total_seconds())
+        # a row with a value missing or out of range, such as 2012-02-30, is NaT here and left to the fallback below
+        date_parts = pd.DataFrame({'year': years, 'month': months, 'day': days}, index=data_frame.index)
+        date_timestamps = pd.to_datetime(date_parts, errors='coerce') + pd.to_timedelta(pd.Series(seconds, index=data_frame.index), unit='s')
+        fast_path = date_timestamps.notna().to_numpy()
+        # pd.to_datetime infers the format from the first row with all four values. When that row is a valid date built here, the format is
+        # year-month-day hour:minute:second and the other rows are parsed with it. Otherwise it parses every row on its own as before
+        complete = has_year & has_month & has_day & has_timestamp
+        if not complete.any() or not fast_path[complete.argmax()]:
+            return self.__join_date_timestamps(data_frame)
+        other_rows = complete & ~fast_path
+        if other_rows.any():
+            date_timestamps[other_rows] = self.__join_date_timestamps(data_frame[other_rows], '%Y-%m-%d %H:%M:%S').to_numpy()
+        return date_timestamps
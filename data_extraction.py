@@ -1,11 +1,69 @@
 import boto3
+import io
+import logging
+import os
+import numpy as np
 import pandas as pd
+import re
 import requests
+import sqlalchemy
 import tabula
+import tempfile
+import threading
 import yaml
+from concurrent.futures import ThreadPoolExecutor
+from extract_cache import ExtractCache
+from s3_ranged_reader import S3RangedReader
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 class DataExtractor:
+    # each parallel PDF chunk has at least this many pages, since a chunk costs a tabula call of its own
+    pdf_min_pages_per_worker = 10
+    # the page objects and the page tree counts of a PDF, used to split the pages between workers
+    pdf_page_pattern = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+    pdf_page_count_pattern = re.compile(rb'/Count\s+([0-9]+)')
+
+    def __init__(self, extract_cache: ExtractCache = None):
+        # the HTTP session is created on first use and shared by all threads using this extractor
+        self.__http_session = None
+        self.__http_session_lock = threading.Lock()
+        # when set, the PDF, S3 and JSON extracts are only downloaded again if they have changed
+        self.extract_cache = extract_cache
+        # when set to a RunMetrics, the bytes of the files and API responses read are recorded against the stage reading them
+        self.metrics = None
+        # (url, pages) -> the PDF tables already parsed by this process, with a lock per key so each PDF is parsed once even when requested by several threads
+        self.__parsed_pdfs = {}
+        self.__parsed_pdf_locks = {}
+        self.__parsed_pdfs_lock = threading.Lock()
+
+    # returns a pooled HTTP session which retries with backoff on throttling (429) and server errors (5xx)
+    def __get_http_session(self) -> requests.Session:
+        with self.__http_session_lock:
+            if self.__http_session is None:
+                retry = Retry(total=5, backoff_factor=0.5,
+                              status_forcelist=[429, 500, 502, 503, 504],
+                              allowed_methods=['GET', 'HEAD'])
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.__http_session = session
+            return self.__http_session
+
+    def __count_bytes(self, count: int, stage: str = None):
+        if self.metrics is not None:
+            self.metrics.add_bytes(bytes_in=count, stage=stage)
+
+    # returns the content at a URL from the extract cache, or the URL itself for pandas/tabula to read when there is no cache
+    def __read_url(self, url: str):
+        if self.extract_cache is None or not url.startswith(('http://', 'https://')):
+            return url
+        content = self.extract_cache.fetch_http(self.__get_http_session(), url)
+        self.__count_bytes(len(content))
+        return io.BytesIO(content)
+
     # read the API credentials/URLs
     def read_api_creds(self):
         '''
@@ -20,32 +78,166 @@ class DataExtractor:
         return config_data
 
     # extract the database table to a pandas DataFrame
-    def read_rds_table(self, db_connector: str, table_name: str) -> pd.DataFrame:
+    def read_rds_table(self, db_connector: str, table_name: str, use_copy=False) -> pd.DataFrame:
         '''
         Reads a database table into a Pandas dataframe.
             Parameters:
                     db_connector: Instance of a DataConnector class to use for database access.
                     table_name: the table in the database to retieve data from.
+                    use_copy (bool) (optional): Read the table with PostgreSQL COPY, falling back to pd.read_sql_table if that fails. This is faster for wide text tables such as legacy_users but not for narrow ones such as orders_table. Defaults to False.
             Returns:
                     table_data (Pandas dataframe): The values for establishing source(RDS) and target(local) database connections.
         '''
-        db_creds = db_connector.read_db_creds()
-        db_engine = db_connector.init_db_engine(db_creds)
-        data_frame = pd.read_sql_table(table_name, db_engine)
+        if use_copy:
+            try:
+                with db_connector.connect('RDS_') as connection:
+                    return self.__read_table_with_copy(connection, table_name)
+            except Exception as error:
+                logging.warn(f"{table_name}: COPY extraction failed ({error}), reading with read_sql_table instead")
+        with db_connector.connect('RDS_') as connection:
+            data_frame = pd.read_sql_table(table_name, connection)
+        return data_frame
+
+    # streams the table out of PostgreSQL as CSV with COPY, which is much faster than fetching the rows through SQLAlchemy
+    def __read_table_with_copy(self, connection, table_name: str) -> pd.DataFrame:
+        # set the CSV parsing so the column types match pd.read_sql_table: text stays as strings, dates are parsed and numbers are inferred
+        text_columns = []
+        date_columns = []
+        boolean_columns = []
+        for column in sqlalchemy.inspect(connection).get_columns(table_name):
+            column_type = column['type']
+            if isinstance(column_type, (sqlalchemy.types.Date, sqlalchemy.types.DateTime)):
+                date_columns.append(column['name'])
+            elif isinstance(column_type, sqlalchemy.types.Boolean):
+                boolean_columns.append(column['name'])
+            elif not isinstance(column_type, (sqlalchemy.types.Integer, sqlalchemy.types.Numeric, sqlalchemy.types.Float)):
+                text_columns.append(column['name'])
+        # NULL is written as \N so that it can be told apart from an empty string
+        copy_sql = f'COPY (SELECT * FROM "{table_name}") TO STDOUT WITH (FORMAT CSV, HEADER, NULL \'\\N\')'
+        cursor = connection.connection.cursor()
+        # COPY writes into one end of a pipe in a thread while pandas parses from the other end, so the CSV is never held in memory as a whole
+        read_fd, write_fd = os.pipe()
+        copy_errors = []
+        def copy_out():
+            try:
+                with open(write_fd, 'wb') as writer:
+                    cursor.copy_expert(copy_sql, writer)
+            except Exception as error:
+                copy_errors.append(error)
+        copy_thread = threading.Thread(target=copy_out)
+        copy_thread.start()
+        try:
+            with open(read_fd, 'rb') as reader:
+                data_frame = pd.read_csv(reader, dtype={column: object for column in text_columns + boolean_columns},
+                                         keep_default_na=False, na_values=['\\N'], parse_dates=date_columns)
+        finally:
+            copy_thread.join()
+        if copy_errors:
+            raise copy_errors[0]
+        # read_sql_table has None rather than NaN for NULL strings
+        for column in text_columns:
+            data_frame[column] = data_frame[column].astype(object).where(data_frame[column].notna(), None)
+        for column in boolean_columns:
+            data_frame[column] = data_frame[column].map({'t': True, 'f': False})
+            if data_frame[column].notna().all():
+                data_frame[column] = data_frame[column].astype(bool)
         return data_frame
 
+    # extract the database table in chunks so that only one chunk is in memory at a time
+    def read_rds_table_chunks(self, db_connector, table_name: str, chunk_size=50000):
+        '''
+        Reads a database table in fixed size chunks using a server side cursor.
+            Parameters:
+                    db_connector: Instance of a DataConnector class to use for database access.
+                    table_name: the table in the database to retieve data from.
+                    chunk_size (int) (optional): The number of rows in each chunk. Defaults to 50000.
+            Yields:
+                    table_data (Pandas dataframe): The next chunk of rows from the table.
+        '''
+        with db_connector.connect('RDS_') as connection:
+            connection = connection.execution_options(stream_results=True)
+            for data_frame in pd.read_sql_table(table_name, connection, chunksize=chunk_size):
+                yield data_frame
+
     # returns a Pandas DataFrame from a link to a PDF.
     # Note this uses Tabula which requires Java/JRE to be installed
-    def retrieve_pdf_data(self, url: str, pages='all') -> pd.DataFrame:
+    def retrieve_pdf_data(self, url: str, pages='all', max_workers=None) -> pd.DataFrame:
         '''
         Loads tables in a PDF into a dataframe.
+        Each PDF and pages is parsed once per process. With an extract cache the result is also saved, keyed by the hash of the PDF, so an unchanged PDF is not parsed again on later runs.
             Parameters:
                     url - URL to a PDF to read with table data.
+                    pages (optional) - The pages to read, as for tabula.read_pdf. Defaults to 'all'.
+                    max_workers (int) (optional): The number of page ranges of the PDF parsed concurrently when reading all pages. 1 parses the PDF in one call. Defaults to the number of CPUs.
             Returns:
                     pdf_data (Pandas dataframe): A table with the table data. 
         '''
-        pdf_data = tabula.read_pdf(url, pages=pages)
-        return pd.concat(pdf_data)
+        key = (url, str(pages))
+        with self.__parsed_pdfs_lock:
+            key_lock = self.__parsed_pdf_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.__parsed_pdfs:
+                self.__parsed_pdfs[key] = self.__parse_pdf(url, pages, max_workers or os.cpu_count() or 1)
+        # each caller gets its own DataFrame. under Copy-on-Write a shallow copy shares the parsed tables until one of them is changed,
+        # without it the caller could change them in place, so it gets a deep copy
+        return self.__parsed_pdfs[key].copy(deep=not pd.get_option('mode.copy_on_write'))
+
+    def __parse_pdf(self, url: str, pages, max_workers: int) -> pd.DataFrame:
+        content = self.__read_bytes(url)
+        self.__count_bytes(len(content))
+        if self.extract_cache is None:
+            return self.__read_pdf_tables(content, pages, max_workers)
+        source = self.extract_cache.parsed_source('tabula', content, {'pages': pages})
+        pdf_data = self.extract_cache.read_data_frame(source)
+        if pdf_data is None:
+            pdf_data = self.__read_pdf_tables(content, pages, max_workers)
+            self.extract_cache.write_data_frame(source, pdf_data)
+        return pdf_data
+
+    # returns the content of a URL through the extract cache if there is one, or of a local file
+    def __read_bytes(self, url: str) -> bytes:
+        if not url.startswith(('http://', 'https://')):
+            with open(url, 'rb') as file:
+                return file.read()
+        if self.extract_cache is not None:
+            return self.extract_cache.fetch_http(self.__get_http_session(), url)
+        response = self.__get_http_session().get(url)
+        response.raise_for_status()
+        return response.content
+
+    # the PDF is saved to a local file once and its pages are split into ranges which are parsed concurrently
+    def __read_pdf_tables(self, content: bytes, pages, max_workers: int) -> pd.DataFrame:
+        with tempfile.TemporaryDirectory() as directory:
+            pdf_path = os.path.join(directory, 'extract.pdf')
+            with open(pdf_path, 'wb') as file:
+                file.write(content)
+            page_ranges = self.__pdf_page_ranges(content, pages, max_workers)
+            if not page_ranges:
+                return pd.concat(tabula.read_pdf(pdf_path, pages=pages))
+            # tabula starts its JVM on the first call, which is not thread safe, so page 1 is read before the other ranges start.
+            # the JVM runs the calls from several threads at once, as does tabula's fall back of one java process per call
+            tables = tabula.read_pdf(pdf_path, pages=1)
+            with ThreadPoolExecutor(max_workers=len(page_ranges)) as executor:
+                # executor.map returns the tables in page order regardless of which range finishes first
+                for range_tables in executor.map(lambda page_range: tabula.read_pdf(pdf_path, pages=page_range), page_ranges):
+                    tables.extend(range_tables)
+            return pd.concat(tables)
+
+    # splits pages 2 onwards into up to max_workers ranges such as '2-71', or returns no ranges if the PDF should be read in one call
+    def __pdf_page_ranges(self, content: bytes, pages, max_workers: int) -> list[str]:
+        if pages != 'all' or max_workers <= 1:
+            return []
+        number_of_pages = len(self.pdf_page_pattern.findall(content))
+        page_counts = [int(count) for count in self.pdf_page_count_pattern.findall(content)]
+        # page objects inside compressed object streams can not be counted, in which case the page tree count will not agree
+        if not page_counts or max(page_counts) != number_of_pages:
+            logging.info(f"PDF page count not found, reading all pages in one call")
+            return []
+        number_of_workers = min(max_workers, (number_of_pages-1) // self.pdf_min_pages_per_worker)
+        if number_of_workers <= 1:
+            return []
+        return [f'{page_range[0]}-{page_range[-1]}'
+                for page_range in np.array_split(np.arange(2, number_of_pages+1), number_of_workers)]
 
     # returns the number of stores to extract
     def list_number_of_stores(self, api_header_dict: dict[str, str], number_stores_endpoint_url: str):
@@ -57,57 +249,120 @@ class DataExtractor:
             Returns:
                     config_data (dictionary): The values for establishing source(RDS) and target(local) database connections.
         '''
-        response = requests.get(number_stores_endpoint_url, headers=api_header_dict)
+        response = self.__get_http_session().get(number_stores_endpoint_url, headers=api_header_dict)
         return response.json()["number_stores"]
     
     # extracts all stores from the API saving them in a pandas DataFrame
-    def retrieve_stores_data(self, api_header_dict: dict[str, str], store_data_endpoint_template: str, max_store_number) -> pd.DataFrame:
+    def retrieve_stores_data(self, api_header_dict: dict[str, str], store_data_endpoint_template: str, max_store_number, max_workers=16) -> pd.DataFrame:
         '''
         Returns the details for stores up to max_store_number.
             Parameters:
                     api_header_dict (dictionary): API headers.
                     store_data_endpoint_template (str): The endpoint to read the store details from.
                     max_store_number (int): The maximum store number to read up to. This is 0 based.
+                    max_workers (int) (optional): The number of concurrent requests. 1 reads the stores serially. Defaults to 16.
             Returns:
                     store_data (Pandas dataframe): The all the store details from the API.
         '''
-        store_data_list = self.retrieve_stores_data_range(api_header_dict, store_data_endpoint_template, max_store_number, 0)
-        return pd.concat(store_data_list)
+        store_records = self.retrieve_stores_data_range(api_header_dict, store_data_endpoint_template, max_store_number, 0, max_workers)
+        return self.stores_records_to_data_frame(store_records)
+
+    # builds the stores DataFrame in one allocation rather than concatenating a one row DataFrame per store
+    def stores_records_to_data_frame(self, store_records: list[dict]) -> pd.DataFrame:
+        '''
+        Converts store detail records from the API into a DataFrame.
+            Parameters:
+                    store_records (list): The store details as returned by retrieve_stores_data_range.
+            Returns:
+                    store_data (Pandas dataframe): The store details, one row per store. Every row has the index label "index" as when each store was read into its own DataFrame.
+        '''
+        store_data = pd.DataFrame.from_records(store_records)
+        store_data.index = ["index"] * len(store_records)
+        return store_data
     
-    # extracts a range of stores from the API saving them in a list
+    # extracts a range of stores from the API saving their JSON records in a list
     # this can be used to extract a subset of stores for use in a multi-threaded download or to allow for the process to be interrupted or monitored
-    def retrieve_stores_data_range(self, api_header_dict: dict[str, str], store_data_endpoint_template: str, max_store_number, min_store_number = 0):
+    def retrieve_stores_data_range(self, api_header_dict: dict[str, str], store_data_endpoint_template: str, max_store_number, min_store_number = 0, max_workers=16):
         '''
         Returns the details for stores from min_store_number up to max_store_number.
+        The requests share one pooled HTTP session and up to max_workers of them run concurrently. The list is always in store number order.
             Parameters:
                     api_header_dict (dictionary): API headers.
                     store_data_endpoint_template (str): The endpoint to read the store details from.
                     max_store_number (int): The maximum store number to read up to. This is 0 based.
                     min_store_number (int) (optional): Start reading from this store_number. Note this is 0 based.
+                    max_workers (int) (optional): The number of concurrent requests. 1 reads the stores serially. Defaults to 16.
             Returns:
-                    store_data_list (list): The all the store details from the API.
+                    store_records (list): The details of each store as a dictionary of the JSON returned by the API.
         '''
-        store_data_list = []
-        for store_number in range(min_store_number, max_store_number):
+        session = self.__get_http_session()
+        # the requests run on threads of their own, so the bytes are recorded against the stage of this thread
+        stage = self.metrics.current_stage() if self.metrics is not None else None
+        def retrieve_store(store_number: int) -> dict:
             store_data_endpoint_url = store_data_endpoint_template.format(store_number=store_number)
-            response = requests.get(store_data_endpoint_url, headers=api_header_dict)
-            store_data_list.append(pd.DataFrame(response.json(), index=["index"]))
-        return store_data_list
+            response = session.get(store_data_endpoint_url, headers=api_header_dict)
+            self.__count_bytes(len(response.content), stage)
+            return response.json()
+
+        store_numbers = range(min_store_number, max_store_number)
+        if max_workers <= 1:
+            return [retrieve_store(store_number) for store_number in store_numbers]
+        # executor.map returns the results in the order of store_numbers regardless of which request finishes first
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(retrieve_store, store_numbers))
     
     # download from s3 and extract the information returning a pandas DataFrame
-    def extract_from_s3(self, s3uri: str) -> pd.DataFrame:
+    def extract_from_s3(self, s3uri: str, s3client=None) -> pd.DataFrame:
         '''
         Loads a table from a CSV in AWS S3.
             Parameters:
                     s3uri - URI to the CSV in S3.
+                    s3client (optional): The S3 client to use. Defaults to a new boto3 client.
             Returns:
                     pdf_data (Pandas dataframe): A table with the data. 
         '''
         s3uri_split = s3uri.split('/')
-        s3client = boto3.client('s3')
+        if s3client is None:
+            s3client = boto3.client('s3')
+        if self.extract_cache is not None:
+            content = self.extract_cache.fetch_s3(s3client, s3uri_split[2], s3uri_split[3])
+            self.__count_bytes(len(content))
+            return pd.read_csv(io.BytesIO(content))
         s3response = s3client.get_object(Bucket=s3uri_split[2], Key=s3uri_split[3])
+        self.__count_bytes(s3response.get('ContentLength', 0))
         return pd.read_csv(s3response.get('Body'))
 
+    # stream a CSV from s3 a chunk at a time so that only one chunk is parsed and in memory at once
+    def extract_from_s3_chunks(self, s3uri: str, chunk_size=50000, dtypes: dict = None, s3client=None,
+                               part_size=8*1024*1024, max_workers=4):
+        '''
+        Reads a CSV in AWS S3 in fixed size chunks.
+        Without an extract cache the object is downloaded with concurrent ranged GETs of part_size bytes as the chunks are read.
+            Parameters:
+                    s3uri (str): URI to the CSV in S3.
+                    chunk_size (int) (optional): The number of rows in each chunk. Defaults to 50000.
+                    dtypes (dictionary) (optional): The type of each column, so every chunk has the same types rather than ones inferred from its own rows.
+                    s3client (optional): The S3 client to use. Defaults to a new boto3 client.
+                    part_size (int) (optional): The bytes in each ranged GET. Defaults to 8MB.
+                    max_workers (int) (optional): The number of parts downloaded concurrently. Defaults to 4.
+            Yields:
+                    data (Pandas dataframe): The next chunk of rows from the CSV.
+        '''
+        s3uri_split = s3uri.split('/')
+        if s3client is None:
+            s3client = boto3.client('s3')
+        if self.extract_cache is not None:
+            content = self.extract_cache.fetch_s3(s3client, s3uri_split[2], s3uri_split[3])
+            self.__count_bytes(len(content))
+            csv_file = io.BytesIO(content)
+        else:
+            s3reader = S3RangedReader(s3client, s3uri_split[2], s3uri_split[3], part_size, max_workers)
+            self.__count_bytes(s3reader.size)
+            csv_file = io.BufferedReader(s3reader)
+        with csv_file, pd.read_csv(csv_file, chunksize=chunk_size, dtype=dtypes) as reader:
+            for data_frame in reader:
+                yield data_frame
+
     # returns the number of stores to extract
     def extract_from_json(self, url: str) -> pd.DataFrame:
         '''
@@ -117,4 +372,4 @@ class DataExtractor:
             Returns:
                     data (Pandas dataframe): A table with the JSON data. 
         '''
-        return pd.read_json(url)    
+        return pd.read_json(self.__read_url(url))
@@ -1,36 +1,122 @@
+import contextlib
+import io
+import logging
+import threading
+import time
 import yaml
+import pandas as pd
+import psycopg2
 import sqlalchemy
 
 
 class DatabaseConnector:
+    # the connections kept in each pool. ProcessManager sets it from the number of stages which run at once, before the engines are created
+    pool_size = 6
+    pool_max_overflow = 2
+    # side tables in the target database for the incremental loads: a hash of each row loaded by primary key, and the last load of each table
+    row_hashes_table = 'etl_row_hashes'
+    watermarks_table = 'etl_watermarks'
+    # the integer types from the smallest, with the range each holds, for fitting the whole number columns of a streamed table
+    integer_types = [('SMALLINT', -2**15, 2**15-1), ('INTEGER', -2**31, 2**31-1), ('BIGINT', -2**63, 2**63-1)]
+
+    def __init__(self):
+        # the credentials and one engine per prefix are created on first use and shared by all threads
+        self.__db_creds = None
+        self.__engines = {}
+        self.__pool_statistics = {}
+        self.__lock = threading.RLock()
+        # when set to a RunMetrics, the bytes of CSV copied into the target database are recorded against the stage loading them
+        self.metrics = None
+
     # read the credentials yaml file and return a dictionary of the credentials.
     def read_db_creds(self):
         '''
-        Loads configuration for the databases from a file (db_creds.yaml).
+        Loads configuration for the databases from a file (db_creds.yaml). The file is only read the first time.
             Parameters:
                     none.
             Returns:
                     config (dictionary): The values for establishing source(RDS) and target(local) database connections.
         '''
-        with open('db_creds.yaml', 'r') as file:
-            config = yaml.safe_load(file)
-        return config
+        with self.__lock:
+            if self.__db_creds is None:
+                with open('db_creds.yaml', 'r') as file:
+                    self.__db_creds = yaml.safe_load(file)
+            return self.__db_creds
 
     # read the credentials from the return of db_creds and initialise and return an sqlalchemy database engine
-    def init_db_engine(self, config: dict[str, str], prefix='RDS_'):
+    def init_db_engine(self, config: dict[str, str], prefix='RDS_', **engine_options):
         '''
         Loads configuration for the databases from a file (db_creds.yaml).
             Parameters:
                     config (dictionary): database configuration.
                     prefix (str) (optional): Determines the databse configuration to use. Options are 'RDS_' or 'LOCAL_'. Defaults to 'RDS_'.
+                    engine_options (optional): Further keyword arguments for sqlalchemy.create_engine such as pool_size.
             Returns:
                     engine (sqlalchemy database engine): The values for establishing source(RDS) and target(local) database connections.
         '''
         db_api = 'psycopg2'
         engine_url = f"{config[prefix+'DATABASE_TYPE']}+{db_api}://{config[prefix+'USER']}:{config[prefix+'PASSWORD']}@{config[prefix+'HOST']}:{config[prefix+'PORT']}/{config[prefix+'DATABASE']}"
-        engine = sqlalchemy.create_engine(engine_url)
+        engine = sqlalchemy.create_engine(engine_url, **engine_options)
         return engine
 
+    # returns the shared engine for a database so all the threads use one connection pool per database
+    def get_engine(self, prefix='RDS_'):
+        '''
+        Returns the shared engine for a database configuration, creating it on first use.
+            Parameters:
+                    prefix (str) (optional): Determines the databse configuration to use. Options are 'RDS_' or 'LOCAL_'. Defaults to 'RDS_'.
+            Returns:
+                    engine (sqlalchemy database engine): The engine with a connection pool of pool_size connections.
+        '''
+        with self.__lock:
+            if prefix not in self.__engines:
+                self.__engines[prefix] = self.init_db_engine(self.read_db_creds(), prefix,
+                                                             pool_size=self.pool_size,
+                                                             max_overflow=self.pool_max_overflow,
+                                                             pool_pre_ping=True)
+                self.__pool_statistics[prefix] = {'checkouts': 0, 'checkout_wait_seconds': 0.0,
+                                                  'max_checkout_wait_seconds': 0.0}
+            return self.__engines[prefix]
+
+    # check out a connection from the shared pool, recording how long it took to get one
+    @contextlib.contextmanager
+    def connect(self, prefix='LOCAL_', autocommit=False):
+        '''
+        Checks out a connection from the shared engine's pool and returns it to the pool afterwards.
+            Parameters:
+                    prefix (str) (optional): Determines the databse configuration to use. Options are 'RDS_' or 'LOCAL_'. Defaults to 'LOCAL_'.
+                    autocommit (bool) (optional): Run each statement in its own transaction. Defaults to False.
+            Returns:
+                    connection (sqlalchemy connection): Used within a with statement.
+        '''
+        engine = self.get_engine(prefix)
+        if autocommit:
+            engine = engine.execution_options(isolation_level='AUTOCOMMIT')
+        start_time = time.perf_counter()
+        connection = engine.connect()
+        wait_seconds = time.perf_counter() - start_time
+        with self.__lock:
+            statistics = self.__pool_statistics[prefix]
+            statistics['checkouts'] += 1
+            statistics['checkout_wait_seconds'] += wait_seconds
+            statistics['max_checkout_wait_seconds'] = max(statistics['max_checkout_wait_seconds'], wait_seconds)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def pool_statistics(self) -> dict:
+        '''
+        Returns the connection pool usage for tuning pool_size.
+            Parameters:
+                    none.
+            Returns:
+                    statistics (dictionary): For each prefix, the number of checkouts, the total and longest time waited for a connection and the pool status.
+        '''
+        with self.__lock:
+            return {prefix: statistics | {'pool_status': self.__engines[prefix].pool.status()}
+                    for prefix, statistics in self.__pool_statistics.items()}
+
     # list the tables in the database for exploratory work
     def list_db_tables(self, engine):
         '''
@@ -43,38 +129,337 @@ class DatabaseConnector:
         inspector = sqlalchemy.inspect(engine)
         return inspector.get_table_names()
 
-    # upload data to database table. NOTE: table & data will be replaced
-    def upload_to_db(self, source_data_frame, target_table_name: str, dtypes = None, primary_key = None):
+    # upload data to database table. NOTE: by default the table & data will be replaced
+    def upload_to_db(self, source_data_frame, target_table_name: str, dtypes = None, primary_key = None, if_exists='replace', bulk_load=True, schema='public'):
         '''
         Save the dataframe in a table (target_table_name) on the local/target database.
+        The table, data and primary key are written in one transaction.
             Parameters:
                     source_data_frame (Pandas dataframe): Source data to write.
                     target_table_name (str): Target table to write the data into. Note existing data in the specified table will be removed/overwritten.
                     dtypes (dictionary of sqlalchemy.types) (optional): A dictionary of column names and their corresponding SQL types.
                     primary_key (str) (optional): The name of the primary key column.
+                    if_exists (str) (optional): 'replace' to replace the table or 'append' to add the rows to it, such as for each chunk of a streamed table. Defaults to 'replace'.
+                    bulk_load (bool) (optional): Load the rows with PostgreSQL COPY FROM STDIN rather than INSERT statements. Defaults to True.
+                    schema (str) (optional): The schema to write the table in, such as the staging schema. Defaults to 'public'.
             Returns:
                     none.
         '''
-        db_creds = self.read_db_creds()
-        target_engine = self.init_db_engine(db_creds, 'LOCAL_')
-        source_data_frame.to_sql(target_table_name, target_engine, if_exists='replace', index=False, dtype = dtypes)
-        with target_engine.execution_options(isolation_level='AUTOCOMMIT').connect() as con:
-            source_data_frame.to_sql(target_table_name, target_engine, if_exists='replace', index=False, dtype = dtypes)
-            if primary_key is not None:
-                con.execute(sqlalchemy.text(f'ALTER TABLE public.{target_table_name} ADD PRIMARY KEY ({primary_key});'))
+        with self.connect() as con, con.begin():
+            self.__write_table(con, source_data_frame, target_table_name, dtypes, primary_key, if_exists, bulk_load, schema)
+
+    def __write_table(self, con, source_data_frame, target_table_name: str, dtypes, primary_key, if_exists, bulk_load=True, schema='public'):
+        if bulk_load:
+            # create the empty table with the column types, then stream all the rows in with COPY
+            source_data_frame.head(0).to_sql(target_table_name, con, schema=schema, if_exists=if_exists, index=False, dtype = dtypes)
+            self.__copy_data_frame_to_table(con, source_data_frame, f'{schema}.{target_table_name}')
+        else:
+            source_data_frame.to_sql(target_table_name, con, schema=schema, if_exists=if_exists, index=False, dtype = dtypes)
+        # the primary key index is built once after the data is loaded rather than maintained row by row
+        if primary_key is not None:
+            con.execute(sqlalchemy.text(f'ALTER TABLE {schema}.{target_table_name} ADD PRIMARY KEY ({primary_key});'))
+
+    # writes the dataframe as CSV into COPY FROM STDIN a block of rows at a time so the whole CSV is never held in memory
+    def __copy_data_frame_to_table(self, con, data_frame, qualified_table_name: str, rows_per_block=100000):
+        columns = ', '.join(f'"{column}"' for column in data_frame.columns)
+        # nulls are written as \N so that empty strings stay empty strings as they do with INSERT
+        copy_sql = f"COPY {qualified_table_name} ({columns}) FROM STDIN WITH (FORMAT CSV, NULL '\\N')"
+        cursor = con.connection.cursor()
+        for start_row in range(0, data_frame.shape[0], rows_per_block):
+            csv_buffer = io.StringIO()
+            data_frame.iloc[start_row:start_row+rows_per_block].to_csv(csv_buffer, index=False, header=False, na_rep='\\N')
+            if self.metrics is not None:
+                self.metrics.add_bytes(bytes_out=csv_buffer.tell())
+            csv_buffer.seek(0)
+            cursor.copy_expert(copy_sql, csv_buffer)
     
-    def add_foreign_key(self, target_table_name: str, target_column: str, source_table: str, source_column: str):
-        db_creds = self.read_db_creds()
-        target_engine = self.init_db_engine(db_creds, 'LOCAL_')
-        with target_engine.execution_options(isolation_level='AUTOCOMMIT').connect() as con:
-            con.execute(sqlalchemy.text(f'ALTER TABLE public.{target_table_name} ADD CONSTRAINT fk_{source_table}_{source_column} FOREIGN KEY ({target_column}) REFERENCES {source_table} ({source_column});'))
-
-    def drop_foreign_key(self, target_table_name: str, source_table: str, source_column: str):
-        db_creds = self.read_db_creds()
-        target_engine = self.init_db_engine(db_creds, 'LOCAL_')
-        try:
-            with target_engine.execution_options(isolation_level='AUTOCOMMIT').connect() as con:
-                con.execute(sqlalchemy.text(f'ALTER TABLE {target_table_name} DROP CONSTRAINT fk_{source_table}_{source_column};'))
-        except:
-            # Key may not exist, so pass.
-            pass
+    # incrementally load a table keyed by its primary key, writing only the rows which have changed since the last load
+    def upsert_to_db(self, source_data_frame, target_table_name: str, dtypes, primary_key: str, full_refresh=False, schema='public') -> dict:
+        '''
+        Save the dataframe in a table on the local/target database, only writing the rows which changed since the last load.
+        A hash of each row is kept by primary key in the etl_row_hashes table. The new and changed rows are staged in a temporary table and
+        applied with INSERT ... ON CONFLICT DO UPDATE, and rows whose key has gone are deleted, all in one transaction.
+        The table is replaced as by upload_to_db when full_refresh is set, when it does not exist yet, has no row hashes or has different columns,
+        or if applying the changes fails, such as when a value is longer than a VARCHAR column.
+        In a schema other than public, such as a staging schema, the table is written there with its row hashes and watermark in that schema's side tables,
+        so that it reaches public with swap_schema_tables. When it is loaded incrementally, the changes are applied to a copy of the public table made there.
+        Each load is recorded in the etl_watermarks table.
+            Parameters:
+                    source_data_frame (Pandas dataframe): Source data to write. The primary key values must be unique.
+                    target_table_name (str): Target table to write the data into.
+                    dtypes (dictionary of sqlalchemy.types): A dictionary of column names and their corresponding SQL types, used when the table is replaced.
+                    primary_key (str): The name of the primary key column.
+                    full_refresh (bool) (optional): Replace the table even if it could be loaded incrementally. Defaults to False.
+                    schema (str) (optional): The schema to write the table in. The rows it is compared with are always those of the public table. Defaults to 'public'.
+            Returns:
+                    load (dictionary): The mode ('incremental' or 'full') and the number of rows inserted, updated, deleted and unchanged.
+        '''
+        row_keys = source_data_frame[primary_key].astype(str).reset_index(drop=True)
+        # int64 rather than uint64 so that the hashes fit in a BIGINT column
+        row_hashes = pd.Series(pd.util.hash_pandas_object(source_data_frame, index=False).to_numpy().view('int64'))
+        if not full_refresh:
+            self.__create_side_tables()
+            if schema != 'public':
+                self.__create_side_tables(schema)
+            try:
+                with self.connect() as con, con.begin():
+                    load = self.__apply_changes(con, source_data_frame, target_table_name, primary_key, row_keys, row_hashes, schema)
+                    if load is not None:
+                        self.__record_watermark(con, target_table_name, load, schema)
+                        return load
+            # the changed rows are copied in on the DBAPI cursor, so a value too long for its column raises a psycopg2 error rather than a SQLAlchemy one
+            except (sqlalchemy.exc.SQLAlchemyError, psycopg2.Error) as error:
+                logging.warn(f"{target_table_name}: incremental load failed ({error.__class__.__name__}), replacing the table instead")
+        self.__create_side_tables(schema)
+        with self.connect() as con, con.begin():
+            self.__write_table(con, source_data_frame, target_table_name, dtypes, primary_key, 'replace', schema=schema)
+            con.execute(sqlalchemy.text(f'DELETE FROM {schema}.{self.row_hashes_table} WHERE table_name = :table_name;'),
+                        {'table_name': target_table_name})
+            self.__copy_data_frame_to_table(con, pd.DataFrame({'table_name': target_table_name, 'row_key': row_keys, 'row_hash': row_hashes}),
+                                            f'{schema}.{self.row_hashes_table}')
+            load = {'mode': 'full', 'inserted': len(row_keys), 'updated': 0, 'deleted': 0, 'unchanged': 0}
+            self.__record_watermark(con, target_table_name, load, schema)
+        return load
+
+    # the side tables are created in a transaction of their own before a load rather than in the load's, holding an advisory lock until it commits.
+    # stages loading at once could otherwise both create a table, which fails on PostgreSQL with a unique violation on pg_type
+    def __create_side_tables(self, schema='public'):
+        with self.connect() as con, con.begin():
+            con.execute(sqlalchemy.text('SELECT pg_advisory_xact_lock(hashtext(:lock_name));'), {'lock_name': f'{schema}.{self.row_hashes_table}'})
+            con.execute(sqlalchemy.text(f'CREATE TABLE IF NOT EXISTS {schema}.{self.row_hashes_table} (table_name TEXT, row_key TEXT, row_hash BIGINT, PRIMARY KEY (table_name, row_key));'))
+            con.execute(sqlalchemy.text(f'CREATE TABLE IF NOT EXISTS {schema}.{self.watermarks_table} (table_name TEXT PRIMARY KEY, mode TEXT, loaded_at TIMESTAMPTZ, inserted BIGINT, updated BIGINT, deleted BIGINT, unchanged BIGINT);'))
+
+    # applies the new, changed and deleted rows to the table, or returns None if the table has to be replaced
+    def __apply_changes(self, con, source_data_frame, target_table_name: str, primary_key: str, row_keys, row_hashes, schema='public'):
+        inspector = sqlalchemy.inspect(con)
+        if not inspector.has_table(target_table_name, schema='public'):
+            return None
+        target_columns = {column['name'] for column in inspector.get_columns(target_table_name, schema='public')}
+        if target_columns != set(source_data_frame.columns):
+            logging.info(f"{target_table_name}: columns have changed, replacing the table")
+            return None
+        stored_hashes = pd.read_sql(sqlalchemy.text(f'SELECT row_key, row_hash FROM public.{self.row_hashes_table} WHERE table_name = :table_name;'),
+                                    con, params={'table_name': target_table_name})
+        if stored_hashes.empty:
+            return None
+        stored_hashes = stored_hashes.set_index('row_key')['row_hash'].astype('Int64')
+        previous_hashes = stored_hashes.reindex(row_keys).reset_index(drop=True)
+        inserted = previous_hashes.isna().to_numpy(dtype=bool)
+        changed = inserted | (previous_hashes != row_hashes).fillna(True).to_numpy(dtype=bool)
+        deleted_keys = stored_hashes.index.difference(row_keys)
+        # without changes the public table is left as it is
+        target_schema = 'public'
+        if schema != 'public' and (changed.any() or len(deleted_keys) > 0):
+            # the changes are applied to a copy of the table and its row hashes in the schema, so that public only changes with the swap.
+            # the copy is made in the database, so only the changed rows are sent to it
+            con.execute(sqlalchemy.text(f'CREATE TABLE {schema}.{target_table_name} (LIKE public.{target_table_name});'))
+            con.execute(sqlalchemy.text(f'INSERT INTO {schema}.{target_table_name} SELECT * FROM public.{target_table_name};'))
+            con.execute(sqlalchemy.text(f'ALTER TABLE {schema}.{target_table_name} ADD PRIMARY KEY ("{primary_key}");'))
+            con.execute(sqlalchemy.text(f'INSERT INTO {schema}.{self.row_hashes_table} SELECT * FROM public.{self.row_hashes_table} WHERE table_name = :table_name;'),
+                        {'table_name': target_table_name})
+            target_schema = schema
+        columns = ', '.join(f'"{column}"' for column in source_data_frame.columns)
+        if changed.any():
+            # the temporary tables have the same column types as the target and are dropped at the end of the transaction
+            con.execute(sqlalchemy.text(f'CREATE TEMPORARY TABLE changed_rows (LIKE public.{target_table_name}) ON COMMIT DROP;'))
+            self.__copy_data_frame_to_table(con, source_data_frame.iloc[changed], 'changed_rows')
+            updates = ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in source_data_frame.columns if column != primary_key)
+            con.execute(sqlalchemy.text(f'INSERT INTO {target_schema}.{target_table_name} ({columns}) SELECT {columns} FROM changed_rows ON CONFLICT ("{primary_key}") DO UPDATE SET {updates};'))
+            con.execute(sqlalchemy.text(f'CREATE TEMPORARY TABLE changed_hashes (row_key TEXT, row_hash BIGINT) ON COMMIT DROP;'))
+            self.__copy_data_frame_to_table(con, pd.DataFrame({'row_key': row_keys[changed], 'row_hash': row_hashes[changed]}), 'changed_hashes')
+            con.execute(sqlalchemy.text(f'INSERT INTO {target_schema}.{self.row_hashes_table} SELECT :table_name, row_key, row_hash FROM changed_hashes ON CONFLICT (table_name, row_key) DO UPDATE SET row_hash = EXCLUDED.row_hash;'),
+                        {'table_name': target_table_name})
+        if len(deleted_keys) > 0:
+            # the keys are compared as the key column's own type, so a UUID matches however its text was written
+            con.execute(sqlalchemy.text(f'CREATE TEMPORARY TABLE deleted_keys ON COMMIT DROP AS SELECT "{primary_key}" FROM {target_schema}.{target_table_name} WITH NO DATA;'))
+            self.__copy_data_frame_to_table(con, pd.DataFrame({primary_key: deleted_keys}), 'deleted_keys')
+            con.execute(sqlalchemy.text(f'DELETE FROM {target_schema}.{target_table_name} AS target USING deleted_keys WHERE target."{primary_key}" = deleted_keys."{primary_key}";'))
+            con.execute(sqlalchemy.text(f'DELETE FROM {target_schema}.{self.row_hashes_table} WHERE table_name = :table_name AND row_key = ANY(:row_keys);'),
+                        {'table_name': target_table_name, 'row_keys': list(deleted_keys)})
+        return {'mode': 'incremental', 'inserted': int(inserted.sum()), 'updated': int((changed & ~inserted).sum()),
+                'deleted': len(deleted_keys), 'unchanged': int((~changed).sum())}
+
+    def __record_watermark(self, con, target_table_name: str, load: dict, schema='public'):
+        con.execute(sqlalchemy.text(f'INSERT INTO {schema}.{self.watermarks_table} VALUES (:table_name, :mode, NOW(), :inserted, :updated, :deleted, :unchanged) ON CONFLICT (table_name) DO UPDATE SET mode = EXCLUDED.mode, loaded_at = EXCLUDED.loaded_at, inserted = EXCLUDED.inserted, updated = EXCLUDED.updated, deleted = EXCLUDED.deleted, unchanged = EXCLUDED.unchanged;'),
+                    load | {'table_name': target_table_name})
+
+    # the following finish a table which has been uploaded in chunks with the steps that need the whole table
+    def remove_duplicate_rows(self, target_table_name: str, key_columns: list[str] = None, schema='public'):
+        '''
+        Removes duplicate rows from a table keeping the first row uploaded. Nulls compare as equal as with DataFrame.drop_duplicates.
+            Parameters:
+                    target_table_name (str): The table in the target database.
+                    key_columns (list) (optional): The columns identifying a row. Defaults to all the columns.
+                    schema (str) (optional): The schema of the table. Defaults to 'public'.
+            Returns:
+                    none.
+        '''
+        with self.connect(autocommit=True) as con:
+            if key_columns is None:
+                key_columns = [column['name'] for column in sqlalchemy.inspect(con).get_columns(target_table_name, schema=schema)]
+            partition_columns = ', '.join(f'"{column}"' for column in key_columns)
+            con.execute(sqlalchemy.text(f'DELETE FROM {schema}.{target_table_name} WHERE ctid IN (SELECT ctid FROM (SELECT ctid, ROW_NUMBER() OVER (PARTITION BY {partition_columns} ORDER BY ctid) AS row_number FROM {schema}.{target_table_name}) AS numbered WHERE row_number > 1);'))
+
+    def drop_empty_columns(self, target_table_name: str, schema='public'):
+        '''
+        Drops the columns of a table which only contain nulls as DataFrame.dropna(how="all", axis=1) does.
+            Parameters:
+                    target_table_name (str): The table in the target database.
+                    schema (str) (optional): The schema of the table. Defaults to 'public'.
+            Returns:
+                    none.
+        '''
+        with self.connect(autocommit=True) as con:
+            columns = [column['name'] for column in sqlalchemy.inspect(con).get_columns(target_table_name, schema=schema)]
+            counts = ', '.join(f'COUNT("{column}")' for column in columns)
+            column_counts = con.execute(sqlalchemy.text(f'SELECT {counts} FROM {schema}.{target_table_name};')).one()
+            for column, count in zip(columns, column_counts):
+                if count == 0:
+                    con.execute(sqlalchemy.text(f'ALTER TABLE {schema}.{target_table_name} DROP COLUMN "{column}";'))
+
+    def drop_columns(self, target_table_name: str, columns: list[str], schema='public'):
+        '''
+        Drops columns of a table, such as one used only while the table is loaded.
+            Parameters:
+                    target_table_name (str): The table in the target database.
+                    columns (list): The columns to drop.
+                    schema (str) (optional): The schema of the table. Defaults to 'public'.
+            Returns:
+                    none.
+        '''
+        with self.connect(autocommit=True) as con:
+            for column in columns:
+                con.execute(sqlalchemy.text(f'ALTER TABLE {schema}.{target_table_name} DROP COLUMN "{column}";'))
+
+    def fit_varchar_columns(self, target_table_name: str, columns: list[str], schema='public'):
+        '''
+        Changes text columns to VARCHAR sized to the longest value in the column.
+            Parameters:
+                    target_table_name (str): The table in the target database.
+                    columns (list): The columns to change.
+                    schema (str) (optional): The schema of the table. Defaults to 'public'.
+            Returns:
+                    none.
+        '''
+        with self.connect(autocommit=True) as con:
+            for column in columns:
+                max_length = con.execute(sqlalchemy.text(f'SELECT MAX(LENGTH("{column}")) FROM {schema}.{target_table_name};')).scalar()
+                if max_length is not None:
+                    con.execute(sqlalchemy.text(f'ALTER TABLE {schema}.{target_table_name} ALTER COLUMN "{column}" TYPE VARCHAR({max_length});'))
+
+    def fit_integer_columns(self, target_table_name: str, columns: list[str], schema='public'):
+        '''
+        Changes whole number columns to the smallest of SMALLINT, INTEGER and BIGINT holding every value in the column.
+            Parameters:
+                    target_table_name (str): The table in the target database.
+                    columns (list): The columns to change.
+                    schema (str) (optional): The schema of the table. Defaults to 'public'.
+            Returns:
+                    none.
+        '''
+        with self.connect(autocommit=True) as con:
+            for column in columns:
+                smallest, largest = con.execute(sqlalchemy.text(f'SELECT MIN("{column}"), MAX("{column}") FROM {schema}.{target_table_name};')).one()
+                if smallest is not None:
+                    sql_type = next(sql_type for sql_type, lowest, highest in self.integer_types if lowest <= smallest and largest <= highest)
+                    con.execute(sqlalchemy.text(f'ALTER TABLE {schema}.{target_table_name} ALTER COLUMN "{column}" TYPE {sql_type};'))
+
+    def add_primary_key(self, target_table_name: str, primary_key: str, schema='public'):
+        with self.connect(autocommit=True) as con:
+            con.execute(sqlalchemy.text(f'ALTER TABLE {schema}.{target_table_name} ADD PRIMARY KEY ({primary_key});'))
+
+    def count_rows(self, target_table_name: str, schema='public') -> int:
+        with self.connect() as con:
+            return con.execute(sqlalchemy.text(f'SELECT COUNT(*) FROM {schema}.{target_table_name};')).scalar()
+
+    def table_exists(self, target_table_name: str, schema='public') -> bool:
+        with self.connect() as con:
+            return sqlalchemy.inspect(con).has_table(target_table_name, schema=schema)
+
+    def add_foreign_key(self, target_table_name: str, target_column: str, source_table: str, source_column: str,
+                        target_schema='public', source_schema='public', constraint_name: str = None):
+        '''
+        Adds a foreign key constraint. It is added NOT VALID, which only locks the tables briefly, and then validated,
+        which checks the existing rows without blocking reads of the tables. The validation locks the target table against other validations,
+        so the keys of one table are validated one after another.
+            Parameters:
+                    target_table_name (str): The table with the foreign key column, such as orders_table.
+                    target_column (str): The foreign key column.
+                    source_table (str): The table referenced.
+                    source_column (str): The column referenced.
+                    target_schema (str) (optional): The schema of the target table. Defaults to 'public'.
+                    source_schema (str) (optional): The schema of the source table. Defaults to 'public'.
+                    constraint_name (str) (optional): The name of the constraint. Defaults to fk_{source_table}_{source_column}.
+            Returns:
+                    none.
+        '''
+        constraint_name = constraint_name or f'fk_{source_table}_{source_column}'
+        with self.connect(autocommit=True) as con:
+            con.execute(sqlalchemy.text(f'ALTER TABLE {target_schema}.{target_table_name} ADD CONSTRAINT {constraint_name} FOREIGN KEY ({target_column}) REFERENCES {source_schema}.{source_table} ({source_column}) NOT VALID;'))
+            try:
+                con.execute(sqlalchemy.text(f'ALTER TABLE {target_schema}.{target_table_name} VALIDATE CONSTRAINT {constraint_name};'))
+            except sqlalchemy.exc.SQLAlchemyError:
+                # a key which does not hold is not left behind checking only the new rows
+                con.execute(sqlalchemy.text(f'ALTER TABLE {target_schema}.{target_table_name} DROP CONSTRAINT {constraint_name};'))
+                raise
+
+    # the tables of a run are loaded into a staging schema and swapped into public once they are all loaded and constrained
+    def prepare_schema(self, schema: str):
+        '''
+        Creates an empty schema, dropping any tables left in it by a run which did not finish.
+        The side tables of the incremental loads are created in it and in public, once before the stages load into them at the same time.
+            Parameters:
+                    schema (str): The name of the schema, such as staging.
+            Returns:
+                    none.
+        '''
+        with self.connect() as con, con.begin():
+            con.execute(sqlalchemy.text(f'DROP SCHEMA IF EXISTS {schema} CASCADE;'))
+            con.execute(sqlalchemy.text(f'CREATE SCHEMA {schema};'))
+        self.__create_side_tables()
+        self.__create_side_tables(schema)
+
+    def swap_schema_tables(self, schema: str, staged_suffix='_staged') -> list[str]:
+        '''
+        Moves every table in a schema into public, replacing the public table of the same name, and drops the schema, all in one transaction.
+        Readers of public see either all the old tables or all the new ones. The replaced tables are only locked for the moment the transaction takes to commit.
+        The row hashes and watermarks of the tables are merged into the public side tables, and constraints whose names end in staged_suffix,
+        added to public tables to reference staged tables, are renamed without it. The foreign keys referencing a replaced table are dropped with it
+        when their own table is replaced too or they have a staged constraint to take their place. Any other view or key depending on a replaced table
+        makes the swap fail and roll back, so it is never dropped silently.
+            Parameters:
+                    schema (str): The schema to move the tables from, such as staging.
+                    staged_suffix (str) (optional): The suffix of the constraint names to rename. Defaults to '_staged'.
+            Returns:
+                    table_names (list): The tables moved into public.
+        '''
+        side_tables = [self.row_hashes_table, self.watermarks_table]
+        self.__create_side_tables()
+        self.__create_side_tables(schema)
+        with self.connect() as con, con.begin():
+            table_names = [table_name for table_name in sqlalchemy.inspect(con).get_table_names(schema=schema)
+                           if table_name not in side_tables]
+            # the public foreign keys replaced by the run: those of the staged tables and those with a staged constraint to take their place
+            replaced_constraints = con.execute(sqlalchemy.text("SELECT source.relname, constraints.conname FROM pg_constraint AS constraints "
+                                                               "JOIN pg_class AS source ON source.oid = constraints.conrelid "
+                                                               "JOIN pg_class AS referenced ON referenced.oid = constraints.confrelid "
+                                                               "WHERE constraints.contype = 'f' AND source.relnamespace = 'public'::regnamespace "
+                                                               "AND referenced.relnamespace = 'public'::regnamespace AND referenced.relname = ANY(:table_names) "
+                                                               "AND (source.relname = ANY(:table_names) OR EXISTS (SELECT 1 FROM pg_constraint AS staged "
+                                                               "WHERE staged.conrelid = constraints.conrelid AND staged.conname = constraints.conname || :suffix));"),
+                                               {'table_names': table_names, 'suffix': staged_suffix}).all()
+            for table_name, constraint_name in replaced_constraints:
+                con.execute(sqlalchemy.text(f'ALTER TABLE public.{table_name} DROP CONSTRAINT {constraint_name};'))
+            for table_name in table_names:
+                # without CASCADE, so a view or key from outside the run depending on the old table fails the swap rather than being dropped
+                con.execute(sqlalchemy.text(f'DROP TABLE IF EXISTS public.{table_name};'))
+                con.execute(sqlalchemy.text(f'ALTER TABLE {schema}.{table_name} SET SCHEMA public;'))
+            for side_table in side_tables:
+                con.execute(sqlalchemy.text(f'DELETE FROM public.{side_table} WHERE table_name IN (SELECT table_name FROM {schema}.{side_table});'))
+                con.execute(sqlalchemy.text(f'INSERT INTO public.{side_table} SELECT * FROM {schema}.{side_table};'))
+            staged_constraints = con.execute(sqlalchemy.text("SELECT conrelid::regclass::text, conname FROM pg_constraint WHERE connamespace = 'public'::regnamespace AND RIGHT(conname, LENGTH(:suffix)) = :suffix;"),
+                                             {'suffix': staged_suffix}).all()
+            for table_name, constraint_name in staged_constraints:
+                con.execute(sqlalchemy.text(f'ALTER TABLE {table_name} RENAME CONSTRAINT {constraint_name} TO {constraint_name[:-len(staged_suffix)]};'))
+            con.execute(sqlalchemy.text(f'DROP SCHEMA {schema} CASCADE;'))
+        return table_names
@@ -0,0 +1,61 @@
+import logging
+import numpy as np
+import pandas as pd
+
+
+class DateParser:
+    '''
+    Parses date columns with the same results as pd.to_datetime(format='mixed') without parsing every cell with dateutil.
+    Each distinct string is parsed once. The explicit formats are tried in order as vectorised passes and only the strings none of them match are parsed with format='mixed'.
+    '''
+    # the formats found in the legacy data, most common first
+    formats = ['%Y-%m-%d', '%Y/%m/%d', '%Y %B %d', '%B %Y %d']
+
+    def __init__(self, formats: list[str] = None):
+        if formats is not None:
+            self.formats = formats
+        # the number of rows resolved by each pass of the last parse
+        self.pass_counts = {}
+
+    def parse(self, values: pd.Series, errors='coerce') -> pd.Series:
+        '''
+        Converts a column of dates to datetime64 as pd.to_datetime(values, format='mixed', errors=errors) does.
+            Parameters:
+                    values (Pandas series): The dates to parse.
+                    errors (str) (optional): 'coerce' to set dates which can not be parsed to NaT or 'ignore' to return values unchanged if any of them can not be parsed. Defaults to 'coerce'.
+            Returns:
+                    dates (Pandas series): The parsed dates.
+        '''
+        codes, unique_values = pd.factorize(values)
+        unique_values = pd.Series(unique_values, dtype=object)
+        # the number of rows each distinct value is on, for the pass counts
+        row_counts = np.bincount(codes[codes >= 0], minlength=len(unique_values))
+        unique_dates = pd.Series(pd.NaT, index=unique_values.index, dtype='datetime64[ns]')
+        is_string = (unique_values.map(type) == str).to_numpy()
+        remaining = is_string.copy()
+        self.pass_counts = {}
+        for date_format in self.formats:
+            if not remaining.any():
+                break
+            parsed = pd.to_datetime(unique_values[remaining], format=date_format, errors='coerce')
+            resolved = parsed.notna()
+            unique_dates[parsed.index[resolved]] = parsed[resolved]
+            remaining[parsed.index[resolved]] = False
+            self.pass_counts[date_format] = int(row_counts[parsed.index[resolved]].sum())
+        # strings which matched no format and any values which are not strings are parsed as format='mixed' would
+        remaining |= ~is_string
+        if remaining.any():
+            parsed = pd.to_datetime(unique_values[remaining], format='mixed', errors=errors)
+            if parsed.dtype != 'datetime64[ns]':
+                # errors='ignore' found a value which could not be parsed, or there are time zones which the explicit formats did not give.
+                # either way parsing the whole column as before gives the same result
+                logging.info(f"{values.name}: dates not parsed by the explicit formats, parsing with format='mixed'")
+                return pd.to_datetime(values, format='mixed', errors=errors)
+            resolved = parsed.notna()
+            unique_dates[parsed.index[resolved]] = parsed[resolved]
+            self.pass_counts['mixed'] = int(row_counts[parsed.index[resolved]].sum())
+        self.pass_counts['unparsed'] = int((codes < 0).sum() + row_counts[unique_dates.isna().to_numpy()].sum())
+        logging.info(f"{values.name}: rows resolved by each date parsing pass {self.pass_counts}")
+        # factorize gives missing values the code -1, which takes the NaT added to the end
+        dates = np.append(unique_dates.to_numpy(), np.datetime64('NaT', 'ns'))[codes]
+        return pd.Series(dates, index=values.index, name=values.name)
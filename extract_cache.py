@@ -0,0 +1,202 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import pandas as pd
+import threading
+from parquet_frames import ParquetFrames
+
+
+class ExtractCache:
+    '''
+    Keeps the raw bytes of downloaded extracts on disk so that a source which has not changed since the last run is not downloaded again.
+    It can also keep DataFrames parsed from an extract as Parquet, keyed by the hash of the extract, so that an unchanged extract is not parsed again.
+    Each file is stored under the SHA-256 of its content and an index maps each source to its file with the ETag/Last-Modified it was downloaded with.
+    When the files grow beyond max_bytes the least recently used sources are evicted.
+    '''
+    index_file_name = 'index.json'
+
+    def __init__(self, directory='.extract_cache', max_bytes=256*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # the extracts are downloaded by several threads at once
+        self.__lock = threading.Lock()
+        # source -> {'sha256', 'size', 'etag', 'last_modified'} with the least recently used source first
+        self.__index = self.__read_index()
+        self.statistics = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __read_index(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, self.index_file_name), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    # written to a temporary file first so that an interrupted run never leaves a partial index. the temporary file is named
+    # by this process, as the stages run in other processes with executor_processes write the index of the same directory
+    def __write_index(self):
+        index_path = os.path.join(self.directory, self.index_file_name)
+        temporary_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(self.__index, file)
+        os.replace(temporary_path, index_path)
+
+    def __content_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256)
+
+    # returns the cache entry and content for a source, or (None, None) if it is not cached or the file is missing or corrupt
+    def __cached(self, source: str):
+        with self.__lock:
+            entry = self.__index.get(source)
+            if entry is None:
+                return None, None
+            try:
+                with open(self.__content_path(entry['sha256']), 'rb') as file:
+                    content = file.read()
+            except OSError:
+                content = None
+            if content is None or hashlib.sha256(content).hexdigest() != entry['sha256']:
+                logging.warn(f"{source}: cached extract is missing or corrupt, downloading it again")
+                del self.__index[source]
+                return None, None
+            return entry, content
+
+    # marks a source as the most recently used
+    def __hit(self, source: str, entry: dict, content: bytes) -> bytes:
+        with self.__lock:
+            if source in self.__index:
+                self.__index[source] = self.__index.pop(source)
+                self.__write_index()
+            self.statistics['hits'] += 1
+        logging.info(f"{source}: unchanged, using the cached copy")
+        return content
+
+    def __store(self, source: str, content: bytes, etag: str, last_modified: str) -> bytes:
+        sha256 = hashlib.sha256(content).hexdigest()
+        with self.__lock:
+            os.makedirs(self.directory, exist_ok=True)
+            content_path = self.__content_path(sha256)
+            if not os.path.exists(content_path):
+                temporary_path = f'{content_path}.{os.getpid()}.tmp'
+                with open(temporary_path, 'wb') as file:
+                    file.write(content)
+                os.replace(temporary_path, content_path)
+            self.__index.pop(source, None)
+            self.__index[source] = {'sha256': sha256, 'size': len(content),
+                                    'etag': etag, 'last_modified': last_modified}
+            self.__evict()
+            self.__write_index()
+            self.statistics['misses'] += 1
+        logging.info(f"{source}: saved {len(content)} bytes in the extract cache")
+        return content
+
+    # removes the least recently used sources until the files fit in max_bytes. Sources with the same content share one file
+    def __evict(self):
+        sizes = {entry['sha256']: entry['size'] for entry in self.__index.values()}
+        total_size = sum(sizes.values())
+        while total_size > self.max_bytes and self.__index:
+            source = next(iter(self.__index))
+            sha256 = self.__index.pop(source)['sha256']
+            self.statistics['evictions'] += 1
+            logging.info(f"{source}: evicted from the extract cache")
+            if all(entry['sha256'] != sha256 for entry in self.__index.values()):
+                total_size -= sizes[sha256]
+                try:
+                    os.remove(self.__content_path(sha256))
+                except OSError:
+                    pass
+
+    def fetch_http(self, session, url: str, headers: dict[str, str] = None) -> bytes:
+        '''
+        Returns the content at a URL, only downloading it if it has changed since it was cached.
+        A cached URL is requested with If-None-Match/If-Modified-Since so an unchanged source is answered with 304 Not Modified and no body.
+            Parameters:
+                    session (requests.Session): The session to send the request with.
+                    url (str): The URL to read.
+                    headers (dictionary) (optional): Extra request headers.
+            Returns:
+                    content (bytes): The content at the URL.
+        '''
+        entry, content = self.__cached(url)
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry['etag']:
+                request_headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                request_headers['If-Modified-Since'] = entry['last_modified']
+        response = session.get(url, headers=request_headers)
+        if response.status_code == 304 and entry is not None:
+            return self.__hit(url, entry, content)
+        response.raise_for_status()
+        return self.__store(url, response.content, response.headers.get('ETag'),
+                            response.headers.get('Last-Modified'))
+
+    def fetch_s3(self, s3client, bucket: str, key: str) -> bytes:
+        '''
+        Returns the content of an S3 object, only downloading it if its ETag has changed since it was cached.
+            Parameters:
+                    s3client: The boto3 S3 client (or any client with the same head_object and get_object methods).
+                    bucket (str): The S3 bucket.
+                    key (str): The key of the object in the bucket.
+            Returns:
+                    content (bytes): The content of the object.
+        '''
+        source = f's3://{bucket}/{key}'
+        entry, content = self.__cached(source)
+        if entry is not None and entry['etag']:
+            head = s3client.head_object(Bucket=bucket, Key=key)
+            if head.get('ETag') == entry['etag']:
+                return self.__hit(source, entry, content)
+        s3response = s3client.get_object(Bucket=bucket, Key=key)
+        last_modified = s3response.get('LastModified')
+        return self.__store(source, s3response['Body'].read(), s3response.get('ETag'),
+                            str(last_modified) if last_modified is not None else None)
+
+    def version(self, source: str) -> str:
+        '''
+        Returns the version of a cached source: the SHA-256 of its extract, which changes whenever the source does.
+            Parameters:
+                    source (str): The URL or S3 URI of the source.
+            Returns:
+                    version (str): The SHA-256 of the extract, or None if the source is not cached.
+        '''
+        with self.__lock:
+            entry = self.__index.get(source)
+        return entry['sha256'] if entry is not None else None
+
+    def parsed_source(self, parser: str, content: bytes, arguments: dict) -> str:
+        '''
+        Returns the cache key for a DataFrame parsed from an extract. The key names the Parquet format, so a DataFrame pickled by an earlier version is parsed again.
+            Parameters:
+                    parser (str): The name of the parser, such as tabula.
+                    content (bytes): The extract that was parsed.
+                    arguments (dictionary): The parser arguments which change the result, such as the pages.
+            Returns:
+                    source (str): The key to read and write the DataFrame with.
+        '''
+        return f'{parser}:parquet:{hashlib.sha256(content).hexdigest()}:{json.dumps(arguments, sort_keys=True, default=str)}'
+
+    def read_data_frame(self, source: str):
+        '''
+        Returns a DataFrame saved with write_data_frame.
+            Parameters:
+                    source (str): The key the DataFrame was saved with.
+            Returns:
+                    data_frame (Pandas dataframe): The DataFrame, or None if it is not cached.
+        '''
+        entry, content = self.__cached(source)
+        if entry is None:
+            return None
+        return ParquetFrames.read(io.BytesIO(self.__hit(source, entry, content)))
+
+    def write_data_frame(self, source: str, data_frame: pd.DataFrame):
+        '''
+        Saves a DataFrame in the cache. It is evicted with the extracts when the cache is full.
+            Parameters:
+                    source (str): The key to save the DataFrame with.
+                    data_frame (Pandas dataframe): The DataFrame to save. Its column names must be strings.
+        '''
+        buffer = io.BytesIO()
+        ParquetFrames.write(data_frame, buffer)
+        self.__store(source, buffer.getvalue(), None, None)
@@ -0,0 +1,275 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where the peak RSS is not recorded
+    resource = None
+
+
+class RunMetrics:
+    '''
+    Records for each stage of a run the wall and CPU time of the stage, of its extract, clean and load phases and of the cleaning steps,
+    the rows in and out, the bytes downloaded and loaded, the memory used by the cleaned tables, the peak RSS and a profile of the columns loaded.
+    The results are written as a JSON run report and optionally in the Prometheus text format to compare runs.
+    The stage is kept per thread, so a component running in a stage's thread records against that stage without being given its name.
+    The CPU time is that of the stage's thread: work on other threads or in the process pool only counts in the wall time.
+    '''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.start_time = time.time()
+        self.__start_counter = time.perf_counter()
+        # stage name -> the measurements of the stage, as returned by __stage_metrics
+        self.stages = {}
+
+    # a copy sent to a process in the pool starts empty, so the lock and thread local state are never pickled
+    def __reduce__(self):
+        return (RunMetrics, ())
+
+    @staticmethod
+    def peak_rss_bytes() -> int:
+        '''
+        Returns the largest resident set size of this process so far, or None where it can not be read.
+        '''
+        if resource is None:
+            return None
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+    def __stage_metrics(self, stage: str) -> dict:
+        return self.stages.setdefault(stage, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_bytes': None,
+                                              'rows_in': 0, 'rows_out': 0, 'bytes_in': 0, 'bytes_out': 0,
+                                              'memory_bytes': 0, 'memory_bytes_uncompacted': 0,
+                                              'phases': {}, 'steps': {}, 'columns': {}})
+
+    # adds the wall and CPU time since the start times to a measurement and keeps the largest peak RSS
+    def __add_times(self, measurement: dict, start_counter: float, start_thread_time: float):
+        measurement['wall_seconds'] += time.perf_counter() - start_counter
+        measurement['cpu_seconds'] += time.thread_time() - start_thread_time
+        if 'peak_rss_bytes' in measurement:
+            measurement['peak_rss_bytes'] = self.__largest(measurement['peak_rss_bytes'], self.peak_rss_bytes())
+
+    @staticmethod
+    def __largest(first, second):
+        return max((value for value in (first, second) if value is not None), default=None)
+
+    def current_stage(self) -> str:
+        '''
+        Returns the stage running on this thread, or None outside a stage.
+        '''
+        return getattr(self.__local, 'stage', None)
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        '''
+        Measures a stage run on this thread. The phases, steps, rows and bytes recorded on this thread until it ends are recorded against it.
+            Parameters:
+                    stage (str): The name of the stage, such as process_users.
+        '''
+        self.__local.stage = stage
+        start_counter, start_thread_time = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.__local.stage = None
+            with self.__lock:
+                stage_metrics = self.__stage_metrics(stage)
+                self.__add_times(stage_metrics, start_counter, start_thread_time)
+
+    @contextlib.contextmanager
+    def phase(self, phase: str):
+        '''
+        Measures a phase of the stage running on this thread. A phase which runs several times, such as for each chunk of a table, is added up.
+            Parameters:
+                    phase (str): The phase, one of extract, clean or load.
+        '''
+        stage = self.current_stage()
+        start_counter, start_thread_time = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            if stage is not None:
+                with self.__lock:
+                    phase_metrics = self.__stage_metrics(stage)['phases'].setdefault(
+                        phase, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_bytes': None})
+                    phase_metrics['calls'] += 1
+                    self.__add_times(phase_metrics, start_counter, start_thread_time)
+
+    @contextlib.contextmanager
+    def step(self, step: str):
+        '''
+        Measures a step of the stage running on this thread, such as the date parsing while cleaning.
+            Parameters:
+                    step (str): The name of the step.
+        '''
+        stage = self.current_stage()
+        start_counter, start_thread_time = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            if stage is not None:
+                with self.__lock:
+                    step_metrics = self.__stage_metrics(stage)['steps'].setdefault(
+                        step, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+                    step_metrics['calls'] += 1
+                    self.__add_times(step_metrics, start_counter, start_thread_time)
+
+    def add_rows(self, rows_in=0, rows_out=0):
+        '''
+        Adds to the rows read and written by the stage running on this thread. Nothing is recorded outside a stage.
+        '''
+        stage = self.current_stage()
+        if stage is not None:
+            with self.__lock:
+                stage_metrics = self.__stage_metrics(stage)
+                stage_metrics['rows_in'] += rows_in
+                stage_metrics['rows_out'] += rows_out
+
+    def add_bytes(self, bytes_in=0, bytes_out=0, stage: str = None):
+        '''
+        Adds to the bytes downloaded and loaded by a stage.
+            Parameters:
+                    bytes_in (int) (optional): The bytes downloaded.
+                    bytes_out (int) (optional): The bytes sent to the target database.
+                    stage (str) (optional): The stage, for work done on another thread for it. Defaults to the stage running on this thread.
+        '''
+        stage = stage or self.current_stage()
+        if stage is not None:
+            with self.__lock:
+                stage_metrics = self.__stage_metrics(stage)
+                stage_metrics['bytes_in'] += bytes_in
+                stage_metrics['bytes_out'] += bytes_out
+
+    def add_memory(self, memory_bytes: int, memory_bytes_uncompacted: int):
+        '''
+        Adds to the memory used by the cleaned DataFrames of the stage running on this thread. The chunks of a streamed table are added up.
+            Parameters:
+                    memory_bytes (int): The memory used by a cleaned DataFrame.
+                    memory_bytes_uncompacted (int): The memory it would use without compact types, as returned by DataCleaning.memory_footprint.
+        '''
+        stage = self.current_stage()
+        if stage is not None:
+            with self.__lock:
+                stage_metrics = self.__stage_metrics(stage)
+                stage_metrics['memory_bytes'] += memory_bytes
+                stage_metrics['memory_bytes_uncompacted'] += memory_bytes_uncompacted
+
+    def profile_columns(self, data_frame):
+        '''
+        Adds the type and the number of nulls of each column of a DataFrame loaded by the stage running on this thread.
+        The nulls of a table loaded in chunks are added up.
+            Parameters:
+                    data_frame (Pandas dataframe): The DataFrame being loaded.
+        '''
+        stage = self.current_stage()
+        if stage is None:
+            return
+        null_counts = data_frame.isna().sum()
+        with self.__lock:
+            columns = self.__stage_metrics(stage)['columns']
+            for column, dtype in data_frame.dtypes.items():
+                column_metrics = columns.setdefault(str(column), {'dtype': str(dtype), 'nulls': 0})
+                column_metrics['nulls'] += int(null_counts[column])
+
+    def merge(self, stages: dict):
+        '''
+        Adds the stages recorded by another RunMetrics, such as the one in the process which ran a stage.
+        The CPU time, rows and bytes are added to those recorded here, and the phases, steps and columns replace any of the same name.
+        The wall time of a stage is left to be measured here, around the wait for the other process.
+            Parameters:
+                    stages (dictionary): The stages attribute of the other RunMetrics.
+        '''
+        with self.__lock:
+            for stage, other_metrics in stages.items():
+                stage_metrics = self.__stage_metrics(stage)
+                for name in ['cpu_seconds', 'rows_in', 'rows_out', 'bytes_in', 'bytes_out', 'memory_bytes', 'memory_bytes_uncompacted']:
+                    stage_metrics[name] += other_metrics[name]
+                stage_metrics['peak_rss_bytes'] = self.__largest(stage_metrics['peak_rss_bytes'], other_metrics['peak_rss_bytes'])
+                for name in ['phases', 'steps', 'columns']:
+                    stage_metrics[name].update(other_metrics[name])
+
+    def report(self, stage_scheduler=None) -> dict:
+        '''
+        Returns the run report.
+            Parameters:
+                    stage_scheduler (StageScheduler) (optional): The scheduler which ran the stages, to add their status, start and end times and the critical path.
+            Returns:
+                    report (dictionary): The run start time, wall and CPU time and peak RSS, and the measurements of each stage.
+        '''
+        with self.__lock:
+            stages = json.loads(json.dumps(self.stages))
+        report = {'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.start_time)),
+                  'wall_seconds': time.perf_counter() - self.__start_counter,
+                  'cpu_seconds': time.process_time(),
+                  'peak_rss_bytes': self.peak_rss_bytes(),
+                  'stages': stages}
+        if stage_scheduler is not None:
+            for stage, result in stage_scheduler.results.items():
+                stages.setdefault(stage, {}).update({key: result[key] for key in ['status', 'start', 'end'] if key in result})
+            report['critical_path'] = stage_scheduler.critical_path()
+        return report
+
+    def prometheus_text(self, report: dict) -> str:
+        '''
+        Returns a run report in the Prometheus text exposition format, such as for the node exporter textfile collector.
+            Parameters:
+                    report (dictionary): The report returned by report.
+            Returns:
+                    text (str): One gauge per measurement, labelled by stage, phase or step.
+        '''
+        samples = {}
+        def add_sample(name: str, labels: dict, value):
+            if value is not None:
+                label_text = ','.join(f'{label}="{self.__escape_label(label_value)}"' for label, label_value in labels.items())
+                samples.setdefault(f'etl_{name}', []).append(f'etl_{name}{{{label_text}}} {value}' if label_text else f'etl_{name} {value}')
+        for name in ['wall_seconds', 'cpu_seconds', 'peak_rss_bytes']:
+            add_sample(f'run_{name}', {}, report[name])
+        for stage, stage_metrics in report['stages'].items():
+            labels = {'stage': stage}
+            if 'status' in stage_metrics:
+                add_sample('stage_succeeded', labels, int(stage_metrics['status'] == 'succeeded'))
+            for name in ['wall_seconds', 'cpu_seconds', 'peak_rss_bytes', 'rows_in', 'rows_out', 'bytes_in', 'bytes_out',
+                         'memory_bytes', 'memory_bytes_uncompacted']:
+                add_sample(f'stage_{name}', labels, stage_metrics.get(name))
+            for phase, phase_metrics in stage_metrics.get('phases', {}).items():
+                for name in ['wall_seconds', 'cpu_seconds']:
+                    add_sample(f'phase_{name}', labels | {'phase': phase}, phase_metrics[name])
+            for step, step_metrics in stage_metrics.get('steps', {}).items():
+                for name in ['wall_seconds', 'cpu_seconds']:
+                    add_sample(f'step_{name}', labels | {'step': step}, step_metrics[name])
+            for column, column_metrics in stage_metrics.get('columns', {}).items():
+                add_sample('column_nulls', labels | {'column': column}, column_metrics['nulls'])
+        lines = []
+        for name, name_samples in samples.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(name_samples)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __escape_label(label_value: str) -> str:
+        return label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    # written to a temporary file first so that a reader never sees a partial report
+    def __write_file(self, path: str, text: str):
+        with open(path + '.tmp', 'w') as file:
+            file.write(text)
+        os.replace(path + '.tmp', path)
+
+    def write_reports(self, report: dict, json_path: str = None, prometheus_path: str = None):
+        '''
+        Writes a run report as JSON and in the Prometheus text format.
+            Parameters:
+                    report (dictionary): The report returned by report.
+                    json_path (str) (optional): The JSON file to write. Not written if None.
+                    prometheus_path (str) (optional): The Prometheus text file to write. Not written if None.
+        '''
+        if json_path:
+            self.__write_file(json_path, json.dumps(report, indent=2))
+        if prometheus_path:
+            self.__write_file(prometheus_path, self.prometheus_text(report))
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import re
+
+
+class PhoneNumberFormatter:
+    '''
+    Validates phone numbers against the numbering plan of each user's country and rewrites the valid ones in one canonical form.
+    The patterns are compiled once when the class is loaded and the numbers of each plan are matched and rewritten together with the pandas str methods.
+    '''
+    # the numbering plan for numbers with no country_code or a country_code without its own plan
+    default_plan = 'GB'
+    # UK numbers: 0 followed by the national number, or +44/0044/011 44 with an optional (0), with an optional extension
+    gb_pattern = re.compile(r'^(?:(?:\(?(?:0(?:0|11)\)?[\s-]?\(?|\+)44\)?[\s-]?(?:\(?0\)?[\s-]?)?)|(?:\(?0))(?:(?:\d{5}\)?[\s-]?\d{4,5})|(?:\d{4}\)?[\s-]?(?:\d{5}|\d{3}[\s-]?\d{3}))|(?:\d{3}\)?[\s-]?\d{3}[\s-]?\d{3,4})|(?:\d{2}\)?[\s-]?\d{4}[\s-]?\d{4}))(?:[\s-]?(?:x|ext\.?|\#)\d{3,4})?$')
+    # the gb_pattern only allows +44 at the start, where it becomes the trunk 0 with any 0 or (0) following it. the brackets, dashes and spaces are then removed
+    gb_international_pattern = re.compile(r'^\+44(?:\(0\)|0)?')
+    gb_separator_pattern = re.compile(r'[() -]')
+    # North American numbers: optional +1, 1 or 001, a 3 digit area code, 3 digit exchange and 4 digit line with an optional extension
+    us_pattern = re.compile(r'^(?:\+?1|001)?[\s.-]?\(?([2-9]\d{2})\)?[\s.-]?(\d{3})[\s.-]?(\d{4})(?:\s*(?:x|ext\.?|\#)\s*(\d{1,5}))?$')
+    # German numbers: +49/0049 with an optional (0), or the trunk 0, followed by 6 to 13 digits which may be grouped
+    de_pattern = re.compile(r'^(?:(?:\+|00)49\s?(?:\(0\))?|\(?0)\s?(\d[\d\s/()-]{4,15}\d)$')
+    non_digit_pattern = re.compile(r'\D')
+
+    # each plan returns the canonical numbers, with NaN where a number does not match the plan
+    def __format_gb(self, phone_numbers: pd.Series) -> pd.Series:
+        valid_numbers = phone_numbers.where(phone_numbers.str.match(self.gb_pattern))
+        return valid_numbers.str.replace(self.gb_international_pattern, '0', regex=True).str.replace(self.gb_separator_pattern, '', regex=True)
+
+    def __format_us(self, phone_numbers: pd.Series) -> pd.Series:
+        area_codes, exchanges, lines, extensions = (part for _, part in phone_numbers.str.extract(self.us_pattern).items())
+        national_numbers = area_codes + exchanges + lines
+        return national_numbers.where(extensions.isna(), national_numbers + 'x' + extensions)
+
+    def __format_de(self, phone_numbers: pd.Series) -> pd.Series:
+        national_numbers = phone_numbers.str.extract(self.de_pattern)[0].str.replace(self.non_digit_pattern, '', regex=True)
+        lengths = national_numbers.str.len()
+        return national_numbers.str.lstrip('0').radd('0').where((lengths >= 6) & (lengths <= 13))
+
+    # the numbering plan for each country_code
+    def __plans(self) -> dict:
+        return {'GB': self.__format_gb, 'US': self.__format_us, 'DE': self.__format_de}
+
+    def format_phone_numbers(self, phone_numbers: pd.Series, country_codes: pd.Series = None) -> pd.Series:
+        '''
+        Validates and canonicalises phone numbers using the numbering plan for each row's country.
+                GB numbers are written as the national number with the trunk 0, such as 01214960340, keeping any extension as x123.
+                US numbers are written as the 10 digit national number, such as 3082544417, keeping any extension as x1234.
+                DE numbers are written as the national number with the trunk 0, such as 0845803476.
+            Parameters:
+                    phone_numbers (Pandas series): The phone numbers to format.
+                    country_codes (Pandas series) (optional): The country_code of each row. Defaults to the UK plan for every row.
+            Returns:
+                    formatted (Pandas series): The canonical phone numbers, or None where the number is not valid for the country.
+        '''
+        plans = self.__plans()
+        if country_codes is None:
+            plan_names = pd.Series(self.default_plan, index=phone_numbers.index)
+        else:
+            plan_names = country_codes.where(country_codes.isin(list(plans)), self.default_plan)
+        formatted = pd.Series(np.full(len(phone_numbers), None, dtype=object), index=phone_numbers.index, name=phone_numbers.name)
+        is_string = (phone_numbers.map(type) == str).to_numpy()
+        for plan_name, format_phone_numbers in plans.items():
+            in_plan = is_string & (plan_names == plan_name).to_numpy()
+            if not in_plan.any():
+                continue
+            plan_formatted = format_phone_numbers(phone_numbers[in_plan])
+            formatted[in_plan] = plan_formatted.where(plan_formatted.notna(), None).to_numpy(dtype=object)
+        return formatted
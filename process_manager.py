@@ -1,8 +1,21 @@
+import functools
+import hashlib
+import inspect
 import logging
-import threading
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from data_cleaning import DataCleaning
 from data_extraction import DataExtractor
+from extract_cache import ExtractCache
 from database_utils import DatabaseConnector
+from date_parsing import DateParser
+from metrics import RunMetrics
+from phone_number_formatter import PhoneNumberFormatter
+from raw_snapshots import RawSnapshots
+from schema_inference import SchemaInferrer
+from stage_scheduler import StageScheduler
+import pandas as pd
 import sqlalchemy.types as types
 
 
@@ -11,37 +24,96 @@ class ProcessManager:
     db_connector = DatabaseConnector()
     data_extractor = DataExtractor()
     data_cleaning = DataCleaning()
-    # read external endpoint configurations
-    api_config =  data_extractor.read_api_creds()
-
-    # to be filled in later during __init__ or thread creation
+    # to be filled in later during __init__ or stage creation
+    api_config = None
+    schema_inferrer = None
     write_raw_data = False
-    need_to_add_foreign_keys = False
-    thread_function_list = []
+    write_raw_db = False
+    # the snapshot the raw extracts of this run are saved in with write_raw, and the snapshot read instead of the sources with replay
+    raw_snapshots = None
+    replay_snapshots = None
+    stream_tables = False
+    # the rows read, cleaned and saved at a time with the stream argument
+    stream_chunk_size = 50000
+    full_refresh = False
+    stage_function_list = []
     valid_arguments_list = []
+    # the tables replaced by a run are loaded into this schema and swapped into public together at the end of the run
+    staging_schema = 'staging'
+    # the orders_table foreign keys as (dimension table, column, the stage which loads the dimension table)
+    foreign_keys = [('dim_products', 'product_code', 'process_products'),
+                    ('dim_store_details', 'store_code', 'process_stores'),
+                    ('dim_card_details', 'card_number', 'process_cards'),
+                    ('dim_users', 'user_uuid', 'process_users'),
+                    ('dim_date_times', 'date_uuid', 'process_times')]
+    # the types of the key columns are set on both sides of each foreign key rather than inferred, so that the values of one load can not give
+    # the two sides different types, such as BIGINT for card numbers which are all digits. the VARCHAR columns are sized to their longest value
+    key_types = {'product_code': types.VARCHAR, 'store_code': types.VARCHAR, 'card_number': types.VARCHAR,
+                 'user_uuid': types.UUID(), 'date_uuid': types.UUID()}
+    # threads: every stage runs on a thread. hybrid: extraction and loading run on threads and the cleaning in a process pool.
+    # processes: every stage runs in a process of its own
+    executor = 'threads'
+    executor_modes = ['threads', 'hybrid', 'processes']
+    process_pool = None
+    # the connections of each pool kept for the prerequisite checks and the preparing of the staging schema, besides one for each stage
+    main_thread_connections = 2
 
     def __init__(self):
-        self.thread_function_list = [self.process_users,
-                                     self.process_cards,
-                                     self.process_stores,
-                                     self.process_products,
-                                     self.process_orders,
-                                     self.process_times]
+        # read external endpoint configurations. this is done here rather than when the module is imported,
+        # as each spawned process of the pools imports it again
+        self.api_config = self.data_extractor.read_api_creds()
+        self.stream_chunk_size = self.api_config.get('stream_chunk_size') or self.stream_chunk_size
+        # keep the downloaded PDF, S3 and JSON extracts so that unchanged sources are not downloaded again on the next run, when a directory is configured
+        extract_cache_directory = self.api_config.get('extract_cache_directory')
+        self.data_extractor.extract_cache = ExtractCache(extract_cache_directory, self.api_config.get('extract_cache_max_bytes', 256*1024*1024)) \
+                                            if extract_cache_directory else None
+        # the SQL types of each table are inferred from the cleaned data. the profile is kept for an unchanged source so it is not measured again
+        if self.schema_inferrer is None:
+            schema_cache_path = self.api_config.get('schema_cache_path', '.schema_cache.json')
+            self.schema_inferrer = SchemaInferrer(schema_cache_path, self.__cleaning_code_version()) if schema_cache_path else SchemaInferrer()
+        # the time, rows and bytes of each stage of this run, recorded by the shared worker classes too
+        self.metrics = RunMetrics()
+        self.db_connector.metrics = self.metrics
+        self.data_extractor.metrics = self.metrics
+        self.data_cleaning.metrics = self.metrics
+        self.stage_function_list = [self.process_users,
+                                    self.process_cards,
+                                    self.process_stores,
+                                    self.process_products,
+                                    self.process_orders,
+                                    self.process_times]
         self.valid_arguments_list = ['checks_extensive',
                                      'checks',
                                      'write_raw',
+                                     'write_raw_db',
+                                     'replay',
+                                     'stream',
+                                     'full_refresh',
                                      'do_nothing']
-        for thread_function in self.thread_function_list:
-            self.valid_arguments_list.append(thread_function.__name__)
+        for executor in self.executor_modes:
+            self.valid_arguments_list.append('executor_'+executor)
+        for stage_function in self.stage_function_list:
+            self.valid_arguments_list.append(stage_function.__name__)
+        # every stage holds at most one connection of a pool at a time, and the process and foreign key stages can all run at once.
+        # the pools keep a connection for each stage stage_max_workers lets run at once and more for the main thread. the engines are created on first use, after this
+        concurrent_stages = len(self.stage_function_list) + len(self.foreign_keys)
+        stage_max_workers = self.api_config.get('stage_max_workers') or concurrent_stages
+        self.db_connector.pool_size = min(stage_max_workers, concurrent_stages) + self.main_thread_connections
+
+    # the code of the cleaning is part of the version of a cached profile, so a change which makes values longer,
+    # such as another phone number or date format, is measured again
+    @staticmethod
+    def __cleaning_code_version() -> str:
+        return hashlib.sha256(''.join(inspect.getsource(cleaning_class)
+                                      for cleaning_class in [DataCleaning, DateParser, PhoneNumberFormatter, SchemaInferrer]).encode()).hexdigest()
 
     def prerequisite_checks_ok(self, extensive: bool)  -> bool:
         logging.info("PREREQUISITE CHECK: database configurations load")
-        db_creds = self.db_connector.read_db_creds()
-        db_engine = self.db_connector.init_db_engine(db_creds)
+        db_engine = self.db_connector.get_engine('RDS_')
         if not db_engine:
             logging.error(f"PREREQUISITE CHECK FAILED: source database configuration failed")
             return False
-        if not self.db_connector.init_db_engine(db_creds, 'LOCAL_'):
+        if not self.db_connector.get_engine('LOCAL_'):
             logging.error(f"PREREQUISITE CHECK FAILED: target database configuration failed")
             return False
 
@@ -54,13 +126,14 @@ class ProcessManager:
 
         logging.info("PREREQUISITE CHECK: card PDF URL & library installed")
         card_data_url = self.api_config['card_data_url']
+        # only the first page is parsed. process_cards parses the whole PDF, or reads it from the extract cache
         data_frame =  self.data_extractor.retrieve_pdf_data(card_data_url, 1)
         if data_frame.empty:
             logging.error("PREREQUISITE CHECK FAILED: card PDF empty")
             return False
 
         logging.info("PREREQUISITE CHECK: write access to target database")
-        self.db_connector.upload_to_db(data_frame, 'test')
+        self.db_connector.upload_to_db(data_frame.head(1), 'test')
 
         if extensive:        
             logging.info("PREREQUISITE CHECK: API endpoints")
@@ -93,8 +166,8 @@ class ProcessManager:
         logging.info("PREREQUISITE CHECKS: DONE")
         return True
 
-    def initialise_threads(self, argv: dict[str, str]) -> list[threading.Thread]:
-        write_raw_data = 'write_raw' in  argv
+    def initialise_stages(self, argv: dict[str, str]) -> StageScheduler:
+        self.read_arguments(argv)
 
         # do some optinal checks to be sure we are connected to the internet and critial components can execute
         extensive_checks = 'checks_extensive' in  argv
@@ -103,107 +176,286 @@ class ProcessManager:
                 logging.error("PREREQUISITE CHECK FAILED: FAILED. Exiting.")
                 exit()
 
+        stage_scheduler = StageScheduler()
         if 'do_nothing' in argv:
             logging.info("do_nothing specified so no data to process")
-            return []
+            return stage_scheduler
 
-        # drop foreign key constrains. re-adding them later in finalise
-        self.__drop_foreign_keys()
+        # the tables are loaded into the staging schema so readers of public see the previous load until the swap.
+        # a staging schema left by a run which failed is dropped
+        self.db_connector.prepare_schema(self.staging_schema)
 
-        # since these processes are heavily io bound with different sources we can run them in parallel for a performance increase
-        thread_list = []
+        # the extraction and loading are io bound with different sources so they run in parallel on threads.
+        # the cleaning holds the GIL, so it can be sent to processes with the hybrid or processes executors
+        logging.info(f"using the {self.executor} executor")
+        if self.executor != 'threads':
+            # spawned rather than forked as the parent has threads, database connections and possibly a JVM running
+            self.process_pool = ProcessPoolExecutor(max_workers=self.api_config.get('process_max_workers', os.cpu_count()),
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=ProcessManager.initialise_process)
         # if we have specified processes on the command line, then run those; otherwise, run them all
-        for thread_function in self.thread_function_list:
-            if thread_function.__name__ in  argv:
-                if thread_list == []:
-                    logging.info("running specified processes only")
-                thread = threading.Thread(target=thread_function, args=())
-                thread_list.append(thread)
-        if thread_list == []:
-            for thread_function in self.thread_function_list:
-                thread = threading.Thread(target=thread_function, args=())
-                thread_list.append(thread)
-        return thread_list
-    
-    def finalise(self):
-        if self.need_to_add_foreign_keys:
-            logging.info("adding foreign keys to orders_table")
-            target_table = 'orders_table'
-            source_table = 'dim_products'
-            source_column = 'product_code'
-            target_column = source_column        
-            self.db_connector.add_foreign_key(target_table, target_column,
-                                              source_table, source_column)
-            source_table = 'dim_store_details'
-            source_column = 'store_code'
-            target_column = source_column        
-            self.db_connector.add_foreign_key(target_table, target_column,
-                                              source_table, source_column)
-            source_table = 'dim_card_details'
-            source_column = 'card_number'
-            target_column = source_column        
-            self.db_connector.add_foreign_key(target_table, target_column,
-                                              source_table, source_column)
-            source_table = 'dim_users'
-            source_column = 'user_uuid'
-            target_column = source_column        
-            self.db_connector.add_foreign_key(target_table, target_column,
-                                              source_table, source_column)
-            source_table = 'dim_date_times'
-            source_column = 'date_uuid'
-            target_column = source_column        
-            self.db_connector.add_foreign_key(target_table, target_column,
-                                              source_table, source_column)
-
-    def __drop_foreign_keys(self):
-        logging.info("dropping foreign keys on orders_table")
-        target_table = 'orders_table'
-        source_table = 'dim_products'
-        source_column = 'product_code'
-        self.db_connector.drop_foreign_key(target_table,
-                                           source_table, source_column)
-        source_table = 'dim_store_details'
-        source_column = 'store_code'
-        self.db_connector.drop_foreign_key(target_table,
-                                           source_table, source_column)
-        source_table = 'dim_card_details'
-        source_column = 'card_number'
-        self.db_connector.drop_foreign_key(target_table,
-                                           source_table, source_column)
-        source_table = 'dim_users'
-        source_column = 'user_uuid'
-        self.db_connector.drop_foreign_key(target_table,
-                                           source_table, source_column)
-        source_table = 'dim_date_times'
-        source_column = 'date_uuid'
-        self.db_connector.drop_foreign_key(target_table,
-                                           source_table, source_column)
-        self.need_to_add_foreign_keys = True
-
-    def __upload_to_db_raw(self, data_frame, table_name: str):
+        stage_functions = [stage_function for stage_function in self.stage_function_list
+                           if stage_function.__name__ in argv]
+        if stage_functions:
+            logging.info("running specified processes only")
+        else:
+            stage_functions = self.stage_function_list
+        for stage_function in stage_functions:
+            stage_name = stage_function.__name__
+            if self.executor == 'processes':
+                stage_function = functools.partial(self.__run_in_process, stage_name, argv,
+                                                   self.raw_snapshots.snapshot_id if self.raw_snapshots is not None else None)
+            stage_scheduler.add_stage(stage_name, functools.partial(self.__run_measured, stage_name, stage_function))
+        # a foreign key depends on the loading of orders_table and its dimension table when they are being loaded.
+        # each key is a stage of its own so it is added as soon as its two tables are loaded. the validations lock orders_table against each other,
+        # so they wait for one another rather than running in parallel
+        for source_table, source_column, dimension_stage in self.foreign_keys:
+            dependencies = [stage_name for stage_name in ['process_orders', dimension_stage]
+                            if stage_name in stage_scheduler.stage_names()]
+            stage_name = f'add_foreign_key_{source_table}'
+            stage_scheduler.add_stage(stage_name,
+                                      functools.partial(self.__run_measured, stage_name,
+                                                        functools.partial(self.__add_foreign_key, source_table, source_column)),
+                                      dependencies)
+        # the staged tables, replaced or loaded incrementally, are only swapped in once every table is loaded and every key validated,
+        # so a failed run leaves public as it was
+        stage_scheduler.add_stage('swap_staged_tables', functools.partial(self.__run_measured, 'swap_staged_tables', self.__swap_staged_tables),
+                                  stage_scheduler.stage_names())
+        return stage_scheduler
+
+    def read_arguments(self, argv: list[str], snapshot_id: str = None):
+        '''
+        Sets the options given on the command line which change how the stages run.
+            Parameters:
+                    argv (list): The command line arguments. replay reads the latest raw snapshot and replay=<snapshot id> a given one.
+                    snapshot_id (str) (optional): The raw snapshot to save in with write_raw, so that the stages run in other processes save in the same one. Defaults to a new snapshot.
+            Returns:
+                    none.
+        '''
+        self.stream_tables = 'stream' in argv
+        self.full_refresh = 'full_refresh' in argv
+        self.write_raw_data = 'write_raw' in argv
+        self.write_raw_db = 'write_raw_db' in argv
+        for executor in self.executor_modes:
+            if 'executor_'+executor in argv:
+                self.executor = executor
+        raw_snapshot_directory = self.api_config.get('raw_snapshot_directory', 'raw_snapshots')
+        replay_arguments = [argument for argument in argv if argument == 'replay' or argument.startswith('replay=')]
+        if replay_arguments:
+            replay_snapshot_id = replay_arguments[0].partition('=')[2] or RawSnapshots.latest_snapshot_id(raw_snapshot_directory)
+            if replay_snapshot_id is None:
+                raise FileNotFoundError(f"there are no raw snapshots in {raw_snapshot_directory} to replay")
+            self.replay_snapshots = RawSnapshots(raw_snapshot_directory, replay_snapshot_id)
+            if self.write_raw_data:
+                logging.warn("write_raw is ignored when replaying a raw snapshot")
+                self.write_raw_data = False
         if self.write_raw_data:
-            return self.__upload_to_db(data_frame, table_name+'_raw')
+            self.raw_snapshots = RawSnapshots(raw_snapshot_directory, snapshot_id)
+
+    def __run_measured(self, stage_name: str, stage_function):
+        with self.metrics.stage(stage_name):
+            stage_function()
+
+    # runs a whole stage in the process pool and waits for it, so the thread only waits. the metrics recorded in the process are added to this run's
+    def __run_in_process(self, stage_name: str, argv: list[str], snapshot_id: str):
+        self.metrics.merge(self.process_pool.submit(self.run_stage, stage_name, argv, snapshot_id).result())
+
+    @staticmethod
+    def initialise_process():
+        '''
+        Sets the logging format and level and turns on the pandas Copy-on-Write the cleaning is written for, for the main process and each process in the pool.
+        It is called once when a process starts, before the stages run, so the options are never changed while the stage threads are using them.
+        '''
+        logging.basicConfig(format="%(asctime)s: %(message)s",
+                            level=logging.INFO, datefmt="%H:%M:%S")
+        pd.set_option('mode.copy_on_write', True)
+
+    @classmethod
+    def run_stage(cls, stage_name: str, argv: list[str], snapshot_id: str = None):
+        '''
+        Runs one stage with a ProcessManager of its own, of the class it is called on. This is the entry point for a stage run in another process.
+            Parameters:
+                    stage_name (str): The name of the stage, such as process_users.
+                    argv (list): The command line arguments.
+                    snapshot_id (str) (optional): The raw snapshot of the run, to save the raw extract in with write_raw.
+            Returns:
+                    stages (dictionary): The metrics recorded for the stage, as the stages attribute of RunMetrics.
+        '''
+        process_manager = cls()
+        process_manager.read_arguments(argv, snapshot_id)
+        # the stage runs in this process, so its cleaning runs here too
+        process_manager.executor = 'threads'
+        with process_manager.metrics.stage(stage_name):
+            getattr(process_manager, stage_name)()
+        if not process_manager.finalise():
+            raise RuntimeError(f"{stage_name}: the raw snapshot could not be saved")
+        return process_manager.metrics.stages
+
+    # cleans a DataFrame in the process pool with the hybrid executor, pickling the DataFrame there and back
+    def __clean(self, clean_function, data_frame, **arguments):
+        with self.metrics.phase('clean'):
+            if self.executor == 'hybrid':
+                return self.process_pool.submit(clean_function, data_frame, **arguments).result()
+            return clean_function(data_frame, **arguments)
+    
+    # waits for the raw snapshots and shuts down the process pool. returns False if a raw snapshot could not be saved
+    def finalise(self) -> bool:
+        succeeded = True
+        if self.raw_snapshots is not None:
+            succeeded = self.raw_snapshots.close()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+            self.process_pool = None
+        return succeeded
+
+    # adds the foreign key for each table being staged. a staged orders_table references the staged or the public dimension table.
+    # the public orders_table gets a second key, renamed by the swap, referencing a staged dimension table
+    def __add_foreign_key(self, source_table: str, source_column: str):
+        staged_source = self.db_connector.table_exists(source_table, self.staging_schema)
+        source_schema = self.staging_schema if staged_source else 'public'
+        if self.db_connector.table_exists('orders_table', self.staging_schema):
+            logging.info(f"adding foreign key to the staged orders_table for {source_table}")
+            self.db_connector.add_foreign_key('orders_table', source_column, source_table, source_column,
+                                              self.staging_schema, source_schema)
+        elif staged_source and self.db_connector.table_exists('orders_table'):
+            logging.info(f"adding foreign key to orders_table for the staged {source_table}")
+            self.db_connector.add_foreign_key('orders_table', source_column, source_table, source_column,
+                                              'public', source_schema, f'fk_{source_table}_{source_column}_staged')
+
+    def __swap_staged_tables(self):
+        table_names = self.db_connector.swap_schema_tables(self.staging_schema)
+        logging.info(f"swapped the staged tables into public: {', '.join(table_names) or 'none'}")
+
+    # reads a source from the replayed raw snapshot rather than extracting it when replaying
+    def __extract(self, table_name: str, extract_function, *arguments, **keyword_arguments):
+        with self.metrics.phase('extract'):
+            if self.replay_snapshots is not None:
+                logging.info(f"{table_name}: replaying the raw snapshot {self.replay_snapshots.snapshot_id}")
+                return self.replay_snapshots.read(table_name)
+            return extract_function(*arguments, **keyword_arguments)
+
+    def __extract_chunks(self, table_name: str, extract_function, *arguments, **keyword_arguments):
+        if self.replay_snapshots is not None:
+            logging.info(f"{table_name}: replaying the raw snapshot {self.replay_snapshots.snapshot_id} in chunks")
+            return self.replay_snapshots.read_chunks(table_name, self.stream_chunk_size)
+        return extract_function(*arguments, **keyword_arguments)
+
+    # saves the raw extract in the run's snapshot on a background thread, and in a _raw table with write_raw_db
+    def __save_raw(self, data_frame, table_name: str):
+        if self.raw_snapshots is not None:
+            self.raw_snapshots.write(table_name, data_frame)
+        if self.write_raw_db:
+            self.__upload_to_db(data_frame, table_name+'_raw', None)
         return data_frame.shape[0]
     def __upload_to_db(self, data_frame, table_name, start_size,
                        dtypes=None, primary_key=None):
         if start_size is not None:
-            reduction_percent = 100-100*data_frame.shape[0]/start_size
-            if reduction_percent > 10:
-                logging.warn(f"{table_name}: {start_size} rows -> {data_frame.shape[0]} rows = {round( reduction_percent,1)}% SIGNIFICANT  reduction")
-            elif reduction_percent > 0:
-                logging.info(f"{table_name}: {start_size} rows -> {data_frame.shape[0]} rows = {round( reduction_percent,1)}%  reduction")
+            self.__log_reduction(table_name, start_size, data_frame.shape[0])
+            self.metrics.add_rows(start_size, data_frame.shape[0])
+            self.metrics.profile_columns(data_frame)
+            self.__record_memory(table_name, data_frame)
         logging.info("saving to database in "+table_name)
-        self.db_connector.upload_to_db(data_frame, table_name, dtypes, primary_key)
+        with self.metrics.phase('load'):
+            if primary_key is None:
+                # without a key the rows can not be matched to the last load, so orders_table is always replaced
+                self.db_connector.upload_to_db(data_frame, table_name, dtypes, primary_key, schema=self.staging_schema)
+            else:
+                # a replaced table, and the changes of an incremental load applied to a copy of the public table, are staged
+                load = self.db_connector.upsert_to_db(data_frame, table_name, dtypes, primary_key, self.full_refresh,
+                                                      self.staging_schema)
+                logging.info(f"{table_name}: {load['mode']} load, {load['inserted']} rows inserted, {load['updated']} updated, {load['deleted']} deleted, {load['unchanged']} unchanged")
         return data_frame.shape[0]
 
+    # records and logs the memory used by a cleaned table with its compact types and what it would use without them
+    def __record_memory(self, table_name, data_frame):
+        memory_bytes, memory_bytes_uncompacted = DataCleaning.memory_footprint(data_frame)
+        self.metrics.add_memory(memory_bytes, memory_bytes_uncompacted)
+        logging.info(f"{table_name}: {round(memory_bytes/2**20, 1)} MB in memory, {round(memory_bytes_uncompacted/2**20, 1)} MB without compact types")
+
+    # the version of a table's source for the schema cache: the replayed snapshot, or the hash of the cached extract.
+    # None when the source has no version, such as an RDS table, so its schema is always inferred
+    def __source_version(self, source: str = None):
+        if self.replay_snapshots is not None:
+            return 'snapshot:' + self.replay_snapshots.snapshot_id
+        if source is not None and self.data_extractor.extract_cache is not None:
+            return self.data_extractor.extract_cache.version(source)
+        return None
+
+    def __infer_dtypes(self, data_frame, table_name: str, overrides: dict, source: str = None) -> dict:
+        with self.metrics.step('schema'):
+            return self.schema_inferrer.infer(data_frame, overrides, table_name, self.__source_version(source))
+
+    def __log_reduction(self, table_name, start_size, end_size):
+        reduction_percent = 100-100*end_size/start_size
+        if reduction_percent > 10:
+            logging.warn(f"{table_name}: {start_size} rows -> {end_size} rows = {round( reduction_percent,1)}% SIGNIFICANT  reduction")
+        elif reduction_percent > 0:
+            logging.info(f"{table_name}: {start_size} rows -> {end_size} rows = {round( reduction_percent,1)}%  reduction")
+
+    # clean and save a source table one chunk at a time so memory use depends on stream_chunk_size rather than the table size
+    def __process_table_streamed(self, data_frames, table_name, clean_function,
+                                 overrides, primary_key=None):
+        if self.write_raw_data or self.write_raw_db:
+            logging.warn(f"{table_name}: raw data is not written when streaming")
+        dtypes = None
+        varchar_columns, integer_columns = [], []
+        start_size = 0
+        if_exists = 'replace'
+        data_frames = iter(data_frames)
+        while True:
+            # the chunks are read as they are asked for, so the extraction is timed a chunk at a time
+            with self.metrics.phase('extract'):
+                data_frame = next(data_frames, None)
+            if data_frame is None:
+                break
+            start_size += data_frame.shape[0]
+            data_frame = self.__clean(clean_function, data_frame, whole_table=False)
+            # the duplicate key of each row is loaded with it and dropped once the duplicates are removed
+            cleaned_data_frame = data_frame.drop(columns=[DataCleaning.duplicate_key_column])
+            if dtypes is None:
+                # the types are inferred from the first chunk. the VARCHAR lengths are not known until all the chunks are saved, so start with TEXT and fit them at the end
+                with self.metrics.step('schema'):
+                    dtypes = self.schema_inferrer.infer(cleaned_data_frame, overrides, streamed=True)
+                varchar_columns = [column for column, dtype in dtypes.items() if type(dtype) is types.TEXT and data_frame[column].notna().any()]
+                integer_columns = [column for column, dtype in dtypes.items() if type(dtype) is types.BIGINT and column not in overrides]
+                dtypes = dtypes | {DataCleaning.duplicate_key_column: types.BIGINT}
+            with self.metrics.phase('load'):
+                self.metrics.profile_columns(cleaned_data_frame)
+                self.metrics.add_memory(*DataCleaning.memory_footprint(cleaned_data_frame))
+                self.db_connector.upload_to_db(data_frame, table_name, dtypes, if_exists=if_exists, schema=self.staging_schema)
+            if_exists = 'append'
+        # finish the cleaning steps which need the whole table in the database. the duplicates are found by the key each row had at the point
+        # the in-memory path finds them, so the same rows are kept as when the table is cleaned whole: the first of each, as the chunks are loaded in order
+        with self.metrics.phase('load'):
+            self.db_connector.remove_duplicate_rows(table_name, [DataCleaning.duplicate_key_column], self.staging_schema)
+            self.db_connector.drop_columns(table_name, [DataCleaning.duplicate_key_column], self.staging_schema)
+            self.db_connector.drop_empty_columns(table_name, self.staging_schema)
+            self.db_connector.fit_varchar_columns(table_name, varchar_columns, self.staging_schema)
+            self.db_connector.fit_integer_columns(table_name, integer_columns, self.staging_schema)
+            if primary_key is not None:
+                self.db_connector.add_primary_key(table_name, primary_key, self.staging_schema)
+            end_size = self.db_connector.count_rows(table_name, self.staging_schema)
+        self.__log_reduction(table_name, start_size, end_size)
+        self.metrics.add_rows(start_size, end_size)
+
     def process_users(self):
-        logging.info("USERS: reading data from AWS database")
         source_table = 'legacy_users'
-        data_frame =  self.data_extractor.read_rds_table(self.db_connector, source_table)
-        logging.info("USERS: cleaning data")
+        # the other types are inferred from the data
+        overrides = {'first_name': types.VARCHAR(255), 'last_name': types.VARCHAR(255), 'user_uuid': self.key_types['user_uuid']}
+        if self.stream_tables:
+            logging.info("USERS: streaming data from AWS database")
+            data_frames = self.__extract_chunks('dim_users', self.data_extractor.read_rds_table_chunks,
+                                                self.db_connector, source_table, self.stream_chunk_size)
+            self.__process_table_streamed(data_frames, 'dim_users', self.data_cleaning.clean_user_data,
+                                          overrides, 'user_uuid')
+            logging.info("USERS: DONE")
+            return
+        logging.info("USERS: reading data from AWS database")
         table_name = "dim_users"
-        start_size = self.__upload_to_db_raw(data_frame, table_name)
-        data_frame =  self.data_cleaning.clean_user_data(data_frame)
+        data_frame =  self.__extract(table_name, self.data_extractor.read_rds_table, self.db_connector, source_table, use_copy=True)
+        logging.info("USERS: cleaning data")
+        start_size = self.__save_raw(data_frame, table_name)
+        data_frame =  self.__clean(self.data_cleaning.clean_user_data, data_frame)
 
         # convert types as specified in milestone 3
         # | first_name     | TEXT               | VARCHAR(255)       |
@@ -212,22 +464,28 @@ class ProcessManager:
         # | country_code   | TEXT               | VARCHAR(?)         |
         # | user_uuid      | TEXT               | UUID               |
         # | join_date      | TEXT               | DATE               |
-        country_code_max_len = data_frame.country_code.map(lambda x: len(x)).max()
-        dtypes={'first_name': types.VARCHAR(255), 'last_name': types.VARCHAR(255),
-                'country_code': types.VARCHAR(country_code_max_len),
-            'date_of_birth': types.DATE, 'join_date': types.DATE,
-            'user_uuid': types.UUID}
+        dtypes = self.__infer_dtypes(data_frame, table_name, overrides)
         self.__upload_to_db(data_frame, table_name, start_size, dtypes, 'user_uuid')
         logging.info("USERS: DONE")
 
     def process_orders(self):
-        logging.info("ORDERS: reading data from AWS database")
         source_table = 'orders_table'
-        data_frame =  self.data_extractor.read_rds_table(self.db_connector, source_table)
-        logging.info("ORDERS: cleaning data")
+        # the quantity is SMALLINT by the specification and the keys have the types of the tables they reference. the other types are inferred from the data
+        overrides = {'product_quantity': types.SMALLINT} | self.key_types
+        if self.stream_tables:
+            logging.info("ORDERS: streaming data from AWS database")
+            data_frames = self.__extract_chunks('orders_table', self.data_extractor.read_rds_table_chunks,
+                                                self.db_connector, source_table, self.stream_chunk_size)
+            self.__process_table_streamed(data_frames, 'orders_table', self.data_cleaning.clean_orders_data,
+                                          overrides)
+            logging.info("ORDERS: DONE. Foreign Keys to be added next.")
+            return
+        logging.info("ORDERS: reading data from AWS database")
         table_name = 'orders_table'
-        start_size = self.__upload_to_db_raw(data_frame, table_name)
-        data_frame =  self.data_cleaning.clean_orders_data(data_frame)
+        data_frame =  self.__extract(table_name, self.data_extractor.read_rds_table, self.db_connector, source_table)
+        logging.info("ORDERS: cleaning data")
+        start_size = self.__save_raw(data_frame, table_name)
+        data_frame =  self.__clean(self.data_cleaning.clean_orders_data, data_frame)
 
         # convert types as specified in milestone 3
         # | date_uuid        | TEXT               | UUID               |
@@ -236,37 +494,25 @@ class ProcessManager:
         # | store_code       | TEXT               | VARCHAR(?)         |
         # | product_code     | TEXT               | VARCHAR(?)         |
         # | product_quantity | BIGINT             | SMALLINT           |
-        store_code_max_len = data_frame.store_code.map(lambda x: len(x)).max()
-        card_number_max_len = data_frame.card_number.map(lambda x: len(str(x))).max()
-        product_code_max_len = data_frame.product_code.map(lambda x: len(str(x))).max()
-        dtypes={'store_code': types.VARCHAR(store_code_max_len), 
-                'card_number': types.VARCHAR(card_number_max_len), 
-                'product_code': types.VARCHAR(product_code_max_len),
-                'product_quantity': types.SMALLINT, 
-                'date_uuid': types.UUID, 
-                'user_uuid': types.UUID}
+        dtypes = self.__infer_dtypes(data_frame, table_name, overrides)
         self.__upload_to_db(data_frame, table_name, start_size, dtypes)
-        self.need_to_add_foreign_keys = True
         logging.info("ORDERS: DONE. Foreign Keys to be added next.")
 
     def process_cards(self):
         logging.info("CARDS: reading data from HTTPS PDF")
         card_data_url = self.api_config['card_data_url']
-        data_frame =  self.data_extractor.retrieve_pdf_data(card_data_url)
-        logging.info("CARDS: cleaning data")
         table_name = 'dim_card_details'
-        start_size = self.__upload_to_db_raw(data_frame, table_name)
-        data_frame =  self.data_cleaning.clean_card_data(data_frame)
+        data_frame =  self.__extract(table_name, self.data_extractor.retrieve_pdf_data, card_data_url,
+                                     max_workers=self.api_config.get('pdf_max_workers'))
+        logging.info("CARDS: cleaning data")
+        start_size = self.__save_raw(data_frame, table_name)
+        data_frame =  self.__clean(self.data_cleaning.clean_card_data, data_frame)
 
         # convert types as specified in milestone 3
         # | card_number            | TEXT              | VARCHAR(?)         |
         # | expiry_date            | TEXT              | VARCHAR(?)         |
         # | date_payment_confirmed | TEXT              | DATE               |
-        card_number_max_len = data_frame.card_number.map(lambda x: len(str(x))).max()
-        expiry_date_max_len = data_frame.expiry_date.map(lambda x: len(str(x))).max()
-        dtypes={'card_number': types.VARCHAR(card_number_max_len), 
-                'expiry_date': types.VARCHAR(expiry_date_max_len), 
-                'date_payment_confirmed': types.DATE}
+        dtypes = self.__infer_dtypes(data_frame, table_name, {'card_number': self.key_types['card_number']}, card_data_url)
         self.__upload_to_db(data_frame, table_name, start_size, dtypes, 'card_number')
         logging.info("CARDS: DONE")
 
@@ -275,15 +521,13 @@ class ProcessManager:
         api_header_dict = {'x-api-key': self.api_config['stores_api_key']}
         number_stores_url = self.api_config['number_stores_url']
         store_data_template = self.api_config['store_data_template']
-        number_of_stores =  self.data_extractor.list_number_of_stores(api_header_dict, 
-                                                                      number_stores_url)
-        data_frame =  self.data_extractor.retrieve_stores_data(api_header_dict, 
-                                                               store_data_template, 
-                                                               number_of_stores)
-        logging.info("STORES: cleaning data")
+        stores_max_workers = self.api_config.get('stores_max_workers', 16)
         table_name = 'dim_store_details'
-        start_size = self.__upload_to_db_raw(data_frame, table_name)
-        data_frame =  self.data_cleaning.clean_store_data(data_frame)
+        data_frame =  self.__extract(table_name, self.__retrieve_stores, api_header_dict, number_stores_url,
+                                     store_data_template, stores_max_workers)
+        logging.info("STORES: cleaning data")
+        start_size = self.__save_raw(data_frame, table_name)
+        data_frame =  self.__clean(self.data_cleaning.clean_store_data, data_frame)
 
         # convert types as specified in milestone 3
         # | longitude           | TEXT              | FLOAT                  |
@@ -295,29 +539,44 @@ class ProcessManager:
         # | latitude            | TEXT              | FLOAT                  |
         # | country_code        | TEXT              | VARCHAR(?)             |
         # | continent           | TEXT              | VARCHAR(255)           |
-        store_code_max_len = data_frame.store_code.map(lambda x: len(x)).max()
-        country_code_max_len = data_frame.country_code.map(lambda x: len(x)).max()
-        dtypes={'store_code': types.VARCHAR(store_code_max_len),
-            'locality': types.VARCHAR(255), 
-            'country_code': types.VARCHAR(country_code_max_len),
-            'continent': types.VARCHAR(255),
-            'staff_numbers': types.SMALLINT,
-            'opening_date': types.DATE,
-            'longitude': types.FLOAT,
-            'latitude': types.FLOAT
-            }
+        # the dates and coordinates which could not be parsed are left as strings by the cleaning, and are converted by the database
+        overrides = {'locality': types.VARCHAR(255), 'continent': types.VARCHAR(255),
+                     'opening_date': types.DATE, 'longitude': types.FLOAT, 'latitude': types.FLOAT, 'store_code': self.key_types['store_code']}
+        dtypes = self.__infer_dtypes(data_frame, table_name, overrides)
         self.__upload_to_db(data_frame, table_name, start_size, 
                             dtypes, 'store_code')
         logging.info("STORES: DONE")
 
+    def __retrieve_stores(self, api_header_dict, number_stores_url, store_data_template, stores_max_workers):
+        number_of_stores =  self.data_extractor.list_number_of_stores(api_header_dict, 
+                                                                      number_stores_url)
+        return self.data_extractor.retrieve_stores_data(api_header_dict, 
+                                                        store_data_template, 
+                                                        number_of_stores,
+                                                        stores_max_workers)
+
     def process_products(self):
-        logging.info("PRODUCTS: reading data from S3")
         products_csv_uri = self.api_config['products_csv_uri']
-        data_frame =  self.data_extractor.extract_from_s3(products_csv_uri)
-        logging.info("PRODUCTS: cleaning data")
+        # the currency symbols are one character and the EAN numbers are text sized to the longest. the other types are inferred from the data
+        overrides = {'currency': types.VARCHAR(3), 'EAN': types.VARCHAR, 'product_code': self.key_types['product_code']}
+        if self.stream_tables:
+            logging.info("PRODUCTS: streaming data from S3")
+            # declared so every chunk has the same types. the text columns stay as strings as the cleaning expects
+            csv_dtypes = {'Unnamed: 0': 'int64', 'product_name': object, 'product_price': object, 'weight': object,
+                          'category': object, 'EAN': object, 'date_added': object, 'uuid': object,
+                          'removed': object, 'product_code': object}
+            data_frames = self.__extract_chunks('dim_products', self.data_extractor.extract_from_s3_chunks,
+                                                products_csv_uri, self.stream_chunk_size, csv_dtypes)
+            self.__process_table_streamed(data_frames, 'dim_products', self.data_cleaning.clean_products_data,
+                                          overrides, 'product_code')
+            logging.info("PRODUCTS: DONE")
+            return
+        logging.info("PRODUCTS: reading data from S3")
         table_name = 'dim_products'
-        start_size = self.__upload_to_db_raw(data_frame, table_name)
-        data_frame =  self.data_cleaning.clean_products_data(data_frame)
+        data_frame =  self.__extract(table_name, self.data_extractor.extract_from_s3, products_csv_uri)
+        logging.info("PRODUCTS: cleaning data")
+        start_size = self.__save_raw(data_frame, table_name)
+        data_frame =  self.__clean(self.data_cleaning.clean_products_data, data_frame)
 
         # convert types as specified in milestone 3
         # | product_price   | TEXT               | FLOAT              |
@@ -328,17 +587,7 @@ class ProcessManager:
         # | uuid            | TEXT               | UUID               |
         # | still_available | TEXT               | BOOL               |
         # | weight_class    | TEXT               | VARCHAR(?)         |
-        EAN_max_len = data_frame.EAN.map(lambda x: len(str(x))).max()
-        product_code_max_len = data_frame.product_code.map(lambda x: len(str(x))).max()
-        weight_class_max_len = data_frame.weight_class.map(lambda x: len(x)).max()
-        dtypes={'EAN': types.VARCHAR(EAN_max_len), 
-                'product_code': types.VARCHAR(product_code_max_len),
-                'weight_class': types.VARCHAR(weight_class_max_len),
-                'continent': types.VARCHAR(255),
-                'uuid': types.UUID, 'date_added': types.DATE,
-                'product_price': types.FLOAT, 'weight': types.FLOAT,
-                'currency': types.VARCHAR(3)
-            }
+        dtypes = self.__infer_dtypes(data_frame, table_name, overrides, products_csv_uri)
         self.__upload_to_db(data_frame, table_name, start_size,
                             dtypes, 'product_code')
         logging.info("PRODUCTS: DONE")
@@ -346,11 +595,11 @@ class ProcessManager:
     def process_times(self):
         logging.info("TIME: reading data from HTTPS")
         date_details_url = self.api_config['date_details_url']
-        data_frame =  self.data_extractor.extract_from_json(date_details_url)
-        logging.info("TIME: cleaning data")
         table_name = 'dim_date_times'
-        start_size = self.__upload_to_db_raw(data_frame, table_name)
-        data_frame =  self.data_cleaning.clean_time_data(data_frame)
+        data_frame =  self.__extract(table_name, self.data_extractor.extract_from_json, date_details_url)
+        logging.info("TIME: cleaning data")
+        start_size = self.__save_raw(data_frame, table_name)
+        data_frame =  self.__clean(self.data_cleaning.clean_time_data, data_frame)
 
         # | month, year, day & time period
         #   The above have already been handled during the data cleansing
@@ -358,6 +607,6 @@ class ProcessManager:
         #   This has made working with dates/times in the database
         #   straightforward for sorting and grouping.
         # | date_uuid       | TEXT              | UUID               |
-        dtypes={'date_uuid': types.UUID}
+        dtypes = self.__infer_dtypes(data_frame, table_name, {'date_uuid': self.key_types['date_uuid']}, date_details_url)
         self.__upload_to_db(data_frame, table_name, start_size, dtypes, 'date_uuid')
         logging.info("TIME: DONE")
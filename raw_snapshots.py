@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import threading
+import time
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from parquet_frames import ParquetFrames
+
+
+class RawSnapshots:
+    '''
+    Saves the raw extracts of a run as a snapshot, one Parquet file per table in a directory named by the snapshot id, and reads them back to replay a run.
+    The files keep the DataFrames as extracted, including the object columns holding a mix of strings and numbers (see ParquetFrames).
+    Snapshots are written by a background thread so a stage only waits for the DataFrame to be copied, and each file is written under a temporary name first.
+    Each table has a JSON file next to it with its rows and columns, written once the table is complete, so that processes can save tables in the same snapshot.
+    '''
+    file_extension = '.parquet'
+    description_extension = '.json'
+
+    def __init__(self, directory='raw_snapshots', snapshot_id: str = None):
+        self.directory = directory
+        # a new snapshot is named by the time it was started, so the latest snapshot sorts last
+        self.snapshot_id = snapshot_id or time.strftime('%Y%m%dT%H%M%S')
+        self.snapshot_directory = os.path.join(directory, self.snapshot_id)
+        self.__lock = threading.Lock()
+        self.__writer = None
+        self.__pending_writes = []
+
+    @staticmethod
+    def latest_snapshot_id(directory='raw_snapshots') -> str:
+        '''
+        Returns the id of the most recent snapshot with a complete table, or None if there is none.
+            Parameters:
+                    directory (str) (optional): The directory the snapshots are saved in. Defaults to 'raw_snapshots'.
+            Returns:
+                    snapshot_id (str): The name of the snapshot's directory.
+        '''
+        try:
+            snapshot_ids = sorted(snapshot_id for snapshot_id in os.listdir(directory)
+                                  if RawSnapshots(directory, snapshot_id).read_manifest()['tables'])
+        except OSError:
+            return None
+        return snapshot_ids[-1] if snapshot_ids else None
+
+    def __table_path(self, table_name: str) -> str:
+        return os.path.join(self.snapshot_directory, table_name + self.file_extension)
+
+    def __write_table(self, table_name: str, data_frame: pd.DataFrame):
+        table_path = self.__table_path(table_name)
+        ParquetFrames.write(data_frame, table_path + '.tmp')
+        os.replace(table_path + '.tmp', table_path)
+        description_path = os.path.join(self.snapshot_directory, table_name + self.description_extension)
+        with open(description_path + '.tmp', 'w') as file:
+            json.dump({'rows': data_frame.shape[0], 'columns': [str(column) for column in data_frame.columns],
+                       'bytes': os.path.getsize(table_path)}, file)
+        os.replace(description_path + '.tmp', description_path)
+        logging.info(f"{table_name}: raw snapshot saved in {table_path}")
+
+    def read_manifest(self) -> dict:
+        '''
+        Returns the manifest of the snapshot: its id and the rows, columns and file size of each complete table in it.
+        '''
+        tables = {}
+        try:
+            file_names = sorted(os.listdir(self.snapshot_directory))
+        except OSError:
+            file_names = []
+        for file_name in file_names:
+            if file_name.endswith(self.description_extension):
+                with open(os.path.join(self.snapshot_directory, file_name), 'r') as file:
+                    tables[file_name[:-len(self.description_extension)]] = json.load(file)
+        return {'snapshot_id': self.snapshot_id, 'tables': tables}
+
+    def write(self, table_name: str, data_frame: pd.DataFrame):
+        '''
+        Saves a raw extract in the snapshot on the background writer.
+        The writer is given a copy of the DataFrame so it keeps the extract as it was if the caller changes the DataFrame. Under Copy-on-Write it is a shallow copy sharing the extract's data.
+            Parameters:
+                    table_name (str): The table the extract is cleaned into, such as dim_users.
+                    data_frame (Pandas dataframe): The raw extract.
+        '''
+        data_frame = data_frame.copy(deep=not pd.get_option('mode.copy_on_write'))
+        with self.__lock:
+            if self.__writer is None:
+                os.makedirs(self.snapshot_directory, exist_ok=True)
+                # one thread, so the snapshots are compressed one at a time alongside the stages rather than competing with them
+                self.__writer = ThreadPoolExecutor(max_workers=1)
+            self.__pending_writes.append((table_name, self.__writer.submit(self.__write_table, table_name, data_frame)))
+
+    def close(self) -> bool:
+        '''
+        Waits for the snapshots still being written.
+            Parameters:
+                    none.
+            Returns:
+                    succeeded (bool): False if any snapshot could not be written. The errors are logged.
+        '''
+        with self.__lock:
+            pending_writes, self.__pending_writes = self.__pending_writes, []
+            writer, self.__writer = self.__writer, None
+        succeeded = True
+        for table_name, pending_write in pending_writes:
+            try:
+                pending_write.result()
+            except Exception:
+                logging.exception(f"{table_name}: raw snapshot FAILED")
+                succeeded = False
+        if writer is not None:
+            writer.shutdown()
+        return succeeded
+
+    def read(self, table_name: str) -> pd.DataFrame:
+        '''
+        Reads a raw extract saved in the snapshot.
+            Parameters:
+                    table_name (str): The table the extract is cleaned into, such as dim_users.
+            Returns:
+                    data_frame (Pandas dataframe): The raw extract as it was saved.
+        '''
+        if table_name not in self.read_manifest()['tables']:
+            raise FileNotFoundError(f"{table_name} is not in the raw snapshot {self.snapshot_directory}")
+        return ParquetFrames.read(self.__table_path(table_name))
+
+    def read_chunks(self, table_name: str, chunk_size=50000):
+        '''
+        Reads a raw extract saved in the snapshot in chunks, as a streamed table is extracted.
+            Parameters:
+                    table_name (str): The table the extract is cleaned into, such as dim_users.
+                    chunk_size (int) (optional): The number of rows in each chunk. Defaults to 50000.
+            Yields:
+                    data_frame (Pandas dataframe): The next chunk of rows, which can be cleaned in place. Under Copy-on-Write a chunk shares the rows of the extract until it is changed.
+        '''
+        data_frame = self.read(table_name)
+        for start_row in range(0, data_frame.shape[0], chunk_size):
+            yield data_frame.iloc[start_row:start_row+chunk_size].copy(deep=not pd.get_option('mode.copy_on_write'))
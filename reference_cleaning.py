@@ -0,0 +1,115 @@
+import pandas as pd
+import re
+from phone_number_formatter import PhoneNumberFormatter
+
+
+# the original cell by cell implementations of the DataCleaning steps which have been vectorised.
+# these are kept as the reference the unit tests check the vectorised versions against and the benchmarks time them against.
+class ReferenceCleaning:
+    def replace_null_strings(self, cell_value):
+        if type(cell_value) == str and cell_value.lower() in ['null','none', 'nan']:
+            cell_value = None
+        return cell_value
+
+    def remove_nonnumeric_characters(self, cell_value):
+        if type(cell_value) == str:
+            cell_value = re.sub("[^0-9.]", "",cell_value)
+            if cell_value == '':
+                cell_value = None
+        return cell_value
+
+    def reformat_phone_data(self, data_frame: pd.DataFrame, column_name: str):
+        regex_expression = r'^(?:(?:\(?(?:0(?:0|11)\)?[\s-]?\(?|\+)44\)?[\s-]?(?:\(?0\)?[\s-]?)?)|(?:\(?0))(?:(?:\d{5}\)?[\s-]?\d{4,5})|(?:\d{4}\)?[\s-]?(?:\d{5}|\d{3}[\s-]?\d{3}))|(?:\d{3}\)?[\s-]?\d{3}[\s-]?\d{3,4})|(?:\d{2}\)?[\s-]?\d{4}[\s-]?\d{4}))(?:[\s-]?(?:x|ext\.?|\#)\d{3,4})?$'
+        data_frame.loc[~data_frame[column_name].str.match(regex_expression), column_name] = None # For every row where the column_name column does not match our regular expression, replace the value with None/null
+        data_frame[column_name] = data_frame[column_name].replace({r'\+44(0)': '0',r'\+44': '0', r'\(': '', r'\)': '', r'-': '', r' ': ''}, regex=True)
+
+    # the PhoneNumberFormatter numbering plans applied to one number at a time
+    def format_phone_number(self, phone_number, country_code):
+        if type(phone_number) != str:
+            return None
+        if country_code not in ['GB', 'US', 'DE']:
+            country_code = PhoneNumberFormatter.default_plan
+        if country_code == 'GB':
+            if PhoneNumberFormatter.gb_pattern.match(phone_number) is None:
+                return None
+            if '+44' in phone_number:
+                phone_number = phone_number.replace('+44(0)', '0').replace('+440', '0').replace('+44', '0')
+            return phone_number.replace('(', '').replace(')', '').replace('-', '').replace(' ', '')
+        if country_code == 'US':
+            match = PhoneNumberFormatter.us_pattern.match(phone_number)
+            if match is None:
+                return None
+            area_code, exchange, line, extension = match.groups()
+            return f'{area_code}{exchange}{line}' + (f'x{extension}' if extension else '')
+        match = PhoneNumberFormatter.de_pattern.match(phone_number)
+        if match is None:
+            return None
+        national_number = re.sub(r'\D', '', match.group(1))
+        if not 6 <= len(national_number) <= 13:
+            return None
+        return '0' + national_number.lstrip('0')
+
+    def handle_nulls_empties_and_duplicates(self, data_frame: pd.DataFrame) -> pd.DataFrame:
+        for column in data_frame.columns:
+                data_frame[column] = data_frame[column].apply(self.replace_null_strings)
+        data_frame.drop_duplicates(inplace=True)
+        data_frame.dropna(how="all", axis=1, inplace=True)
+        data_frame.dropna(how="all", axis=0, inplace=True)
+        return data_frame
+
+    # Convert a weights to a decimal value represented in kg
+    def convert_product_weight(self, raw_weight):
+        '''
+        Convert a weight to a decimal value represented in kg. If no units specified, presumes the weight is already in kg.
+        For ml, a 1:1 ratio of ml to g is used as a rough estimate for the rows containing ml.
+            Parameters:
+                    raw_weight (object): The weight cell value.
+            Returns:
+                    weight_in_kg (float): The weight in kg or None if the input value could not be converted.
+        '''
+        if type(raw_weight) != str:
+            try:
+                return abs(float(raw_weight))
+            except (TypeError, ValueError):
+                return None
+        # clean up characters that won't impact the value
+        new_weight = raw_weight.replace(' ', '')
+        if new_weight.endswith('.'):
+            new_weight = new_weight[:len(new_weight)-1]
+        # determine if we have multiple weights to handle
+        divisor = 1
+        new_weight_split = new_weight.split('x')
+        if len(new_weight_split) > 1:
+            new_weight = new_weight_split[1]
+            try:
+                divisor = 1/float(new_weight_split[0])
+            except (ValueError, ZeroDivisionError):
+                return None
+        # convert known units to kg and remove the unit designation
+        if new_weight.endswith('kg'):
+            new_weight = new_weight.replace('kg', '')
+        elif new_weight.endswith('g') or new_weight.endswith('ml'):
+            new_weight = new_weight.replace('g', '').replace('ml', '')
+            divisor = 1000
+        # try the value as a float and consider mathmatic adjustments. if it fails, it is bad data
+        try:
+            weight_in_kg = abs(float(new_weight)/divisor)
+            return weight_in_kg
+        except ValueError:
+            return None
+
+    def assign_weight_class(self, weight: int) -> str:
+        if weight < 2:
+            return 'Light'
+        if weight < 40:
+            return 'Mid_Sized'
+        if weight < 140:
+            return 'Heavy'
+        return 'Truck_Required'
+
+    def clean_time_data(self, data_frame: pd.DataFrame) -> pd.DataFrame:
+        data_frame['date_timestamp'] = data_frame['year'] + '-' + data_frame['month'] + '-' + data_frame['day'] + ' ' + data_frame['timestamp']
+        data_frame['date_timestamp'] = pd.to_datetime(data_frame['date_timestamp'], errors='coerce')
+        data_frame.drop(['year', 'month', 'day', 'timestamp'], axis=1, inplace=True)
+        data_frame.dropna(inplace=True)
+        return data_frame
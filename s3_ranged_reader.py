@@ -0,0 +1,61 @@
+import collections
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+
+class S3RangedReader(io.RawIOBase):
+    '''
+    Reads an S3 object as a file, downloading it in parts with ranged GETs.
+    Up to max_workers parts are downloaded ahead of the reader at once, so a large object is downloaded concurrently while only those parts are held in memory.
+    Every part is requested with the ETag of the first request so that an object replaced part way through fails rather than mixing two versions.
+    '''
+    def __init__(self, s3client, bucket: str, key: str, part_size=8*1024*1024, max_workers=4):
+        super().__init__()
+        self.s3client = s3client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_workers = max_workers
+        head = s3client.head_object(Bucket=bucket, Key=key)
+        self.size = head['ContentLength']
+        self.etag = head.get('ETag')
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__parts = self.__download_parts()
+        self.__part = memoryview(b'')
+
+    def __get_range(self, start: int, end: int) -> bytes:
+        arguments = {'Bucket': self.bucket, 'Key': self.key, 'Range': f'bytes={start}-{end}'}
+        if self.etag:
+            arguments['IfMatch'] = self.etag
+        return self.s3client.get_object(**arguments)['Body'].read()
+
+    # yields the parts in order, keeping up to max_workers of the following parts downloading
+    def __download_parts(self):
+        downloads = collections.deque()
+        for start in range(0, self.size, self.part_size):
+            end = min(start + self.part_size, self.size) - 1
+            downloads.append(self.__executor.submit(self.__get_range, start, end))
+            if len(downloads) > self.max_workers:
+                yield downloads.popleft().result()
+        while downloads:
+            yield downloads.popleft().result()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.__part:
+            part = next(self.__parts, None)
+            if part is None:
+                return 0
+            self.__part = memoryview(part)
+        size = min(len(buffer), len(self.__part))
+        buffer[:size] = self.__part[:size]
+        self.__part = self.__part[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.__parts.close()
+            self.__executor.shutdown(wait=True, cancel_futures=True)
+        super().close()
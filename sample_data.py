@@ -0,0 +1,292 @@
+import numpy as np
+import pandas as pd
+
+
+# generated data shaped like the legacy sources for use in the unit tests and benchmarks. No credentials or network access are needed.
+def store_records(number_of_stores: int, seed=0) -> list[dict]:
+    '''
+    Generates store detail records in the shape returned by the store details API, including some of the known bad values.
+        Parameters:
+                number_of_stores (int): The number of records to generate.
+                seed (int) (optional): Random seed so the same records are generated each time. Defaults to 0.
+        Returns:
+                store_records (list): A list of dictionaries, one per store.
+    '''
+    rng = np.random.default_rng(seed)
+    store_types = ['Mall Kiosk', 'Super Store', 'Local', 'Web Portal', 'Outlet', 'NULL', 'QP74AHEQT0']
+    continents = ['Europe', 'America', 'eeEurope', 'eeAmerica']
+    records = []
+    for store_number in range(number_of_stores):
+        records.append({'index': store_number,
+                        'address': f'{store_number} High Street\nLondon\nE1 {store_number % 9}AA',
+                        'longitude': str(round(rng.uniform(-120, 20), 5)) if store_number % 50 else 'N/A',
+                        'lat': None,
+                        'locality': 'London',
+                        'store_code': f'ST-{store_number:06X}',
+                        'staff_numbers': str(rng.integers(1, 400)) + ('e' if store_number % 97 == 0 else ''),
+                        'opening_date': '2010-06-12' if store_number % 3 else 'October 2012 08',
+                        'store_type': store_types[store_number % len(store_types)],
+                        'latitude': str(round(rng.uniform(-40, 60), 5)),
+                        'country_code': ['GB', 'US', 'DE'][store_number % 3],
+                        'continent': continents[store_number % len(continents)]})
+    return records
+
+def _uuids(rng, number_of_rows: int) -> np.ndarray:
+    hex_digits = np.array(list('0123456789abcdef'))
+    characters = hex_digits[rng.integers(0, 16, size=(number_of_rows, 32))]
+    joined = characters.view(f'<U32').ravel()
+    return np.array([f'{u[:8]}-{u[8:12]}-{u[12:16]}-{u[16:20]}-{u[20:]}' for u in joined], dtype=object)
+
+def users_frame(number_of_rows: int, seed=0) -> pd.DataFrame:
+    '''
+    Generates a DataFrame shaped like the legacy_users table including null strings, junk rows, duplicates and mixed date formats.
+        Parameters:
+                number_of_rows (int): The number of rows to generate.
+                seed (int) (optional): Random seed so the same rows are generated each time. Defaults to 0.
+        Returns:
+                data_frame (Pandas dataframe): The generated users.
+    '''
+    rng = np.random.default_rng(seed)
+    first_names = np.array(['Sigfried', 'Guy', 'Harry', 'Darren', 'Garry', 'Anna', 'Jutta'], dtype=object)
+    last_names = np.array(['Noack', 'Allen', 'Lawrence', 'Hussain', 'Stone', 'Smith'], dtype=object)
+    dates = np.array(['1990-09-30', '1940-12-01', '1995/08/02', '1968 October 16', 'January 1951 27', 'November 1958 11',
+                      '2001-12-20', '2016-12-16', '2004-02-23', '2006/09/01', '2012 May 03'], dtype=object)
+    countries = np.array([('Germany', 'DE'), ('United Kingdom', 'GB'), ('United Kingdom', 'GGB'),
+                          ('United States', 'US'), ('United Kingdom', 'GB')], dtype=object)
+    phones = np.array(['+49(0) 047905356', '(0161) 496 0674', '+44(0)121 4960340', '(0306) 999 0871', '0121 496 0225',
+                       '+44(0)1632 960123', '020 7946 0958', '07700 900 461', '001-308-254-4417x1234', '(555)555-0143',
+                       '+1-843-455-1255', '04859 08233', '+49(0)8458 03476', '12345', 'NULL'], dtype=object)
+    country_index = rng.integers(0, len(countries), number_of_rows)
+    data_frame = pd.DataFrame({'index': np.arange(number_of_rows),
+                               'first_name': first_names[rng.integers(0, len(first_names), number_of_rows)],
+                               'last_name': last_names[rng.integers(0, len(last_names), number_of_rows)],
+                               'date_of_birth': dates[rng.integers(0, len(dates), number_of_rows)],
+                               'company': 'Fox Ltd',
+                               'email_address': np.where(rng.random(number_of_rows) < 0.99, 'someone@example.com', 'nobody.example.com'),
+                               'address': '92 Ann drive\nJoanborough\nSK0 6LR',
+                               'country': countries[country_index, 0],
+                               'country_code': countries[country_index, 1],
+                               'phone_number': phones[rng.integers(0, len(phones), number_of_rows)],
+                               'join_date': dates[rng.integers(0, len(dates), number_of_rows)],
+                               'user_uuid': _uuids(rng, number_of_rows)})
+    # rows which are all 'NULL' strings and junk rows where every column is a random code
+    null_rows = rng.random(number_of_rows) < 0.01
+    data_frame.loc[null_rows, data_frame.columns[1:]] = 'NULL'
+    junk_rows = rng.random(number_of_rows) < 0.01
+    data_frame.loc[junk_rows, data_frame.columns[1:]] = 'I7G4DMDZOZ'
+    # duplicate a few rows
+    duplicates = data_frame.sample(frac=0.005, random_state=seed)
+    data_frame = pd.concat([data_frame, duplicates], ignore_index=True)
+    data_frame['index'] = np.arange(data_frame.shape[0])
+    return data_frame
+
+def orders_frame(number_of_rows: int, seed=0, number_of_users: int = None) -> pd.DataFrame:
+    '''
+    Generates a DataFrame shaped like the orders_table table.
+        Parameters:
+                number_of_rows (int): The number of rows to generate.
+                seed (int) (optional): Random seed so the same rows are generated each time. Defaults to 0.
+                number_of_users (int) (optional): The number of users placing the orders, each with one card, as in the source where users order many times. Defaults to a user per order.
+        Returns:
+                data_frame (Pandas dataframe): The generated orders.
+    '''
+    rng = np.random.default_rng(seed)
+    store_codes = np.array([f'ST-{n:06X}' for n in range(450)] + ['WEB-1388012W'], dtype=object)
+    product_codes = np.array([f'A{n}-{n * 7919 % 10000}' for n in range(1850)], dtype=object)
+    date_uuids = _uuids(rng, number_of_rows)
+    user_uuids = _uuids(rng, number_of_users or number_of_rows)
+    card_numbers = rng.integers(10**11, 10**16, number_of_users or number_of_rows).astype(str).astype(object)
+    if number_of_users is not None:
+        users = rng.integers(0, number_of_users, number_of_rows)
+        user_uuids, card_numbers = user_uuids[users], card_numbers[users]
+    data_frame = pd.DataFrame({'level_0': np.arange(number_of_rows),
+                               'index': np.arange(number_of_rows),
+                               'date_uuid': date_uuids,
+                               'first_name': None,
+                               'last_name': None,
+                               'user_uuid': user_uuids,
+                               'card_number': card_numbers,
+                               'store_code': store_codes[rng.integers(0, len(store_codes), number_of_rows)],
+                               'product_code': product_codes[rng.integers(0, len(product_codes), number_of_rows)],
+                               '1': None,
+                               'product_quantity': rng.integers(1, 14, number_of_rows)})
+    return data_frame
+
+def mixed_values_frame(number_of_rows: int, seed=0) -> pd.DataFrame:
+    '''
+    Generates object columns of mixed cell types including every case of the null strings, for checking cleaning steps give the same results as the reference implementations.
+    The columns are named like orders_table so the frame can be passed to DataCleaning.clean_orders_data.
+        Parameters:
+                number_of_rows (int): The number of rows to generate.
+                seed (int) (optional): Random seed so the same rows are generated each time. Defaults to 0.
+        Returns:
+                data_frame (Pandas dataframe): The generated values.
+    '''
+    rng = np.random.default_rng(seed)
+    value_pool = np.array(['NULL', 'null', 'NuLl', 'None', 'NONE', 'nan', 'NaN', 'nan ', ' null', 'nulls', '', 'a', 'GB',
+                           1, 2, 2.5, -0.0, True, np.nan, None, pd.Timestamp('2020-01-01'), '2020-01-01'], dtype=object)
+    data_frame = pd.DataFrame({'level_0': np.arange(number_of_rows), 'index': np.arange(number_of_rows),
+                               'first_name': None, 'last_name': None, '1': None})
+    for column_number in range(6):
+        # restrict some columns to part of the pool so that numeric, all-null and single type columns are covered
+        pool = value_pool[rng.choice(len(value_pool), size=rng.integers(1, len(value_pool)), replace=False)]
+        data_frame[f'column_{column_number}'] = pool[rng.integers(0, len(pool), number_of_rows)]
+    data_frame['all_null_strings'] = np.array(['NULL', 'none'], dtype=object)[rng.integers(0, 2, number_of_rows)]
+    data_frame['numbers_and_nulls'] = np.array([1, 2, 'nan'], dtype=object)[rng.integers(0, 3, number_of_rows)]
+    return data_frame
+
+def weight_values(number_of_values: int, seed=0) -> np.ndarray:
+    '''
+    Generates product weights in the forms found in the products data, such as '1.2kg', '500ml' and '12 x 100g', along with badly formed weights and non-string values.
+        Parameters:
+                number_of_values (int): The number of weights to generate.
+                seed (int) (optional): Random seed so the same weights are generated each time. Defaults to 0.
+        Returns:
+                weights (numpy array): The weights as an object array.
+    '''
+    rng = np.random.default_rng(seed)
+    multipliers = np.array(['', '', '', '', '12 x ', '3x', '.5x', '2.x', '16 X ', '2x3x', 'ax', '0x'], dtype=object)
+    values = np.array(['1', '0', '1.2', '0.45', '500', '77', '.5', '5.', '1e3', 'inf', 'nan', '', '1 000', '1,5', '-2'], dtype=object)
+    units = np.array(['kg', 'kg', 'g', 'g', 'ml', '', 'oz', 'KG', 'mg', 'k g', 'gg'], dtype=object)
+    endings = np.array(['', '', '', '.', ' .', '..', '\n', ' '], dtype=object)
+    weights = (multipliers[rng.integers(0, len(multipliers), number_of_values)] + values[rng.integers(0, len(values), number_of_values)]
+               + units[rng.integers(0, len(units), number_of_values)] + endings[rng.integers(0, len(endings), number_of_values)])
+    # some cells which are not strings
+    others = np.array([1.5, 2, -0.25, np.nan, None, 'I7G4DMDZOZ', '9GO9NZ5JTL'], dtype=object)
+    replaced = rng.random(number_of_values) < 0.05
+    weights[replaced] = others[rng.integers(0, len(others), replaced.sum())]
+    return weights
+
+def products_frame(number_of_rows: int, seed=0) -> pd.DataFrame:
+    '''
+    Generates a DataFrame shaped like the products CSV in S3.
+        Parameters:
+                number_of_rows (int): The number of rows to generate.
+                seed (int) (optional): Random seed so the same rows are generated each time. Defaults to 0.
+        Returns:
+                data_frame (Pandas dataframe): The generated products.
+    '''
+    rng = np.random.default_rng(seed)
+    categories = np.array(['toys-and-games', 'sports-and-leisure', 'pets', 'homeware', 'health-and-beauty', 'food-and-drink', 'diy'], dtype=object)
+    dates = np.array(['2005-12-02', '2006-01-03', '2018-10-22', 'September 2017 06', '2017/09/06'], dtype=object)
+    data_frame = pd.DataFrame({'Unnamed: 0': np.arange(number_of_rows),
+                               'product_name': np.array([f'Product {n}' for n in range(number_of_rows)], dtype=object),
+                               'product_price': np.char.add('£', np.round(rng.uniform(0.5, 900, number_of_rows), 2).astype(str)).astype(object),
+                               'weight': weight_values(number_of_rows, seed),
+                               'category': categories[rng.integers(0, len(categories), number_of_rows)],
+                               'EAN': rng.integers(10**12, 10**13, number_of_rows),
+                               'date_added': dates[rng.integers(0, len(dates), number_of_rows)],
+                               'uuid': _uuids(rng, number_of_rows),
+                               'removed': np.where(rng.random(number_of_rows) < 0.9, 'Still_avaliable', 'Removed').astype(object),
+                               'product_code': np.array([f'R7-{n * 7919 % 10**7}' for n in range(number_of_rows)], dtype=object)})
+    # junk rows where every column is a random code
+    junk_rows = rng.random(number_of_rows) < 0.005
+    data_frame.loc[junk_rows, ['product_name', 'product_price', 'weight', 'category', 'date_added', 'removed', 'product_code']] = 'BSDTR67VD90'
+    return data_frame
+
+def cards_frame(number_of_rows: int, seed=0) -> pd.DataFrame:
+    '''
+    Generates a DataFrame shaped like the card details read from the PDF, including '?' prefixed card numbers, null strings, junk rows and mixed date formats.
+        Parameters:
+                number_of_rows (int): The number of rows to generate.
+                seed (int) (optional): Random seed so the same rows are generated each time. Defaults to 0.
+        Returns:
+                data_frame (Pandas dataframe): The generated card details.
+    '''
+    rng = np.random.default_rng(seed)
+    providers = np.array(['Diners Club / Carte Blanche', 'American Express', 'JCB 16 digit', 'VISA 16 digit', 'Maestro'], dtype=object)
+    dates = np.array(['2015-11-25', '2001-06-18', '2000-12-26', 'December 2021 17', '2005 July 01', '2008/12/12', 'September 2016 04'], dtype=object)
+    card_numbers = rng.integers(10**11, 10**16, number_of_rows).astype(str).astype(object)
+    prefixed = rng.random(number_of_rows) < 0.02
+    card_numbers[prefixed] = '???' + card_numbers[prefixed]
+    # tabula reads some card numbers as integers
+    as_integers = rng.random(number_of_rows) < 0.3
+    card_numbers[as_integers] = [int(card_number.strip('?')) for card_number in card_numbers[as_integers]]
+    data_frame = pd.DataFrame({'card_number': card_numbers,
+                               'expiry_date': np.char.add(np.char.zfill(rng.integers(1, 13, number_of_rows).astype(str), 2),
+                                                          np.char.add('/', rng.integers(22, 32, number_of_rows).astype(str))).astype(object),
+                               'card_provider': providers[rng.integers(0, len(providers), number_of_rows)],
+                               'date_payment_confirmed': dates[rng.integers(0, len(dates), number_of_rows)]})
+    null_rows = rng.random(number_of_rows) < 0.01
+    data_frame.loc[null_rows] = 'NULL'
+    junk_rows = rng.random(number_of_rows) < 0.01
+    data_frame.loc[junk_rows] = 'NB71VBAHJE'
+    return data_frame
+
+def phone_numbers(number_of_rows: int, seed=0) -> pd.DataFrame:
+    '''
+    Generates random UK, US and German phone numbers written in the different ways found in the users data, along with some invalid ones.
+        Parameters:
+                number_of_rows (int): The number of phone numbers to generate.
+                seed (int) (optional): Random seed so the same numbers are generated each time. Defaults to 0.
+        Returns:
+                data_frame (Pandas dataframe): The phone_number and country_code of each row.
+    '''
+    rng = np.random.default_rng(seed)
+    templates = {'GB': ['0{a}{b} {c}{d}{e} {f}{g}{h}{i}', '({a}{b}{c}{d}) {e}{f}{g} {h}{i}{j}', '+44(0){a}{b}{c} {d}{e}{f}{g}{h}{i}{j}',
+                        '+44 {a}{b} {c}{d}{e}{f} {g}{h}{i}{j}', '07{a}{b}{c} {d}{e}{f} {g}{h}{i}', '0{a}{b}{c} {d}{e}{f} {g}{h}{i}{j} x{a}{b}{c}'],
+                 'US': ['({a}{b}{c}){d}{e}{f}-{g}{h}{i}{j}', '001-{a}{b}{c}-{d}{e}{f}-{g}{h}{i}{j}x{a}{b}{c}', '+1-{a}{b}{c}-{d}{e}{f}-{g}{h}{i}{j}',
+                        '{a}{b}{c}.{d}{e}{f}.{g}{h}{i}{j}'],
+                 'DE': ['+49(0) 0{a}{b}{c}{d}{e}{f}{g}{h}', '0{a}{b}{c}{d} {e}{f}{g}{h}{i}', '+49(0){a}{b}{c}{d} {e}{f}{g}{h}{i}', '(0{a}{b}{c}) {d}{e}{f}{g}{h}{i}'],
+                 'XX': ['{a}{b}{c}{d}{e}', '+{a}{b} {c}{d}{e}']}
+    country_codes = np.array(['GB', 'GB', 'US', 'DE', 'XX'], dtype=object)[rng.integers(0, 5, number_of_rows)]
+    digits = rng.integers(0, 10, size=(number_of_rows, 10)).astype(str)
+    phone_numbers = []
+    for country_code, row_digits in zip(country_codes, digits):
+        country_templates = templates[country_code]
+        template = country_templates[rng.integers(0, len(country_templates))]
+        phone_numbers.append(template.format(**dict(zip('abcdefghij', row_digits))))
+    # numbers with an unknown country are checked against the UK plan
+    country_codes[country_codes == 'XX'] = np.array(['GB', 'FR'], dtype=object)[rng.integers(0, 2, (country_codes == 'XX').sum())]
+    return pd.DataFrame({'phone_number': np.array(phone_numbers, dtype=object), 'country_code': country_codes})
+
+def date_strings(number_of_values: int, seed=0) -> np.ndarray:
+    '''
+    Generates random dates from 1940 to 2022 written in the formats found in the legacy data, along with some invalid dates.
+        Parameters:
+                number_of_values (int): The number of dates to generate.
+                seed (int) (optional): Random seed so the same dates are generated each time. Defaults to 0.
+        Returns:
+                dates (numpy array): The dates as an object array.
+    '''
+    rng = np.random.default_rng(seed)
+    dates = pd.to_datetime('1940-01-01') + pd.to_timedelta(rng.integers(0, 30000, number_of_values), unit='D')
+    formats = ['%Y-%m-%d', '%Y-%m-%d', '%Y/%m/%d', '%Y %B %d', '%B %Y %d']
+    format_index = rng.integers(0, len(formats), number_of_values)
+    date_strings = np.empty(number_of_values, dtype=object)
+    for index, date_format in enumerate(formats):
+        in_format = format_index == index
+        date_strings[in_format] = dates[in_format].strftime(date_format)
+    invalid = rng.random(number_of_values) < 0.01
+    date_strings[invalid] = np.array(['GLPTIB3LPI', 'NULL', '2005-02-30'], dtype=object)[rng.integers(0, 3, invalid.sum())]
+    return date_strings
+
+def times_frame(number_of_rows: int, seed=0) -> pd.DataFrame:
+    '''
+    Generates a DataFrame shaped like the date_details JSON, including 'NULL' rows, junk rows and some unusual but valid values.
+        Parameters:
+                number_of_rows (int): The number of rows to generate.
+                seed (int) (optional): Random seed so the same rows are generated each time. Defaults to 0.
+        Returns:
+                data_frame (Pandas dataframe): The generated date details.
+    '''
+    rng = np.random.default_rng(seed)
+    timestamps = pd.to_datetime('1992-01-01') + pd.to_timedelta(rng.integers(0, 30 * 365 * 86400, number_of_rows), unit='s')
+    data_frame = pd.DataFrame({'timestamp': timestamps.strftime('%H:%M:%S').astype(object),
+                               'month': timestamps.month.astype(str).astype(object),
+                               'year': timestamps.year.astype(str).astype(object),
+                               'day': timestamps.day.astype(str).astype(object),
+                               'time_period': np.array(['Evening', 'Morning', 'Midday', 'Late_Hours'], dtype=object)[rng.integers(0, 4, number_of_rows)],
+                               'date_uuid': _uuids(rng, number_of_rows)})
+    # values which pd.to_datetime accepts or rejects in ways that are easy to get wrong
+    unusual = rng.random(number_of_rows) < 0.01
+    unusual_values = {'timestamp': ['23:59:60', '7:5:9', ' 22:00:06', '22:00', '24:00:00'], 'month': ['09', '13', '0'],
+                      'day': ['31', '30', '01', '9 '], 'year': ['1677', '2262', '99']}
+    for column, values in unusual_values.items():
+        chosen = unusual & (rng.random(number_of_rows) < 0.3)
+        data_frame.loc[chosen, column] = np.array(values, dtype=object)[rng.integers(0, len(values), chosen.sum())]
+    null_rows = rng.random(number_of_rows) < 0.01
+    data_frame.loc[null_rows] = 'NULL'
+    junk_rows = rng.random(number_of_rows) < 0.01
+    data_frame.loc[junk_rows] = 'SXBRPGPZMP'
+    return data_frame
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import threading
+import numpy as np
+import pandas as pd
+import sqlalchemy.types as types
+
+
+class SchemaInferrer:
+    '''
+    Works out the SQL type of each column of a cleaned DataFrame from a profile of its values: the number of nulls, the longest string
+    and the smallest and largest number. Strings become VARCHAR sized to the longest value or UUID when every value is one,
+    whole numbers the smallest of SMALLINT, INTEGER and BIGINT holding them, and datetimes DATE when none has a time of day.
+    The profile of each table can be cached in a JSON file with the version of its source and of the code cleaning it, so an unchanged source
+    cleaned by unchanged code is not profiled again.
+    '''
+    # a UUID is 36 characters with dashes at these positions and hex digits everywhere else
+    uuid_dash_positions = [8, 13, 18, 23]
+    # the class of each ASCII character looked up by its byte: 1 for a hex digit, 2 for a dash and 0 for any other
+    character_classes = np.zeros(256, dtype='uint8')
+    character_classes[np.frombuffer(b'0123456789abcdefABCDEF', dtype='uint8')] = 1
+    character_classes[ord('-')] = 2
+    uuid_character_classes = np.where(np.isin(np.arange(36), uuid_dash_positions), 2, 1).astype('uint8')
+    # the strings are measured this many at a time, so one long value only widens the array of a block
+    block_rows = 10000
+    # the integer types from the smallest, with the range each holds
+    integer_types = [(types.SMALLINT, -2**15, 2**15-1), (types.INTEGER, -2**31, 2**31-1), (types.BIGINT, -2**63, 2**63-1)]
+
+    def __init__(self, cache_path: str = None, code_version: str = ''):
+        self.cache_path = cache_path
+        # the version of the code the DataFrames are cleaned with. a profile cached with another version is not used, as changed cleaning can make values longer
+        self.code_version = code_version
+        # several stages infer their schemas at once
+        self.__lock = threading.Lock()
+
+    def __read_cache(self) -> dict:
+        try:
+            with open(self.cache_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    # the other tables are read again first, as a stage run in another process may have written them. the file is written under a name
+    # of this process first so that an interrupted run never leaves a partial cache
+    def __write_cache(self, table_name: str, entry: dict):
+        cache = self.__read_cache()
+        cache[table_name] = entry
+        temporary_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(cache, file)
+        os.replace(temporary_path, self.cache_path)
+
+    def __profile_column(self, column: pd.Series, null_count: int) -> dict:
+        column_profile = {'nulls': null_count}
+        # a categorical is profiled from the categories in the column
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            codes = column.cat.codes.to_numpy()
+            used = np.bincount(codes[codes >= 0], minlength=len(column.cat.categories)) > 0
+            column = pd.Series(column.cat.categories[used])
+            null_count = 0
+        all_nulls = null_count == len(column)
+        if pd.api.types.is_bool_dtype(column.dtype):
+            column_profile['kind'] = 'boolean'
+        elif pd.api.types.is_integer_dtype(column.dtype):
+            column_profile.update(kind='integer', min=None if all_nulls else int(column.min()), max=None if all_nulls else int(column.max()))
+        elif pd.api.types.is_float_dtype(column.dtype):
+            column_profile['kind'] = 'float'
+        elif pd.api.types.is_datetime64_any_dtype(column.dtype):
+            values = column.dropna()
+            column_profile.update(kind='datetime', timezone=getattr(column.dtype, 'tz', None) is not None,
+                                  date_only=bool((values == values.dt.normalize()).all()))
+        elif all_nulls:
+            column_profile['kind'] = 'empty'
+        else:
+            # any other column, such as card numbers read as a mix of strings and numbers, is loaded as text
+            values = column.dropna() if null_count else column
+            max_length, all_uuids = 0, True
+            for start_row in range(0, len(values), self.block_rows):
+                # a block converted to an array of fixed width strings is as wide as its longest value as text, found without measuring each value.
+                # ASCII strings are converted to bytes, a quarter of the size of the code points of any other strings
+                block = values.iloc[start_row:start_row+self.block_rows].to_numpy()
+                try:
+                    characters = block.astype(bytes)
+                    width = characters.dtype.itemsize
+                except UnicodeEncodeError:
+                    characters = block.astype(str)
+                    width = characters.dtype.itemsize // 4
+                max_length = max(max_length, width)
+                # a UUID is ASCII
+                all_uuids = all_uuids and width == 36 and characters.dtype.kind == 'S' and self.__all_uuids(characters)
+            column_profile.update(kind='string', max_length=max_length, uuid=all_uuids)
+        return column_profile
+
+    # checks the characters of every value at once as a 36 column array of bytes rather than matching each value with a regular expression.
+    # a shorter value is padded with zeros, which are not hex digits
+    def __all_uuids(self, characters) -> bool:
+        return bool((self.character_classes[characters.view('uint8').reshape(-1, 36)] == self.uuid_character_classes).all())
+
+    def profile(self, data_frame: pd.DataFrame, text_columns=[]) -> dict:
+        '''
+        Profiles each column of a DataFrame. The nulls of every column are counted together and each column is then measured with vectorised methods.
+            Parameters:
+                    data_frame (Pandas dataframe): The cleaned DataFrame.
+                    text_columns (list) (optional): The columns to profile as strings whatever their type, such as numbers to be loaded as VARCHAR.
+            Returns:
+                    profile (dictionary): For each column its kind (string, integer, float, boolean, datetime or empty for a text column of nulls) and nulls,
+                                          the max_length and whether every value is a UUID of a string column,
+                                          the min and max of an integer column, None when it only has nulls, and whether a datetime column has no times of day.
+        '''
+        null_counts = data_frame.isna().sum()
+        return {str(column_name): self.__profile_column(column.astype(object) if column_name in text_columns else column, int(null_counts[column_name]))
+                for column_name, column in data_frame.items()}
+
+    def sql_type(self, column_profile: dict, streamed=False):
+        '''
+        Returns the SQL type for a profiled column.
+            Parameters:
+                    column_profile (dictionary): The profile of the column, as returned by profile.
+                    streamed (bool) (optional): True when the profile is of the first chunk of a streamed table. Strings are then TEXT, to be fitted once
+                                                the whole table is loaded, and whole numbers BIGINT, as later chunks may hold longer or larger values. Defaults to False.
+            Returns:
+                    sql_type (sqlalchemy.types): The SQL type.
+        '''
+        kind = column_profile['kind']
+        if kind == 'string':
+            if column_profile['uuid']:
+                return types.UUID()
+            return types.TEXT() if streamed else types.VARCHAR(column_profile['max_length'])
+        if kind == 'integer':
+            if streamed or column_profile['min'] is None:
+                return types.BIGINT()
+            return next(sql_type() for sql_type, smallest, largest in self.integer_types
+                        if smallest <= column_profile['min'] and column_profile['max'] <= largest)
+        if kind == 'float':
+            return types.FLOAT()
+        if kind == 'boolean':
+            return types.BOOLEAN()
+        if kind == 'datetime':
+            return types.DATE() if column_profile['date_only'] else types.TIMESTAMP(timezone=column_profile['timezone'])
+        return types.TEXT()
+
+    def infer(self, data_frame: pd.DataFrame, overrides: dict = None, table_name: str = None, source_version: str = None, streamed=False) -> dict:
+        '''
+        Returns the SQL type of each column of a DataFrame, to be given to upload_to_db as its dtypes.
+            Parameters:
+                    data_frame (Pandas dataframe): The cleaned DataFrame, or the first chunk of a streamed table.
+                    overrides (dictionary of sqlalchemy.types) (optional): The types of the columns which are not inferred, such as a VARCHAR(255) set by the specification.
+                                                                           The VARCHAR class rather than an instance is sized to the longest value as text, such as for numbers loaded as VARCHAR.
+                    table_name (str) (optional): The table, for the cache.
+                    source_version (str) (optional): The version of the source the DataFrame was cleaned from, such as the hash of its extract.
+                                                     The profile is only cached with a table_name and source_version.
+                    streamed (bool) (optional): True when data_frame is the first chunk of a streamed table, as for sql_type. Defaults to False.
+            Returns:
+                    dtypes (dictionary of sqlalchemy.types): The SQL type of each column.
+        '''
+        overrides = overrides or {}
+        # the overridden columns do not need to be measured apart from the VARCHAR columns to be sized
+        text_columns = [column for column, sql_type in overrides.items() if sql_type is types.VARCHAR]
+        profiled_columns = [column for column in data_frame.columns if column not in overrides or column in text_columns]
+        version = None
+        if self.cache_path and table_name is not None and source_version is not None and not streamed:
+            # the code version, the columns and their types are part of the version, so a change to the cleaning or the overrides is profiled again
+            version = source_version + ':' + self.code_version + ':' + json.dumps({str(column): str(data_frame[column].dtype) for column in profiled_columns}
+                                                        | {str(column): 'text' for column in text_columns})
+            with self.__lock:
+                entry = self.__read_cache().get(table_name, {})
+            profile = entry.get('profile') if entry.get('version') == version else None
+            if profile is not None:
+                logging.info(f"{table_name}: using the schema inferred for source version {source_version}")
+        if version is None or profile is None:
+            profile = self.profile(data_frame[profiled_columns], text_columns)
+            if version is not None:
+                with self.__lock:
+                    self.__write_cache(table_name, {'version': version, 'profile': profile})
+        dtypes = {column: self.sql_type(column_profile, streamed) for column, column_profile in profile.items()}
+        return dtypes | {column: sql_type for column, sql_type in overrides.items() if column in data_frame.columns and column not in text_columns}
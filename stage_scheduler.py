@@ -0,0 +1,127 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class StageScheduler:
+    '''
+    Runs stages on a pool of threads as soon as the stages they depend on have succeeded.
+    A stage which raises an exception is marked failed and every stage depending on it, directly or not, is skipped.
+    The start and end of each stage are recorded for a critical path report.
+    '''
+    def __init__(self):
+        # stage name -> (function, dependency names), in the order the stages were added
+        self.__stages = {}
+        # stage name -> {'status', 'start', 'end', 'error'} with times in seconds from the start of run
+        self.results = {}
+        self.__start_time = None
+
+    def add_stage(self, name: str, function, dependencies: list[str] = None):
+        '''
+        Adds a stage to be run.
+            Parameters:
+                    name (str): A unique name for the stage.
+                    function: The function to call, with no arguments.
+                    dependencies (list) (optional): The names of the stages which must succeed before this one starts. Defaults to none.
+            Returns:
+                    none.
+        '''
+        if name in self.__stages:
+            raise ValueError(f"stage {name} has already been added")
+        self.__stages[name] = (function, list(dependencies or []))
+
+    def stage_names(self) -> list[str]:
+        return list(self.__stages)
+
+    def __run_stage(self, name: str):
+        function = self.__stages[name][0]
+        self.results[name] = {'status': 'running', 'start': time.perf_counter() - self.__start_time}
+        try:
+            function()
+            self.results[name]['status'] = 'succeeded'
+        except Exception as error:
+            logging.exception(f"{name}: FAILED")
+            self.results[name]['status'] = 'failed'
+            self.results[name]['error'] = error
+        self.results[name]['end'] = time.perf_counter() - self.__start_time
+
+    # submits the pending stages whose dependencies have all succeeded and skips those with a dependency which did not
+    def __start_ready_stages(self, pending: list[str], executor, running: dict):
+        changed = True
+        while changed:
+            changed = False
+            for name in list(pending):
+                statuses = [self.results.get(dependency, {}).get('status') for dependency in self.__stages[name][1]]
+                if any(status in ('failed', 'skipped') for status in statuses):
+                    logging.error(f"{name}: skipped as a stage it depends on did not succeed")
+                    self.results[name] = {'status': 'skipped'}
+                elif all(status == 'succeeded' for status in statuses):
+                    running[executor.submit(self.__run_stage, name)] = name
+                else:
+                    continue
+                pending.remove(name)
+                changed = True
+
+    def run(self, max_workers: int = None) -> bool:
+        '''
+        Runs all the stages, each as soon as its dependencies have succeeded, and waits for them to finish.
+            Parameters:
+                    max_workers (int) (optional): The most stages run at once. Defaults to all of them.
+            Returns:
+                    succeeded (bool): True if every stage succeeded.
+        '''
+        for name, (function, dependencies) in self.__stages.items():
+            for dependency in dependencies:
+                if dependency not in self.__stages:
+                    raise ValueError(f"stage {name} depends on {dependency} which has not been added")
+        self.results = {}
+        self.__start_time = time.perf_counter()
+        pending = list(self.__stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers or max(len(pending), 1)) as executor:
+            self.__start_ready_stages(pending, executor, running)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                self.__start_ready_stages(pending, executor, running)
+        if pending:
+            raise ValueError(f"stages {pending} depend on each other in a cycle")
+        return all(result['status'] == 'succeeded' for result in self.results.values())
+
+    def critical_path(self) -> list[str]:
+        '''
+        Returns the chain of stages which decided when the run finished: the last stage to finish, the dependency it waited for last, and so on.
+            Parameters:
+                    none.
+            Returns:
+                    stage_names (list): The stages on the critical path, first to last.
+        '''
+        finished = {name: result for name, result in self.results.items() if 'end' in result}
+        if not finished:
+            return []
+        path = [max(finished, key=lambda name: finished[name]['end'])]
+        while True:
+            dependencies = [dependency for dependency in self.__stages[path[0]][1] if dependency in finished]
+            if not dependencies:
+                return path
+            path.insert(0, max(dependencies, key=lambda name: finished[name]['end']))
+
+    def report(self) -> str:
+        '''
+        Returns the status and timing of each stage followed by the critical path.
+            Parameters:
+                    none.
+            Returns:
+                    report (str): One line per stage and a line for the critical path.
+        '''
+        lines = []
+        for name, result in self.results.items():
+            if 'end' in result:
+                lines.append(f"{name}: {result['status']} {result['start']:.1f}s -> {result['end']:.1f}s ({result['end']-result['start']:.1f}s)")
+            else:
+                lines.append(f"{name}: {result['status']}")
+        critical_path = self.critical_path()
+        if critical_path:
+            lines.append(f"critical path: {' -> '.join(critical_path)} finishing at {self.results[critical_path[-1]]['end']:.1f}s")
+        return '\n'.join(lines)
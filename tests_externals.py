@@ -1,5 +1,8 @@
+import concurrent.futures
 import unittest
 import pandas as pd
+import sqlalchemy
+import sqlalchemy.types as types
 
 from database_utils import DatabaseConnector
 class TestDatabaseUtils(unittest.TestCase):
@@ -11,11 +14,141 @@ class TestDatabaseUtils(unittest.TestCase):
         self.assertIn("legacy_users", table_names)
         self.assertIn("orders_table", table_names)
 
+    def test_pool_statistics(self):
+        db_connector = DatabaseConnector()
+        for _ in range(3):
+            with db_connector.connect() as connection:
+                connection.exec_driver_sql('SELECT 1')
+        statistics = db_connector.pool_statistics()['LOCAL_']
+        self.assertEqual(statistics['checkouts'], 3)
+        self.assertGreaterEqual(statistics['checkout_wait_seconds'], statistics['max_checkout_wait_seconds'])
+
     def test_upload_data(self):
         db_connector = DatabaseConnector()
         data_frame = pd.DataFrame({'a':[1,2,3],'b':[4,5,6]})
         db_connector.upload_to_db(data_frame, 'test')
 
+    def test_bulk_load_matches_insert(self):
+        db_connector = DatabaseConnector()
+        db_engine = db_connector.init_db_engine(db_connector.read_db_creds(), 'LOCAL_')
+        data_frame = pd.DataFrame({'a': [1.5, None, 1/3], 'b': [True, False, True], 'c': ['', None, 'a"b\nc'],
+                                   'd': pd.to_datetime(['2020-01-01 12:13:14.5', None, '2021-05-06 00:00:00.0'])})
+        db_connector.upload_to_db(data_frame, 'test', bulk_load=False)
+        inserted = pd.read_sql_table('test', db_engine)
+        db_connector.upload_to_db(data_frame, 'test')
+        copied = pd.read_sql_table('test', db_engine)
+        self.assertTrue(copied.equals(inserted))
+
+    def test_upsert_matches_replace(self):
+        db_connector = DatabaseConnector()
+        db_engine = db_connector.init_db_engine(db_connector.read_db_creds(), 'LOCAL_')
+        dtypes = {'key': types.VARCHAR(10), 'value': types.FLOAT, 'day': types.DATE}
+        data_frame = pd.DataFrame({'key': ['a', 'b', 'c', 'd'], 'value': [1.0, 2.0, None, 4.0],
+                                   'day': pd.to_datetime(['2020-01-01', '2020-01-02', '2020-01-03', None])})
+        load = db_connector.upsert_to_db(data_frame, 'test_upsert', dtypes, 'key', full_refresh=True)
+        self.assertEqual(load['mode'], 'full')
+        # b changes, c is deleted and e is new
+        changed = pd.DataFrame({'key': ['a', 'b', 'd', 'e'], 'value': [1.0, 2.5, 4.0, 5.0],
+                                'day': pd.to_datetime(['2020-01-01', '2020-01-02', None, '2020-01-05'])})
+        load = db_connector.upsert_to_db(changed, 'test_upsert', dtypes, 'key')
+        self.assertEqual(load, {'mode': 'incremental', 'inserted': 1, 'updated': 1, 'deleted': 1, 'unchanged': 2})
+        upserted = pd.read_sql_query('SELECT * FROM test_upsert ORDER BY key', db_engine)
+        db_connector.upload_to_db(changed, 'test_upsert', dtypes, 'key')
+        replaced = pd.read_sql_query('SELECT * FROM test_upsert ORDER BY key', db_engine)
+        pd.testing.assert_frame_equal(upserted, replaced)
+        watermark = pd.read_sql_query("SELECT * FROM etl_watermarks WHERE table_name = 'test_upsert'", db_engine)
+        self.assertEqual(watermark['updated'][0], 1)
+
+    def test_upsert_replaces_when_columns_change(self):
+        db_connector = DatabaseConnector()
+        db_connector.upsert_to_db(pd.DataFrame({'key': ['a'], 'value': [1]}), 'test_upsert', None, 'key', full_refresh=True)
+        load = db_connector.upsert_to_db(pd.DataFrame({'key': ['a'], 'other': [1]}), 'test_upsert', None, 'key')
+        self.assertEqual(load['mode'], 'full')
+
+    def test_upsert_replaces_when_value_too_long(self):
+        db_connector = DatabaseConnector()
+        db_engine = db_connector.init_db_engine(db_connector.read_db_creds(), 'LOCAL_')
+        db_connector.upsert_to_db(pd.DataFrame({'key': ['a', 'b'], 'value': ['x', 'y']}), 'test_upsert', {'value': types.VARCHAR(1)}, 'key', full_refresh=True)
+        longer = pd.DataFrame({'key': ['a', 'b'], 'value': ['x', 'longer']})
+        load = db_connector.upsert_to_db(longer, 'test_upsert', {'value': types.VARCHAR(6)}, 'key')
+        self.assertEqual(load['mode'], 'full')
+        pd.testing.assert_frame_equal(pd.read_sql_query('SELECT * FROM test_upsert ORDER BY key', db_engine), longer)
+
+    def test_concurrent_loads_create_side_tables(self):
+        # the stages loading at once into a schema without side tables do not race to create them
+        db_connector = DatabaseConnector()
+        for attempt in range(5):
+            with db_connector.connect(autocommit=True) as con:
+                con.exec_driver_sql('DROP SCHEMA IF EXISTS test_side_tables CASCADE; CREATE SCHEMA test_side_tables;')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+                loads = [executor.submit(db_connector.upsert_to_db, pd.DataFrame({'key': ['a', 'b'], 'value': [n, n]}), f'test_table_{n}', None, 'key',
+                                         full_refresh=True, schema='test_side_tables') for n in range(6)]
+                for load in loads:
+                    self.assertEqual(load.result()['mode'], 'full')
+        with db_connector.connect(autocommit=True) as con:
+            con.exec_driver_sql('DROP SCHEMA test_side_tables CASCADE;')
+
+    def test_swap_schema_tables(self):
+        db_connector = DatabaseConnector()
+        db_engine = db_connector.init_db_engine(db_connector.read_db_creds(), 'LOCAL_')
+        db_connector.upload_to_db(pd.DataFrame({'key': ['a', 'b'], 'value': [1, 2]}), 'test_dimension', primary_key='key')
+        db_connector.upload_to_db(pd.DataFrame({'key': ['a', 'b', 'a']}), 'test_facts')
+        db_connector.prepare_schema('test_staging')
+        db_connector.upsert_to_db(pd.DataFrame({'key': ['a', 'b', 'c'], 'value': [1, 2, 3]}), 'test_dimension', None, 'key',
+                                  full_refresh=True, schema='test_staging')
+        db_connector.add_foreign_key('test_facts', 'key', 'test_dimension', 'key', 'public', 'test_staging', 'fk_test_dimension_key_staged')
+        # public is unchanged until the swap
+        self.assertEqual(db_connector.count_rows('test_dimension'), 2)
+        self.assertEqual(db_connector.swap_schema_tables('test_staging'), ['test_dimension'])
+        self.assertEqual(db_connector.count_rows('test_dimension'), 3)
+        self.assertFalse(db_connector.table_exists('test_dimension', 'test_staging'))
+        constraints = pd.read_sql_query("SELECT conname FROM pg_constraint WHERE conrelid = 'public.test_facts'::regclass", db_engine)
+        self.assertEqual(list(constraints['conname']), ['fk_test_dimension_key'])
+        watermark = pd.read_sql_query("SELECT * FROM etl_watermarks WHERE table_name = 'test_dimension'", db_engine)
+        self.assertEqual(watermark['inserted'][0], 3)
+        with db_connector.connect(autocommit=True) as con:
+            con.exec_driver_sql('DROP TABLE test_facts, test_dimension;')
+
+    def test_staged_upsert_changes_public_with_swap(self):
+        db_connector = DatabaseConnector()
+        db_engine = db_connector.init_db_engine(db_connector.read_db_creds(), 'LOCAL_')
+        db_connector.upsert_to_db(pd.DataFrame({'key': ['a', 'b', 'c'], 'value': [1, 2, 3]}), 'test_upsert', None, 'key', full_refresh=True)
+        db_connector.prepare_schema('test_staging')
+        changed = pd.DataFrame({'key': ['a', 'b', 'd'], 'value': [1, 5, 4]})
+        load = db_connector.upsert_to_db(changed, 'test_upsert', None, 'key', schema='test_staging')
+        self.assertEqual(load, {'mode': 'incremental', 'inserted': 1, 'updated': 1, 'deleted': 1, 'unchanged': 1})
+        # public is unchanged until the swap
+        self.assertEqual(list(pd.read_sql_query('SELECT value FROM test_upsert ORDER BY key', db_engine)['value']), [1, 2, 3])
+        self.assertEqual(db_connector.swap_schema_tables('test_staging'), ['test_upsert'])
+        pd.testing.assert_frame_equal(pd.read_sql_query('SELECT * FROM test_upsert ORDER BY key', db_engine), changed)
+        # the row hashes and primary key are swapped in with the table, so the next load only updates the row which changed
+        changed.loc[0, 'value'] = 6
+        load = db_connector.upsert_to_db(changed, 'test_upsert', None, 'key')
+        self.assertEqual(load, {'mode': 'incremental', 'inserted': 0, 'updated': 1, 'deleted': 0, 'unchanged': 2})
+
+    def test_swap_schema_tables_keeps_dependants(self):
+        db_connector = DatabaseConnector()
+        db_connector.upload_to_db(pd.DataFrame({'key': ['a', 'b'], 'value': [1, 2]}), 'test_dimension', primary_key='key')
+        db_connector.upload_to_db(pd.DataFrame({'key': ['a', 'b', 'a']}), 'test_facts')
+        db_connector.add_foreign_key('test_facts', 'key', 'test_dimension', 'key')
+        db_connector.prepare_schema('test_staging')
+        db_connector.upload_to_db(pd.DataFrame({'key': ['a', 'b', 'c'], 'value': [1, 2, 3]}), 'test_dimension', primary_key='key', schema='test_staging')
+        db_connector.add_foreign_key('test_facts', 'key', 'test_dimension', 'key', 'public', 'test_staging', 'fk_test_dimension_key_staged')
+        with db_connector.connect(autocommit=True) as con:
+            con.exec_driver_sql('CREATE VIEW test_dimension_view AS SELECT * FROM test_dimension;')
+        # a view from outside the run fails the swap, which leaves public as it was
+        with self.assertRaises(sqlalchemy.exc.SQLAlchemyError):
+            db_connector.swap_schema_tables('test_staging')
+        self.assertEqual(db_connector.count_rows('test_dimension'), 2)
+        self.assertEqual(db_connector.count_rows('test_dimension_view'), 2)
+        # the key replaced by its staged constraint does not
+        with db_connector.connect(autocommit=True) as con:
+            con.exec_driver_sql('DROP VIEW test_dimension_view;')
+        self.assertEqual(db_connector.swap_schema_tables('test_staging'), ['test_dimension'])
+        self.assertEqual(db_connector.count_rows('test_dimension'), 3)
+        with db_connector.connect(autocommit=True) as con:
+            con.exec_driver_sql('DROP TABLE test_facts, test_dimension;')
+
 
 from data_extraction import DataExtractor
 class TestDataExtractor(unittest.TestCase):
@@ -32,6 +165,14 @@ class TestDataExtractor(unittest.TestCase):
         data_extractor = DataExtractor()
         data_frame = data_extractor.read_rds_table(db_connector, table_name_to_use)
         self.assertTrue(type(data_frame),type(pd.DataFrame()))
+
+    def test_read_rds_table_copy_matches_read_sql_table(self):
+        db_connector = DatabaseConnector()
+        data_extractor = DataExtractor()
+        copy_data_frame = data_extractor.read_rds_table(db_connector, 'legacy_users', use_copy=True)
+        read_sql_data_frame = data_extractor.read_rds_table(db_connector, 'legacy_users')
+        self.assertTrue(copy_data_frame.dtypes.equals(read_sql_data_frame.dtypes))
+        self.assertTrue(copy_data_frame.equals(read_sql_data_frame))
     
     def test_retrieve_pdf_data(self):
         data_extractor = DataExtractor()
@@ -40,6 +181,14 @@ class TestDataExtractor(unittest.TestCase):
         pdf_data_frame = data_extractor.retrieve_pdf_data(url)
         self.assertTrue(type(pdf_data_frame),type(pd.DataFrame()))
 
+    def test_retrieve_pdf_data_parallel_matches_serial(self):
+        api_config = DataExtractor().read_api_creds()
+        url = api_config['card_data_url']
+        # separate extractors so that the second is not given the first's parsed result
+        serial = DataExtractor().retrieve_pdf_data(url, max_workers=1)
+        parallel = DataExtractor().retrieve_pdf_data(url, max_workers=4)
+        pd.testing.assert_frame_equal(parallel, serial)
+
     def test_list_number_of_stores(self):
         data_extractor = DataExtractor()
         api_config = data_extractor.read_api_creds()
@@ -70,5 +219,50 @@ class TestDataExtractor(unittest.TestCase):
         self.assertTrue(type(data_frame),type(pd.DataFrame()))
 
 
+from data_cleaning import DataCleaning
+from reference_cleaning import ReferenceCleaning
+class TestDataCleaning(unittest.TestCase):
+    def test_clean_time_data_matches_reference(self):
+        data_extractor = DataExtractor()
+        api_config = data_extractor.read_api_creds()
+        data_frame = data_extractor.extract_from_json(api_config['date_details_url'])
+        expected = ReferenceCleaning().clean_time_data(data_frame.copy()).astype({'time_period': 'category'})
+        cleaned = DataCleaning().clean_time_data(data_frame.copy())
+        pd.testing.assert_frame_equal(cleaned, expected)
+
+
+from process_manager import ProcessManager
+class TestProcessManager(unittest.TestCase):
+    # the rows of a staged table in a fixed order and the SQL type of each of its columns
+    def __staged_table(self, db_connector, table_name: str, schema: str, order_column: str):
+        db_engine = db_connector.get_engine('LOCAL_')
+        rows = pd.read_sql_query(f'SELECT * FROM {schema}.{table_name} ORDER BY "{order_column}"', db_engine)
+        column_types = pd.read_sql_query("SELECT column_name, data_type, character_maximum_length FROM information_schema.columns "
+                                         "WHERE table_schema = %(schema)s AND table_name = %(table_name)s ORDER BY column_name",
+                                         db_engine, params={'schema': schema, 'table_name': table_name})
+        return rows, column_types
+
+    def test_streamed_tables_match_in_memory(self):
+        process_manager = ProcessManager()
+        # small chunks so each table is read, cleaned and saved in many of them
+        process_manager.stream_chunk_size = 1000
+        process_manager.staging_schema = 'test_staging'
+        db_connector = process_manager.db_connector
+        for stage_name, table_name, order_column in [('process_users', 'dim_users', 'user_uuid'), ('process_orders', 'orders_table', 'date_uuid')]:
+            with self.subTest(table=table_name):
+                db_connector.prepare_schema('test_staging')
+                process_manager.read_arguments(['full_refresh'])
+                getattr(process_manager, stage_name)()
+                in_memory_rows, in_memory_types = self.__staged_table(db_connector, table_name, 'test_staging', order_column)
+                db_connector.prepare_schema('test_staging')
+                process_manager.read_arguments(['stream', 'full_refresh'])
+                getattr(process_manager, stage_name)()
+                streamed_rows, streamed_types = self.__staged_table(db_connector, table_name, 'test_staging', order_column)
+                pd.testing.assert_frame_equal(streamed_rows, in_memory_rows)
+                pd.testing.assert_frame_equal(streamed_types, in_memory_types)
+        with db_connector.connect(autocommit=True) as con:
+            con.exec_driver_sql('DROP SCHEMA test_staging CASCADE;')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,36 @@
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from database_utils import DatabaseConnector
 from data_extraction import DataExtractor
+import numpy as np
+import pandas as pd
+import requests
+import sample_data
+from data_cleaning import DataCleaning
+from reference_cleaning import ReferenceCleaning
+from phone_number_formatter import PhoneNumberFormatter
+from date_parsing import DateParser
+from extract_cache import ExtractCache
+from stage_scheduler import StageScheduler
+from metrics import RunMetrics
+from raw_snapshots import RawSnapshots
+from parquet_frames import ParquetFrames
+from schema_inference import SchemaInferrer
+from process_manager import ProcessManager
+import sqlalchemy.types as types
 
 class TestDatabaseUtils(unittest.TestCase):
     def test_read_db_creds(self):
@@ -20,6 +50,13 @@ class TestDatabaseUtils(unittest.TestCase):
         self.assertTrue(db_creds['LOCAL_DATABASE'])
         self.assertTrue(db_creds['LOCAL_DATABASE_TYPE'])
     
+    def test_engine_shared_per_prefix(self):
+        db_connector = DatabaseConnector()
+        local_engine = db_connector.get_engine('LOCAL_')
+        self.assertIs(db_connector.get_engine('LOCAL_'), local_engine)
+        self.assertIsNot(db_connector.get_engine('RDS_'), local_engine)
+        self.assertEqual(local_engine.pool.size(), DatabaseConnector.pool_size)
+    
     def test_read_api_creds(self):
         db_extractor = DataExtractor()
         api_creds = db_extractor.read_api_creds()
@@ -36,5 +73,845 @@ class TestDatabaseUtils(unittest.TestCase):
         db_engine = db_connector.init_db_engine(db_creds)
         self.assertIsNotNone(db_engine)
 
+class TestStoresDataFrame(unittest.TestCase):
+    def test_records_match_concatenated_frames(self):
+        store_records = sample_data.store_records(500)
+        expected = pd.concat([pd.DataFrame(record, index=["index"]) for record in store_records])
+        data_frame = DataExtractor().stores_records_to_data_frame(store_records)
+        self.assertTrue(data_frame.equals(expected))
+        self.assertTrue(data_frame.dtypes.equals(expected.dtypes))
+
+class TestDataCleaningNulls(unittest.TestCase):
+    def test_null_strings_match_reference(self):
+        for seed in range(20):
+            data_frame = sample_data.mixed_values_frame(200, seed)
+            expected = ReferenceCleaning().handle_nulls_empties_and_duplicates(data_frame.drop(['first_name', 'last_name', '1', 'index'], axis=1))
+            cleaned = DataCleaning().clean_orders_data(data_frame)
+            pd.testing.assert_frame_equal(cleaned, expected)
+
+    def test_null_strings_cover_every_case(self):
+        self.assertIn('nULl', DataCleaning.null_strings)
+        self.assertEqual(len(DataCleaning.null_strings), 16 + 16 + 8)
+
+class TestDataCleaningCompactTypes(unittest.TestCase):
+    def test_orders_compact_types(self):
+        data_frame = sample_data.orders_frame(5000, number_of_users=600)
+        expected = ReferenceCleaning().handle_nulls_empties_and_duplicates(data_frame.drop(['first_name', 'last_name', '1', 'index'], axis=1))
+        cleaned = DataCleaning().clean_orders_data(data_frame)
+        for column in ['user_uuid', 'card_number', 'store_code', 'product_code']:
+            self.assertIsInstance(cleaned[column].dtype, pd.CategoricalDtype)
+        self.assertEqual(cleaned['product_quantity'].dtype, 'int8')
+        # the values are unchanged, and the footprint without compact types is that of the object strings and int64 numbers
+        uncompacted = cleaned.astype({'user_uuid': object, 'card_number': object, 'store_code': object, 'product_code': object,
+                                      'product_quantity': 'int64'})
+        pd.testing.assert_frame_equal(uncompacted, expected)
+        memory_bytes, memory_bytes_uncompacted = DataCleaning.memory_footprint(cleaned)
+        self.assertEqual(memory_bytes, cleaned.memory_usage(index=False, deep=True).sum())
+        self.assertEqual(memory_bytes_uncompacted, uncompacted.memory_usage(index=False, deep=True).sum())
+        self.assertLess(memory_bytes, memory_bytes_uncompacted / 2)
+        # with a user for each order the user ids are all distinct, so they stay as strings
+        self.assertEqual(DataCleaning().clean_orders_data(sample_data.orders_frame(100))['user_uuid'].dtype, object)
+
+    def test_integers_with_nulls_become_nullable(self):
+        data_frame = sample_data.orders_frame(100)
+        data_frame['product_quantity'] = data_frame['product_quantity'].astype('float')
+        data_frame.loc[3, 'product_quantity'] = None
+        cleaned = DataCleaning().clean_orders_data(data_frame)
+        self.assertEqual(cleaned['product_quantity'].dtype, 'Int8')
+        self.assertTrue(cleaned['product_quantity'].isna().iloc[3])
+
+class TestDataCleaningCopies(unittest.TestCase):
+    # the peak allocations of each cleaner beyond the cleaned DataFrame in copies of the frame, measured as in test_peak_copies_halved with the
+    # cleaners before they ran under Copy-on-Write, when they dropped columns in place and sliced the rows again after each step
+    peak_copies_before = {'clean_user_data': 2.34, 'clean_card_data': 1.38, 'clean_store_data': 2.46,
+                          'clean_products_data': 2.26, 'clean_orders_data': 2.18, 'clean_time_data': 2.22}
+
+    # each cleaner with a generated frame and a column which is null on the rows it finds to be empty
+    def __cleaner_frames(self) -> dict:
+        return {'clean_user_data': (sample_data.users_frame(10000), 'email_address'),
+                'clean_card_data': (sample_data.cards_frame(10000), 'card_number'),
+                'clean_store_data': (DataExtractor().stores_records_to_data_frame(sample_data.store_records(2000)), 'store_code'),
+                'clean_products_data': (sample_data.products_frame(10000), 'product_code'),
+                'clean_orders_data': (sample_data.orders_frame(10000, number_of_users=2000), 'date_uuid'),
+                'clean_time_data': (sample_data.times_frame(10000), 'date_uuid')}
+
+    # the frames are widened with columns which the cleaners only pass through, so the copies of the frame are most of the allocations rather than
+    # the work on its columns. each holds the codes of one of the frame's columns, null where it is null, so the same rows are empty or duplicates
+    def __widen(self, data_frame: pd.DataFrame, column_name: str, number_of_columns=40) -> pd.DataFrame:
+        column = data_frame[column_name]
+        codes = pd.factorize(column.where(~column.isin(DataCleaning.null_strings)))[0].astype('float')
+        codes[codes < 0] = float('nan')
+        pass_through = pd.DataFrame({f'pass_through_{n}': codes for n in range(number_of_columns)}, index=data_frame.index)
+        return pd.concat([data_frame, pass_through], axis=1)
+
+    # the peak traced while cleaning, less the columns of the cleaned DataFrame which were allocated rather than shared with the input
+    def __peak_copies(self, clean_function, data_frame: pd.DataFrame) -> float:
+        tracemalloc.start()
+        try:
+            cleaned = clean_function(data_frame)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        cleaned_bytes = sum(column.memory_usage(index=False) for column_name, column in cleaned.items()
+                            if column_name not in data_frame.columns or not np.shares_memory(column.to_numpy(), data_frame[column_name].to_numpy()))
+        return (peak - cleaned_bytes) / data_frame.memory_usage(index=False).sum()
+
+    def test_peak_copies_halved(self):
+        # under the Copy-on-Write which ProcessManager.initialise_process turns on for a run
+        with pd.option_context('mode.copy_on_write', True):
+            for clean_function_name, (data_frame, column_name) in self.__cleaner_frames().items():
+                with self.subTest(cleaner=clean_function_name):
+                    peak_copies = self.__peak_copies(getattr(DataCleaning(), clean_function_name), self.__widen(data_frame, column_name))
+                    self.assertLessEqual(peak_copies, self.peak_copies_before[clean_function_name] / 2)
+            # when every row is kept, the columns which are not changed are shared with the extract rather than copied
+            orders = sample_data.orders_frame(1000)
+            self.assertTrue(np.shares_memory(DataCleaning().clean_orders_data(orders)['date_uuid'].to_numpy(), orders['date_uuid'].to_numpy()))
+
+    def test_input_and_options_unchanged(self):
+        for copy_on_write in [False, True]:
+            with pd.option_context('mode.copy_on_write', copy_on_write):
+                options = {option: pd.get_option(option) for option in ['mode.copy_on_write', 'mode.chained_assignment']}
+                for clean_function_name, (data_frame, _) in self.__cleaner_frames().items():
+                    with self.subTest(cleaner=clean_function_name, copy_on_write=copy_on_write):
+                        expected = data_frame.copy()
+                        with warnings.catch_warnings():
+                            warnings.simplefilter('error', pd.errors.SettingWithCopyWarning)
+                            getattr(DataCleaning(), clean_function_name)(data_frame)
+                        pd.testing.assert_frame_equal(data_frame, expected)
+                self.assertEqual({option: pd.get_option(option) for option in options}, options)
+
+class TestDataCleaningProductDates(unittest.TestCase):
+    def test_date_added_whole_table_and_chunks(self):
+        data_frame = sample_data.products_frame(2000)
+        kept = DataCleaning().clean_products_data(data_frame)
+        chunk = DataCleaning().clean_products_data(data_frame, whole_table=False)
+        date_added = data_frame['date_added'].where(~data_frame['date_added'].isin(DataCleaning.null_strings))
+        # the whole table keeps the format pandas infers from its first date, with the dates in the other formats NaT
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            expected = pd.to_datetime(date_added, errors='coerce')
+        pd.testing.assert_series_equal(kept['date_added'], expected[kept.index], check_names=False)
+        self.assertTrue(kept['date_added'].isna().any())
+        # a chunk is parsed as format='mixed' so it does not depend on the chunk's first date
+        pd.testing.assert_series_equal(chunk['date_added'], pd.to_datetime(date_added, format='mixed', errors='coerce')[chunk.index], check_names=False)
+
+class TestDataCleaningChunks(unittest.TestCase):
+    # cleans a table in chunks and removes the duplicates by their keys, keeping the first, as the database does for a streamed table
+    def __clean_in_chunks(self, clean_function, data_frame: pd.DataFrame, chunk_size: int) -> pd.DataFrame:
+        cleaned = pd.concat([clean_function(data_frame.iloc[start_row:start_row+chunk_size], whole_table=False)
+                             for start_row in range(0, data_frame.shape[0], chunk_size)])
+        duplicate_keys = cleaned.pop(DataCleaning.duplicate_key_column)
+        return cleaned[~duplicate_keys.duplicated()]
+
+    def test_users_match_whole_table(self):
+        data_frame = sample_data.users_frame(2000)
+        gb_row = data_frame[(data_frame['country_code'] == 'GB') & (data_frame['phone_number'] == '+44(0)121 4960340')].iloc[0]
+        # rows which only become equal once cleaned: the same number written another way and the country code which is corrected.
+        # a row with the same user_uuid and another name. the whole table keeps each of them, as its duplicates are found before those changes
+        planted = pd.DataFrame([gb_row.copy() for _ in range(4)])
+        planted['phone_number'] = ['0121 496 0340', '+44(0)121 4960340', '+44(0)121 4960340', '+44(0)121 4960340']
+        planted['country_code'] = ['GB', 'GGB', 'GB', 'GB']
+        planted['first_name'] = [gb_row['first_name']] * 3 + ['Another']
+        # and the row itself again in another chunk, which is removed
+        data_frame = pd.concat([data_frame, planted, gb_row.to_frame().T], ignore_index=True).astype({'index': 'int64'})
+        expected = DataCleaning().clean_user_data(data_frame)
+        self.assertEqual(len(expected) - len(expected.drop_duplicates()), 2)
+        cleaned = self.__clean_in_chunks(DataCleaning().clean_user_data, data_frame, 300)
+        pd.testing.assert_frame_equal(cleaned.astype(object), expected.astype(object))
+
+    def test_mixed_types_keyed_as_duplicated(self):
+        # the chunks of a column can have different types, such as float64 where one has a null and int64 where none has
+        data_frame = pd.DataFrame({'level_0': [1, 2, 1, 2, 3], 'index': range(5), 'first_name': None, 'last_name': None, '1': None,
+                                   'product_quantity': [1.0, 'NULL', 1, None, 2]})
+        cleaned = self.__clean_in_chunks(DataCleaning().clean_orders_data, data_frame, 2)
+        self.assertEqual(list(cleaned['level_0']), [1, 2, 3])
+
+class TestDataCleaningWeights(unittest.TestCase):
+    def test_weights_match_reference(self):
+        # random weights in the known forms and badly formed ones, compared with converting each cell with the original function
+        for seed in range(25):
+            weights = sample_data.weight_values(2000, seed)
+            expected = pd.Series(weights).apply(ReferenceCleaning().convert_product_weight).astype('float')
+            converted = DataCleaning()._DataCleaning__convert_product_weights(pd.DataFrame({'weight': weights}))['weight']
+            pd.testing.assert_series_equal(converted, expected, check_names=False)
+
+    def test_weight_classes_match_reference(self):
+        weights = pd.Series([0, 1.999, 2, 39.9, 40, 139.99, 140, 1000, float('inf'), float('nan')])
+        expected = weights.apply(ReferenceCleaning().assign_weight_class)
+        pd.testing.assert_series_equal(DataCleaning()._DataCleaning__assign_weight_classes(weights), expected)
+
+    def test_clean_products_data(self):
+        data_frame = DataCleaning().clean_products_data(sample_data.products_frame(1000))
+        self.assertEqual(data_frame['weight'].dtype, 'float64')
+        self.assertTrue(data_frame['weight_class'].isin(DataCleaning.weight_class_labels).all())
+
+class TestDataCleaningCharacters(unittest.TestCase):
+    def test_nonnumeric_character_removal_matches_reference(self):
+        data_cleaning = DataCleaning()
+        reference_cleaning = ReferenceCleaning()
+        # the stores have the same index label on every row as when they are read from the API
+        stores = DataExtractor().stores_records_to_data_frame(sample_data.store_records(500))
+        columns = [stores[column] for column in ['longitude', 'latitude', 'staff_numbers', 'lat']]
+        # enough repeated values for each distinct string to be stripped once
+        columns += [pd.Series(['£1.99', '£2.50', 7, None, float('nan'), 'abc', '£1.99'] + [f'{n % 300}e' for n in range(100000)], name='repeated')]
+        columns += [sample_data.products_frame(500)['product_price']]
+        columns += [sample_data.cards_frame(500)['card_number']]
+        for seed in range(5):
+            mixed_values = sample_data.mixed_values_frame(200, seed)
+            columns += [mixed_values[column] for column in mixed_values.columns]
+        for column in columns:
+            with self.subTest(column=column.name):
+                pd.testing.assert_series_equal(data_cleaning._DataCleaning__remove_nonnumeric_characters(column.copy()),
+                                               column.apply(reference_cleaning.remove_nonnumeric_characters))
+
+class TestPhoneNumberFormatter(unittest.TestCase):
+    def test_gb_numbers_match_reference(self):
+        # the UK plan gives the same numbers as before except for '+44(0)', which now becomes 0 rather than 00
+        phone_numbers = sample_data.phone_numbers(20000)
+        gb_rows = phone_numbers['country_code'].isin(['GB', 'FR']) & ~phone_numbers['phone_number'].str.contains('+44(0)', regex=False)
+        expected = phone_numbers.loc[gb_rows, ['phone_number']].copy()
+        ReferenceCleaning().reformat_phone_data(expected, 'phone_number')
+        formatted = PhoneNumberFormatter().format_phone_numbers(phone_numbers['phone_number'], phone_numbers['country_code'])
+        pd.testing.assert_series_equal(formatted[gb_rows], expected['phone_number'])
+
+    def test_numbering_plans(self):
+        examples = [('GB', '+44(0)121 4960340', '01214960340'), ('GB', '(0161) 496 0674', '01614960674'),
+                    ('GB', '+440207946 0958', '02079460958'), ('GB', '0121 496 0225 x123', '01214960225x123'),
+                    ('GB', '12345', None), ('FR', '020 7946 0958', '02079460958'), ('GB', None, None),
+                    ('US', '001-308-254-4417x1234', '3082544417x1234'), ('US', '(555)555-0143', '5555550143'),
+                    ('US', '+1-843-455-1255', '8434551255'), ('US', '(055)555-0143', None), ('US', '020 7946 0958', None),
+                    ('DE', '+49(0) 047905356', '047905356'), ('DE', '04859 08233', '0485908233'),
+                    ('DE', '+49(0)8458 03476', '0845803476'), ('DE', '12345', None)]
+        country_codes, phone_numbers, expected = (pd.Series(column, dtype=object) for column in zip(*examples))
+        formatted = PhoneNumberFormatter().format_phone_numbers(phone_numbers, country_codes)
+        self.assertEqual(formatted.tolist(), expected.tolist())
+
+    def test_numbering_plans_match_reference(self):
+        # the numbers of every plan are also checked against the other plans, with some written with tabs, dots and extensions
+        phone_numbers = sample_data.phone_numbers(20000)
+        rng = np.random.default_rng(0)
+        country_codes = pd.Series(np.array(['GB', 'US', 'DE', 'FR', None], dtype=object)[rng.integers(0, 5, len(phone_numbers))])
+        extra_numbers = pd.Series(['+44 (0)20 7946 0958', '+44\t020 7946 0958', '0044 20 7946 0958 #1234', '+1 (308) 254 4417 ext. 12',
+                                   '1.308.254.4417', '0049 (0)30/1234-567', '+49 0 30 1234', '+4930 1234 5678 9012 345', 12345, None, ''], dtype=object)
+        for numbers, codes in [(phone_numbers['phone_number'], phone_numbers['country_code']), (phone_numbers['phone_number'], country_codes),
+                               (extra_numbers, pd.Series(['GB', 'GB', 'GB', 'US', 'US', 'DE', 'DE', 'DE', 'GB', 'GB', 'GB'], dtype=object)),
+                               (extra_numbers, pd.Series('US', index=extra_numbers.index)), (extra_numbers, pd.Series('DE', index=extra_numbers.index))]:
+            expected = [ReferenceCleaning().format_phone_number(phone_number, country_code) for phone_number, country_code in zip(numbers, codes)]
+            self.assertEqual(PhoneNumberFormatter().format_phone_numbers(numbers, codes).tolist(), expected)
+
+    def test_default_plan(self):
+        phone_numbers = pd.Series(['020 7946 0958', '(555)555-0143'])
+        self.assertEqual(PhoneNumberFormatter().format_phone_numbers(phone_numbers).tolist(), ['02079460958', None])
+
+    def test_clean_user_data_formats_by_country(self):
+        data_frame = DataCleaning().clean_user_data(sample_data.users_frame(2000))
+        us_rows = data_frame['country_code'] == 'US'
+        self.assertTrue(data_frame.loc[us_rows, 'phone_number'].dropna().str.fullmatch(r'\d{10}(?:x\d+)?').all())
+        self.assertTrue(data_frame.loc[us_rows, 'phone_number'].notna().any())
+
+class TestDateParser(unittest.TestCase):
+    def test_matches_mixed_format(self):
+        users = sample_data.users_frame(5000)
+        mixed_values = sample_data.mixed_values_frame(500)
+        columns = [users['date_of_birth'], users['join_date'], sample_data.cards_frame(500)['date_payment_confirmed']]
+        columns += [pd.Series(sample_data.date_strings(20000), name='random_dates')]
+        columns += [pd.Series(['1990-2-3', '', ' 1990-09-30', '30/12/1990', '1990-09-30T10:00', '1968 october 16', 'October 2012 08'], name='odd_dates')]
+        columns += [mixed_values[column] for column in mixed_values.columns if column.startswith('column_')]
+        for column in columns:
+            with self.subTest(column=column.name):
+                pd.testing.assert_series_equal(DateParser().parse(column), pd.to_datetime(column, format='mixed', errors='coerce'))
+
+    def test_errors_ignore(self):
+        for values in [['2010-06-12', 'October 2012 08'], ['2010-06-12', 'xx']]:
+            column = pd.Series(values * 3, index=['index'] * 6)
+            pd.testing.assert_series_equal(DateParser().parse(column, errors='ignore'), pd.to_datetime(column, format='mixed', errors='ignore'))
+
+    def test_pass_counts(self):
+        date_parser = DateParser()
+        date_parser.parse(pd.Series(['2010-06-12', '2010-06-12', '2010/06/12', '1968 October 16', 'January 1951 27', '30/12/1990', 'xx', None]))
+        self.assertEqual(date_parser.pass_counts, {'%Y-%m-%d': 2, '%Y/%m/%d': 1, '%Y %B %d': 1, '%B %Y %d': 1, 'mixed': 1, 'unparsed': 2})
+
+class TestDataCleaningTimes(unittest.TestCase):
+    def test_clean_time_data_matches_reference(self):
+        for seed in range(5):
+            data_frame = sample_data.times_frame(20000, seed)
+            expected = ReferenceCleaning().clean_time_data(data_frame.copy()).astype({'time_period': 'category'})
+            pd.testing.assert_frame_equal(DataCleaning().clean_time_data(data_frame.copy()), expected)
+
+    def test_clean_time_data_first_row_not_a_date(self):
+        # pd.to_datetime then parses every row on its own, so the rows must all be joined and parsed as before
+        for first_row in [['NULL'] * 6, ['22:00:06', '9', '2012', '31', 'Evening', 'NULL'], ['23:59:60', '9', '2012', '30', 'Evening', 'NULL']]:
+            data_frame = sample_data.times_frame(2000)
+            data_frame.iloc[0] = first_row
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                expected = ReferenceCleaning().clean_time_data(data_frame.copy()).astype({'time_period': 'category'})
+                pd.testing.assert_frame_equal(DataCleaning().clean_time_data(data_frame.copy()), expected)
+
+class StoreApiStub(BaseHTTPRequestHandler):
+    # store number -> number of 429 responses still to send before answering
+    throttled_stores = {}
+
+    def do_GET(self):
+        store_number = int(self.path.rsplit('/', 1)[1])
+        if self.throttled_stores.get(store_number, 0) > 0:
+            self.throttled_stores[store_number] -= 1
+            self.send_response(429)
+            self.end_headers()
+            return
+        body = json.dumps({'index': store_number, 'store_code': f'ST-{store_number:05}'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestDataExtractorStores(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('localhost', 0), StoreApiStub)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.template = f'http://localhost:{self.server.server_port}/store_details/{{store_number}}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_concurrent_matches_serial(self):
+        data_extractor = DataExtractor()
+        serial = data_extractor.retrieve_stores_data({}, self.template, 40, max_workers=1)
+        concurrent = data_extractor.retrieve_stores_data({}, self.template, 40, max_workers=8)
+        self.assertTrue(serial.equals(concurrent))
+        self.assertEqual(list(concurrent['index']), list(range(40)))
+
+    def test_retries_throttled_requests(self):
+        StoreApiStub.throttled_stores = {3: 1, 7: 2}
+        data_frame = DataExtractor().retrieve_stores_data({}, self.template, 10, max_workers=4)
+        self.assertEqual(list(data_frame['store_code']), [f'ST-{n:05}' for n in range(10)])
+
+class TestDataExtractorS3Chunks(unittest.TestCase):
+    dtypes = {'Unnamed: 0': 'int64', 'product_name': object, 'product_price': object, 'weight': object,
+              'category': object, 'EAN': object, 'date_added': object, 'uuid': object,
+              'removed': object, 'product_code': object}
+
+    def setUp(self):
+        self.content = sample_data.products_frame(3000).to_csv(index=False).encode()
+        self.s3client = S3ClientStub({'products.csv': (self.content, '"1"')})
+
+    def test_ranged_chunks_match_whole_read(self):
+        data_frames = list(DataExtractor().extract_from_s3_chunks('s3://bucket/products.csv', 700, self.dtypes, self.s3client,
+                                                                  part_size=10000, max_workers=3))
+        self.assertEqual([len(data_frame) for data_frame in data_frames], [700, 700, 700, 700, 200])
+        expected = pd.read_csv(io.BytesIO(self.content), dtype=self.dtypes)
+        pd.testing.assert_frame_equal(pd.concat(data_frames), expected)
+        self.assertEqual(self.s3client.get_object_calls, -(-len(self.content) // 10000))
+
+    def test_chunked_cleaning_matches_whole_table(self):
+        data_frames = DataExtractor().extract_from_s3_chunks('s3://bucket/products.csv', 700, self.dtypes, self.s3client)
+        cleaned_chunks = pd.concat([DataCleaning().clean_products_data(data_frame, whole_table=False) for data_frame in data_frames])
+        # the database removes the duplicates by their keys once every chunk is saved
+        cleaned_chunks = cleaned_chunks[~cleaned_chunks.pop(DataCleaning.duplicate_key_column).duplicated()]
+        expected = DataCleaning().clean_products_data(pd.read_csv(io.BytesIO(self.content), dtype=self.dtypes))
+        # the chunks parse every date_added as format='mixed', where the whole table keeps the format of its first date
+        pd.testing.assert_frame_equal(cleaned_chunks.drop(columns=['date_added']), expected.drop(columns=['date_added']))
+        self.assertTrue((cleaned_chunks['date_added'] == expected['date_added'])[expected['date_added'].notna()].all())
+
+class ExtractApiStub(BaseHTTPRequestHandler):
+    content = b''
+    etag = '"1"'
+    # the number of responses sent with the content rather than 304 Not Modified
+    full_responses = 0
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        ExtractApiStub.full_responses += 1
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, format, *args):
+        pass
+
+# stands in for a boto3 S3 client, keeping the objects in a dictionary of key -> (content, ETag)
+class S3ClientStub:
+    def __init__(self, objects: dict):
+        self.objects = objects
+        self.get_object_calls = 0
+
+    def head_object(self, Bucket, Key):
+        return {'ETag': self.objects[Key][1], 'ContentLength': len(self.objects[Key][0])}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        self.get_object_calls += 1
+        content, etag = self.objects[Key]
+        if IfMatch is not None and IfMatch != etag:
+            raise ValueError('PreconditionFailed')
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            content = content[int(start):int(end)+1]
+        return {'Body': io.BytesIO(content), 'ETag': etag}
+
+# saves DataFrames in the extract cache of a directory, as a stage run in another process does
+def write_cached_data_frames(directory, process_number):
+    extract_cache = ExtractCache(directory)
+    for number in range(100):
+        extract_cache.write_data_frame(f'{process_number}:{number}', pd.DataFrame({'number': [number % 10]}))
+    return extract_cache.read_data_frame(f'{process_number}:99')
+
+class TestExtractCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        ExtractApiStub.content = json.dumps({'a': [1, 2], 'b': ['x', 'y']}).encode()
+        ExtractApiStub.etag = '"1"'
+        ExtractApiStub.full_responses = 0
+        self.server = ThreadingHTTPServer(('localhost', 0), ExtractApiStub)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://localhost:{self.server.server_port}/date_details.json'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def test_http_only_downloads_changed_content(self):
+        data_extractor = DataExtractor(ExtractCache(self.directory.name))
+        first = data_extractor.extract_from_json(self.url)
+        # a new cache on the same directory reads the index saved by the first
+        data_extractor = DataExtractor(ExtractCache(self.directory.name))
+        second = data_extractor.extract_from_json(self.url)
+        self.assertTrue(first.equals(second))
+        self.assertEqual(list(first['b']), ['x', 'y'])
+        self.assertEqual(ExtractApiStub.full_responses, 1)
+        self.assertEqual(data_extractor.extract_cache.statistics['hits'], 1)
+        ExtractApiStub.content = json.dumps({'a': [3], 'b': ['z']}).encode()
+        ExtractApiStub.etag = '"2"'
+        changed = data_extractor.extract_from_json(self.url)
+        self.assertEqual(list(changed['b']), ['z'])
+        self.assertEqual(ExtractApiStub.full_responses, 2)
+
+    def test_corrupt_content_downloaded_again(self):
+        extract_cache = ExtractCache(self.directory.name)
+        content = extract_cache.fetch_http(requests.Session(), self.url)
+        content_file_name = hashlib.sha256(content).hexdigest()
+        with open(os.path.join(self.directory.name, content_file_name), 'wb') as file:
+            file.write(b'corrupt')
+        self.assertEqual(extract_cache.fetch_http(requests.Session(), self.url), content)
+        self.assertEqual(ExtractApiStub.full_responses, 2)
+
+    def test_parsed_pdf_shared_and_cached(self):
+        ExtractApiStub.content = b'%PDF-1.4 card details'
+        extract_cache = ExtractCache(self.directory.name)
+        pdf_data = pd.DataFrame({'card_number': ['4971858637664481'], 'expiry_date': ['09/23']})
+        # saved as an earlier run would have, so tabula (and Java) is not needed
+        extract_cache.write_data_frame(extract_cache.parsed_source('tabula', ExtractApiStub.content, {'pages': 'all'}), pdf_data)
+        data_extractor = DataExtractor(extract_cache)
+        url = self.url.replace('date_details.json', 'card_details.pdf')
+        threads = [threading.Thread(target=data_extractor.retrieve_pdf_data, args=(url,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(data_extractor.retrieve_pdf_data(url).equals(pdf_data))
+        # the PDF is read once per process however many threads ask for it
+        self.assertEqual(ExtractApiStub.full_responses, 1)
+        self.assertEqual(extract_cache.statistics['hits'], 1)
+
+    def test_s3_only_downloads_changed_etag(self):
+        s3client = S3ClientStub({'products.csv': (b'a,b\n1,x\n', '"1"')})
+        data_extractor = DataExtractor(ExtractCache(self.directory.name))
+        first = data_extractor.extract_from_s3('s3://bucket/products.csv', s3client)
+        second = data_extractor.extract_from_s3('s3://bucket/products.csv', s3client)
+        self.assertTrue(first.equals(second))
+        self.assertEqual(s3client.get_object_calls, 1)
+        s3client.objects['products.csv'] = (b'a,b\n2,y\n', '"2"')
+        changed = data_extractor.extract_from_s3('s3://bucket/products.csv', s3client)
+        self.assertEqual(list(changed['b']), ['y'])
+        self.assertEqual(s3client.get_object_calls, 2)
+        self.assertEqual(data_extractor.extract_cache.version('s3://bucket/products.csv'), hashlib.sha256(b'a,b\n2,y\n').hexdigest())
+        self.assertIsNone(data_extractor.extract_cache.version('s3://bucket/other.csv'))
+
+    def test_least_recently_used_evicted(self):
+        s3client = S3ClientStub({key: (key.encode() * 10, '"1"') for key in ['a', 'b', 'c']})
+        extract_cache = ExtractCache(self.directory.name, max_bytes=25)
+        extract_cache.fetch_s3(s3client, 'bucket', 'a')
+        extract_cache.fetch_s3(s3client, 'bucket', 'b')
+        # reading a again makes b the least recently used
+        extract_cache.fetch_s3(s3client, 'bucket', 'a')
+        extract_cache.fetch_s3(s3client, 'bucket', 'c')
+        self.assertEqual(extract_cache.statistics['evictions'], 1)
+        self.assertEqual(len(os.listdir(self.directory.name)), 3)
+        extract_cache.fetch_s3(s3client, 'bucket', 'a')
+        self.assertEqual(s3client.get_object_calls, 3)
+        extract_cache.fetch_s3(s3client, 'bucket', 'b')
+        self.assertEqual(s3client.get_object_calls, 4)
+
+    def test_processes_share_directory(self):
+        with ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context('spawn')) as process_pool:
+            futures = [process_pool.submit(write_cached_data_frames, self.directory.name, process_number) for process_number in range(4)]
+            for future in futures:
+                self.assertEqual(list(future.result()['number']), [9])
+        # the index is the last one written, and every file is complete
+        file_names = os.listdir(self.directory.name)
+        self.assertFalse([file_name for file_name in file_names if file_name.endswith('.tmp')])
+        self.assertEqual(len(file_names), 11)
+        with open(os.path.join(self.directory.name, ExtractCache.index_file_name)) as file:
+            source = list(json.load(file))[-1]
+        self.assertEqual(list(ExtractCache(self.directory.name).read_data_frame(source)['number']), [9])
+
+class TestStageScheduler(unittest.TestCase):
+    def test_stages_wait_for_dependencies(self):
+        finished = []
+        stage_scheduler = StageScheduler()
+        stage_scheduler.add_stage('fk', lambda: finished.append('fk'), ['orders', 'users'])
+        stage_scheduler.add_stage('orders', lambda: (time.sleep(0.05), finished.append('orders')))
+        stage_scheduler.add_stage('users', lambda: finished.append('users'))
+        self.assertTrue(stage_scheduler.run())
+        self.assertEqual(finished, ['users', 'orders', 'fk'])
+        self.assertEqual(stage_scheduler.critical_path(), ['orders', 'fk'])
+        self.assertIn('critical path: orders -> fk', stage_scheduler.report())
+
+    def test_failure_skips_dependents(self):
+        ran = []
+        def fail():
+            raise RuntimeError('extract failed')
+        stage_scheduler = StageScheduler()
+        stage_scheduler.add_stage('cards', fail)
+        stage_scheduler.add_stage('fk_cards', lambda: ran.append('fk_cards'), ['cards'])
+        stage_scheduler.add_stage('after_fk', lambda: ran.append('after_fk'), ['fk_cards'])
+        stage_scheduler.add_stage('users', lambda: ran.append('users'))
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(stage_scheduler.run())
+        self.assertEqual(ran, ['users'])
+        self.assertEqual({name: result['status'] for name, result in stage_scheduler.results.items()},
+                         {'cards': 'failed', 'fk_cards': 'skipped', 'after_fk': 'skipped', 'users': 'succeeded'})
+        self.assertIsInstance(stage_scheduler.results['cards']['error'], RuntimeError)
+
+    def test_concurrency_limit(self):
+        running = []
+        most_running = []
+        lock = threading.Lock()
+        def stage():
+            with lock:
+                running.append(1)
+                most_running.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+        stage_scheduler = StageScheduler()
+        for number in range(6):
+            stage_scheduler.add_stage(f'stage_{number}', stage)
+        self.assertTrue(stage_scheduler.run(max_workers=2))
+        self.assertEqual(max(most_running), 2)
+
+    def test_unknown_dependency(self):
+        stage_scheduler = StageScheduler()
+        stage_scheduler.add_stage('fk', lambda: None, ['orders'])
+        with self.assertRaises(ValueError):
+            stage_scheduler.run()
+
+class TestRunMetrics(unittest.TestCase):
+    def test_stage_phases_and_cleaning_steps(self):
+        metrics = RunMetrics()
+        data_cleaning = DataCleaning()
+        data_cleaning.metrics = metrics
+        stage_scheduler = StageScheduler()
+        def process_products():
+            with metrics.stage('process_products'):
+                with metrics.phase('extract'):
+                    data_frame = sample_data.products_frame(2000)
+                    metrics.add_bytes(bytes_in=1000)
+                with metrics.phase('clean'):
+                    cleaned = data_cleaning.clean_products_data(data_frame)
+                metrics.add_rows(len(data_frame), len(cleaned))
+                metrics.profile_columns(cleaned)
+        stage_scheduler.add_stage('process_products', process_products)
+        self.assertTrue(stage_scheduler.run())
+        # nothing is recorded against a stage outside it
+        metrics.add_rows(1, 1)
+        report = metrics.report(stage_scheduler)
+        stage = report['stages']['process_products']
+        self.assertEqual(stage['status'], 'succeeded')
+        self.assertEqual(set(stage['phases']), {'extract', 'clean'})
+        self.assertEqual(set(stage['steps']), {'nulls', 'weights', 'dates'})
+        self.assertLessEqual(sum(step['wall_seconds'] for step in stage['steps'].values()), stage['phases']['clean']['wall_seconds'])
+        self.assertEqual(stage['rows_in'], 2000)
+        self.assertEqual(stage['bytes_in'], 1000)
+        self.assertEqual(stage['columns']['weight']['dtype'], 'float64')
+        self.assertEqual(report['critical_path'], ['process_products'])
+        json.dumps(report)
+
+    def test_prometheus_text(self):
+        metrics = RunMetrics()
+        with metrics.stage('process_"users"'):
+            with metrics.phase('load'):
+                metrics.add_bytes(bytes_out=10)
+        text = metrics.prometheus_text(metrics.report())
+        self.assertIn('# TYPE etl_stage_bytes_out gauge\netl_stage_bytes_out{stage="process_\\"users\\""} 10\n', text)
+        self.assertIn('etl_phase_wall_seconds{stage="process_\\"users\\"",phase="load"}', text)
+        with tempfile.TemporaryDirectory() as directory:
+            json_path = os.path.join(directory, 'run_report.json')
+            metrics.write_reports(metrics.report(), json_path, os.path.join(directory, 'run_report.prom'))
+            with open(json_path) as file:
+                self.assertEqual(json.load(file)['stages']['process_"users"']['bytes_out'], 10)
+
+    def test_merge_from_another_process(self):
+        metrics = RunMetrics()
+        other_metrics = RunMetrics()
+        with other_metrics.stage('process_times'):
+            other_metrics.add_rows(5, 4)
+        with metrics.stage('process_times'):
+            metrics.merge(other_metrics.stages)
+        self.assertEqual(metrics.stages['process_times']['rows_out'], 4)
+        # a copy sent to a process in the pool starts empty
+        self.assertEqual(pickle.loads(pickle.dumps(metrics)).stages, {})
+
+class DatabaseConnectorStub:
+    # saves the uploaded tables as pickles in a directory, so that a table loaded in another process can be read back in the test
+    def __init__(self, directory):
+        self.directory = directory
+
+    def upsert_to_db(self, data_frame, table_name, dtypes, primary_key, full_refresh, schema):
+        data_frame.to_pickle(os.path.join(self.directory, table_name + '.pkl'))
+        return {'mode': 'replace', 'inserted': data_frame.shape[0], 'updated': 0, 'deleted': 0, 'unchanged': 0}
+
+class SampleProcessManager(ProcessManager):
+    # runs the stages on sample data replayed from the 'sample' snapshot in the directory given by sample_directory=<directory>,
+    # saving the raw extract in that directory too and the cleaned table with DatabaseConnectorStub, so it needs neither the sources nor the database
+    schema_inferrer = SchemaInferrer()
+
+    def read_arguments(self, argv, snapshot_id=None):
+        super().read_arguments(argv, snapshot_id)
+        directory = [argument.partition('=')[2] for argument in argv if argument.startswith('sample_directory=')][0]
+        self.replay_snapshots = RawSnapshots(directory, 'sample')
+        self.raw_snapshots = RawSnapshots(directory, snapshot_id)
+        self.db_connector = DatabaseConnectorStub(directory)
+
+class TestProcessManagerExecutors(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.data_frame = sample_data.users_frame(2000)
+        replay_snapshots = RawSnapshots(self.directory.name, 'sample')
+        replay_snapshots.write('dim_users', self.data_frame)
+        self.assertTrue(replay_snapshots.close())
+        self.argv = ['process_users', 'sample_directory=' + self.directory.name]
+        self.cleaned = DataCleaning().clean_user_data(sample_data.users_frame(2000))
+        # the pool is made as initialise_stages makes it
+        self.process_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=ProcessManager.initialise_process)
+        self.addCleanup(self.process_pool.shutdown)
+
+    def assert_stage_saved(self, snapshot_id):
+        pd.testing.assert_frame_equal(pd.read_pickle(os.path.join(self.directory.name, 'dim_users.pkl')), self.cleaned)
+        pd.testing.assert_frame_equal(RawSnapshots(self.directory.name, snapshot_id).read('dim_users'), self.data_frame)
+
+    def test_stage_in_process(self):
+        # executor_processes: the stage runs in the pool with a SampleProcessManager of its own, which is finalised there, and its metrics are merged
+        metrics = RunMetrics()
+        with metrics.stage('process_users'):
+            metrics.merge(self.process_pool.submit(SampleProcessManager.run_stage, 'process_users',
+                                                   self.argv + ['executor_processes'], 'processes').result())
+        self.assert_stage_saved('processes')
+        stage = metrics.stages['process_users']
+        self.assertEqual(set(stage['phases']), {'extract', 'clean', 'load'})
+        self.assertEqual(set(stage['steps']), {'nulls', 'phones', 'dates', 'schema'})
+        self.assertEqual((stage['rows_in'], stage['rows_out']), (len(self.data_frame), len(self.cleaned)))
+        self.assertGreater(stage['cpu_seconds'], 0)
+        self.assertGreater(stage['memory_bytes'], 0)
+        self.assertEqual(set(stage['columns']), set(self.cleaned.columns))
+
+    def test_cleaning_in_process(self):
+        # executor_hybrid: the stage runs here and sends the cleaning to the pool, pickling the DataCleaning with the run's RunMetrics
+        process_manager = SampleProcessManager()
+        process_manager.read_arguments(self.argv + ['executor_hybrid'], 'hybrid')
+        self.assertEqual(process_manager.executor, 'hybrid')
+        process_manager.process_pool = self.process_pool
+        with process_manager.metrics.stage('process_users'):
+            process_manager.process_users()
+        self.assertTrue(process_manager.finalise())
+        self.assertIsNone(process_manager.process_pool)
+        self.assert_stage_saved('hybrid')
+        stage = process_manager.metrics.stages['process_users']
+        self.assertEqual(set(stage['phases']), {'extract', 'clean', 'load'})
+        # the steps of the cleaning are recorded by the copy of the RunMetrics in the pool, which starts empty and is not sent back
+        self.assertEqual(set(stage['steps']), {'schema'})
+        self.assertEqual((stage['rows_in'], stage['rows_out']), (len(self.data_frame), len(self.cleaned)))
+
+class ConfiguredDataExtractor(DataExtractor):
+    # reads the configuration it is given rather than api_creds.yaml
+    def __init__(self, api_config):
+        super().__init__()
+        self.api_config = api_config
+
+    def read_api_creds(self):
+        return self.api_config
+
+class TestProcessManagerConfiguration(unittest.TestCase):
+    # a ProcessManager reading the given configuration
+    def __process_manager(self, api_config):
+        class ConfiguredProcessManager(ProcessManager):
+            db_connector = DatabaseConnector()
+            data_extractor = ConfiguredDataExtractor(api_config)
+        return ConfiguredProcessManager()
+
+    def test_extract_cache_only_when_configured(self):
+        process_manager = self.__process_manager({'schema_cache_path': None})
+        self.assertIsNone(process_manager.data_extractor.extract_cache)
+        self.assertIsNone(process_manager.schema_inferrer.cache_path)
+        self.assertEqual(process_manager.stream_chunk_size, 50000)
+        with tempfile.TemporaryDirectory() as directory:
+            schema_cache_path = os.path.join(directory, 'schema.json')
+            process_manager = self.__process_manager({'extract_cache_directory': directory, 'schema_cache_path': schema_cache_path,
+                                                      'stream_chunk_size': 1000})
+            self.assertEqual(process_manager.data_extractor.extract_cache.directory, directory)
+            self.assertEqual(process_manager.schema_inferrer.cache_path, schema_cache_path)
+            self.assertEqual(process_manager.stream_chunk_size, 1000)
+
+    def test_pool_sized_for_stages(self):
+        # six process stages and five foreign key stages can run at once, with two connections for the main thread
+        self.assertEqual(self.__process_manager({'schema_cache_path': None}).db_connector.pool_size, 13)
+        self.assertEqual(self.__process_manager({'schema_cache_path': None, 'stage_max_workers': 3}).db_connector.pool_size, 5)
+        self.assertEqual(self.__process_manager({'schema_cache_path': None, 'stage_max_workers': 20}).db_connector.pool_size, 13)
+
+class TestRawSnapshots(unittest.TestCase):
+    def test_replay_matches_extract(self):
+        data_frame = sample_data.users_frame(1000)
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone(RawSnapshots.latest_snapshot_id(directory))
+            raw_snapshots = RawSnapshots(directory, '20240101T000000')
+            raw_snapshots.write('dim_users', data_frame)
+            # the stage cleans the extract once it is handed to the writer
+            cleaned = DataCleaning().clean_user_data(data_frame)
+            self.assertTrue(raw_snapshots.close())
+            self.assertEqual(RawSnapshots.latest_snapshot_id(directory), '20240101T000000')
+            replay_snapshots = RawSnapshots(directory, RawSnapshots.latest_snapshot_id(directory))
+            replayed = replay_snapshots.read('dim_users')
+            pd.testing.assert_frame_equal(replayed, sample_data.users_frame(1000))
+            self.assertEqual(replay_snapshots.read_manifest()['tables']['dim_users']['rows'], len(replayed))
+            pd.testing.assert_frame_equal(DataCleaning().clean_user_data(replayed.copy()), cleaned)
+            chunks = list(replay_snapshots.read_chunks('dim_users', 300))
+            self.assertEqual(sum(len(chunk) for chunk in chunks), len(replayed))
+            self.assertEqual(len(chunks[0]), 300)
+            with self.assertRaises(FileNotFoundError):
+                replay_snapshots.read('orders_table')
+
+    def test_extract_changed_in_place_is_kept(self):
+        # with or without Copy-on-Write, a change the caller makes in place once the extract is handed to the writer is not saved
+        for copy_on_write in [False, True]:
+            with pd.option_context('mode.copy_on_write', copy_on_write), tempfile.TemporaryDirectory() as directory:
+                data_frame = sample_data.users_frame(100)
+                raw_snapshots = RawSnapshots(directory)
+                raw_snapshots.write('dim_users', data_frame)
+                data_frame.loc[data_frame.index[0], 'first_name'] = 'changed'
+                self.assertTrue(raw_snapshots.close())
+                pd.testing.assert_frame_equal(RawSnapshots(directory, raw_snapshots.snapshot_id).read('dim_users'), sample_data.users_frame(100))
+
+    def test_mixed_object_columns_are_kept(self):
+        data_frame = pd.DataFrame({'staff_numbers': ['12', 3, None, 'J78'], 'longitude': [1.5, 'N/A', None, '-0.1']})
+        with tempfile.TemporaryDirectory() as directory:
+            raw_snapshots = RawSnapshots(directory)
+            raw_snapshots.write('dim_store_details', data_frame)
+            self.assertTrue(raw_snapshots.close())
+            replayed = RawSnapshots(directory, raw_snapshots.snapshot_id).read('dim_store_details')
+        self.assertEqual(list(replayed['staff_numbers']), ['12', 3, None, 'J78'])
+        self.assertEqual([type(value) for value in replayed['staff_numbers']], [str, int, type(None), str])
+        self.assertEqual(list(replayed['longitude']), [1.5, 'N/A', None, '-0.1'])
+
+class TestParquetFrames(unittest.TestCase):
+    def test_mixed_values_round_trip(self):
+        data_frame = sample_data.mixed_values_frame(2000).set_index('index')
+        data_frame['dates'] = [datetime.date(2020, 1, 2), {'date': 1}, np.int64(5), None] * 500
+        buffer = io.BytesIO()
+        ParquetFrames.write(data_frame, buffer)
+        buffer.seek(0)
+        read = ParquetFrames.read(buffer)
+        pd.testing.assert_frame_equal(read, data_frame)
+        # the numpy numbers in an object column are read back as Python numbers
+        for column in data_frame.columns:
+            self.assertEqual([type(value) for value in read[column]],
+                             [type(value.item()) if isinstance(value, np.generic) and data_frame[column].dtype == object else type(value)
+                              for value in data_frame[column]])
+
+class TestSchemaInferrer(unittest.TestCase):
+    def test_orders_types(self):
+        data_frame = DataCleaning().clean_orders_data(sample_data.orders_frame(5000, number_of_users=600))
+        data_frame.loc[data_frame.index[:10], 'card_number'] = None
+        dtypes = SchemaInferrer().infer(data_frame)
+        for column in ['date_uuid', 'user_uuid']:
+            self.assertIsInstance(dtypes[column], types.UUID)
+        # the VARCHAR lengths are those measured one value at a time, without failing on the nulls
+        for column in ['card_number', 'store_code', 'product_code']:
+            self.assertIsInstance(dtypes[column], types.VARCHAR)
+            self.assertEqual(dtypes[column].length, data_frame[column].dropna().map(lambda x: len(str(x))).max())
+        self.assertIsInstance(dtypes['product_quantity'], types.SMALLINT)
+        self.assertIsInstance(dtypes['level_0'], types.SMALLINT)
+        data_frame['level_0'] += 40000
+        self.assertIsInstance(SchemaInferrer().infer(data_frame)['level_0'], types.INTEGER)
+
+    def test_products_types_and_overrides(self):
+        data_frame = DataCleaning().clean_products_data(sample_data.products_frame(1000))
+        dtypes = SchemaInferrer().infer(data_frame, {'currency': types.VARCHAR(3), 'EAN': types.VARCHAR})
+        self.assertEqual(dtypes['currency'].length, 3)
+        self.assertEqual(dtypes['EAN'].length, data_frame['EAN'].map(lambda x: len(str(x))).max())
+        self.assertIsInstance(dtypes['uuid'], types.UUID)
+        self.assertIsInstance(dtypes['date_added'], types.DATE)
+        self.assertIsInstance(dtypes['weight'], types.FLOAT)
+        self.assertIsInstance(dtypes['still_available'], types.BOOLEAN)
+        self.assertEqual(dtypes['weight_class'].length, len('Truck_Required'))
+        # a streamed chunk leaves room for the values in the later chunks
+        streamed = SchemaInferrer().infer(data_frame, {'currency': types.VARCHAR(3), 'EAN': types.VARCHAR}, streamed=True)
+        self.assertEqual(type(streamed['product_code']), types.TEXT)
+        self.assertEqual(type(streamed['EAN']), types.TEXT)
+        self.assertIsInstance(streamed['uuid'], types.UUID)
+
+    def test_times_and_odd_columns(self):
+        data_frame = DataCleaning().clean_time_data(sample_data.times_frame(1000))
+        dtypes = SchemaInferrer().infer(data_frame)
+        self.assertIsInstance(dtypes['date_timestamp'], types.TIMESTAMP)
+        self.assertNotIsInstance(dtypes['date_timestamp'], types.DATE)
+        profile = SchemaInferrer().profile(pd.DataFrame({'numbers': [1, 'ab', None], 'empty': [None, None, None],
+                                                         'not_uuid': ['123e4567-e89b-12d3-a456-42661417400g', None, 'é' * 36]}))
+        self.assertEqual(profile['numbers'], {'nulls': 1, 'kind': 'string', 'max_length': 2, 'uuid': False})
+        self.assertEqual(profile['empty']['kind'], 'empty')
+        self.assertFalse(profile['not_uuid']['uuid'])
+
+    def test_cached_by_source_version(self):
+        data_frame = DataCleaning().clean_user_data(sample_data.users_frame(500))
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = os.path.join(directory, 'schema_cache.json')
+            overrides = {'first_name': types.VARCHAR(255)}
+            dtypes = SchemaInferrer(cache_path).infer(data_frame, overrides, 'dim_users', 'version1')
+            self.assertEqual(dtypes['first_name'].length, 255)
+            # the cached profile is used for the same source version, so the longer address is not measured
+            longer = data_frame.copy()
+            longer.loc[longer.index[0], 'address'] = 'x' * 300
+            schema_inferrer = SchemaInferrer(cache_path)
+            self.assertEqual(schema_inferrer.infer(longer, overrides, 'dim_users', 'version1')['address'].length, dtypes['address'].length)
+            self.assertEqual(schema_inferrer.infer(longer, overrides, 'dim_users', 'version2')['address'].length, 300)
+            # changing the overrides profiles the table again
+            self.assertEqual(schema_inferrer.infer(longer, {}, 'dim_users', 'version2')['first_name'].length,
+                             data_frame['first_name'].str.len().max())
+            with open(cache_path) as file:
+                self.assertEqual(list(json.load(file)), ['dim_users'])
+
+    def test_cached_by_code_version(self):
+        data_frame = DataCleaning().clean_user_data(sample_data.users_frame(500))
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = os.path.join(directory, 'schema_cache.json')
+            dtypes = SchemaInferrer(cache_path, 'code1').infer(data_frame, {}, 'dim_users', 'version1')
+            # cleaning code which formats the phone numbers longer is profiled again for the same source
+            longer = data_frame.assign(phone_number=data_frame['phone_number'] + ' ext. 1234')
+            self.assertEqual(SchemaInferrer(cache_path, 'code1').infer(longer, {}, 'dim_users', 'version1')['phone_number'].length,
+                             dtypes['phone_number'].length)
+            self.assertEqual(SchemaInferrer(cache_path, 'code2').infer(longer, {}, 'dim_users', 'version1')['phone_number'].length,
+                             longer['phone_number'].str.len().max())
+
 if __name__ == '__main__':
     unittest.main()